@@ -0,0 +1,5 @@
+'''
+Performance benchmarks. Run modules directly, e.g.:
+
+    python -m benchmarks.serialization
+'''
@@ -0,0 +1,154 @@
+'''
+Password hashing cost against request latency.
+
+For every hashing method a fresh process creates wallets through
+/v1/create and then logs them in through /v1/balance (auth cache
+off, so every login verifies the hash), from concurrent clients.
+Time of a single hash and throughput, p50/p95/p99 latency and
+statuses (503 when the hashing pool is full) of both routes are
+printed and saved as JSON.
+
+    python -m benchmarks.hashing [--methods m1,m2,...]
+        [--requests N] [--concurrency N]
+        [--hash-workers N] [--max-pending N] [--output FILE]
+'''
+import argparse
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.load import InProcessDriver, REPO, auth_headers, run_route
+from whalet.passwords import PasswordHasher
+
+
+METHODS = (
+    'pbkdf2:sha256:100000',
+    'pbkdf2:sha256:260000',
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha512:210000'
+)
+
+PASSWORD = 'bench-pass1'
+
+
+class HashingScenario:
+    '''
+    Wallets created by create requests,
+    then logged in by balance requests
+    '''
+    def __init__(self):
+        self.names = []
+        self.created = itertools.count()
+        self.logins = itertools.count()
+        self.lock = threading.Lock()
+
+    def request(self, route: str) -> tuple:
+        with self.lock:
+            if route == 'create':
+                name = f'h{next(self.created):07}'
+                self.names.append(name)
+                return 'POST', f'/v1/create?name={name}&pwd={PASSWORD}', {}
+            name = self.names[next(self.logins) % len(self.names)]
+        return 'GET', '/v1/balance', auth_headers(name, PASSWORD)
+
+
+def hash_seconds(method: str, repeat: int = 5) -> float:
+    '''
+    Median time of one hash
+    '''
+    hasher = PasswordHasher(method=method)
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        hasher.hash(PASSWORD)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def measure(method: str, requests: int, concurrency: int,
+            hash_workers: int, max_pending: int) -> dict:
+    '''
+    Latency of create and login with given method
+    (once per process, see InProcessDriver)
+    '''
+    with tempfile.TemporaryDirectory() as workdir:
+        driver = InProcessDriver(
+            'sqlite:///' + os.path.join(workdir, 'whalet.db'),
+            config=dict(
+                PASSWORD_HASH_METHOD=method,
+                HASH_WORKERS=hash_workers,
+                HASH_MAX_PENDING=max_pending,
+                AUTH_CACHE_ENABLED=False,
+                METRICS_ENABLED=False))
+        scenario = HashingScenario()
+        results = [
+            run_route(driver, scenario, route, requests, concurrency)
+            for route in ('create', 'balance')
+        ]
+    return dict(
+        method=method,
+        hash_ms=round(hash_seconds(method) * 1000, 2),
+        results=results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.hashing',
+        description='Compare password hashing costs by latency')
+    parser.add_argument('--methods', default=','.join(METHODS))
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--hash-workers', type=int, default=4)
+    parser.add_argument('--max-pending', type=int, default=16)
+    parser.add_argument('--output', help='JSON results file')
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    options = [
+        '--requests', str(args.requests),
+        '--concurrency', str(args.concurrency),
+        '--hash-workers', str(args.hash_workers),
+        '--max-pending', str(args.max_pending)
+    ]
+
+    if args.single:
+        json.dump(measure(
+            args.single, args.requests, args.concurrency,
+            args.hash_workers, args.max_pending), sys.stdout)
+        return
+
+    report = []
+    print(f'{"method":>22} {"hash, ms":>9} {"route":>8} {"req/s":>8} '
+          f'{"p50, ms":>8} {"p99, ms":>8}  statuses')
+    for method in args.methods.split(','):
+        # routes read config once per process
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.hashing',
+             '--single', method] + options,
+            cwd=REPO, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        report.append(result)
+        for item in result['results']:
+            print(f'{method:>22} {result["hash_ms"]:>9} '
+                  f'{item["route"]:>8} {item["throughput"]:>8} '
+                  f'{item["p50_ms"]:>8} {item["p99_ms"]:>8}  '
+                  f'{item["statuses"]}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(dict(
+                requests=args.requests,
+                concurrency=args.concurrency,
+                hash_workers=args.hash_workers,
+                max_pending=args.max_pending,
+                results=report), file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
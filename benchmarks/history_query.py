@@ -0,0 +1,155 @@
+'''
+History query benchmark: operations referencing wallets by name
+(36-char string ids, the schema before migration 3) against
+integer wallet ids and 16-byte time-ordered ids with names joined.
+
+Both databases are in-memory SQLite filled with the same history.
+
+    python -m benchmarks.history_query [operations ...]
+'''
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from whalet import models
+from whalet.database import Database
+from whalet.helpers import make_query
+
+
+WALLETS = 1000
+
+LEGACY_SCHEMA = [
+    'CREATE TABLE "Wallets" (id INTEGER PRIMARY KEY, '
+    'name VARCHAR(20) UNIQUE, balance BIGINT, password_hash VARCHAR(128))',
+    'CREATE TABLE "Operations" (id VARCHAR(36) PRIMARY KEY, '
+    'optype VARCHAR(20), time DATETIME, amount BIGINT, '
+    'sent_to VARCHAR(20), get_from VARCHAR(20))',
+    'CREATE INDEX "ix_Operations_sent_to_time" '
+    'ON "Operations" (sent_to, time)',
+    'CREATE INDEX "ix_Operations_get_from_time" '
+    'ON "Operations" (get_from, time)',
+]
+
+LEGACY_QUERY = (
+    'SELECT id, optype, time, amount, sent_to, get_from '
+    'FROM "Operations" WHERE sent_to = ? OR get_from = ? '
+    'ORDER BY time')
+
+
+def make_history(count: int, seed=42) -> list:
+    '''
+    Transfers between wallet numbers, a few wallets get
+    most of the traffic
+    '''
+    rnd = random.Random(seed)
+    start = datetime(2021, 1, 1)
+    weights = [1 / (n + 1) for n in range(WALLETS)]
+    rows = []
+    for i in range(count):
+        sent_to, get_from = rnd.choices(range(WALLETS), weights, k=2)
+        rows.append((
+            start + timedelta(seconds=i), rnd.randint(1, 10 ** 6),
+            sent_to, get_from))
+    return rows
+
+
+def wallet_name(number: int) -> str:
+    return f'wallet{number:05}'
+
+
+def legacy_database(history: list) -> Database:
+    dbase = Database('sqlite://')
+    with dbase.engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(text(
+            'INSERT INTO "Wallets" (name, balance) VALUES (:name, 0)'),
+            [dict(name=wallet_name(n)) for n in range(WALLETS)])
+        conn.execute(text(
+            'INSERT INTO "Operations" VALUES '
+            '(:id, "transaction", :time, :amount, :sent_to, :get_from)'),
+            [dict(id=str(uuid.uuid4()), time=op_time, amount=amount,
+                  sent_to=wallet_name(sent_to),
+                  get_from=wallet_name(get_from))
+             for op_time, amount, sent_to, get_from in history])
+    return dbase
+
+
+def normalized_database(history: list) -> Database:
+    dbase = Database('sqlite://')
+    models.Base.metadata.create_all(dbase.engine)
+    with dbase.engine.begin() as conn:
+        conn.execute(models.Wallet.__table__.insert(), [
+            dict(id=n + 1, name=wallet_name(n), balance=0)
+            for n in range(WALLETS)])
+        conn.execute(models.Operation.__table__.insert(), [
+            dict(id=models.new_operation_id(), optype='transaction',
+                 time=op_time, amount=amount,
+                 sent_to_id=sent_to + 1, get_from_id=get_from + 1)
+            for op_time, amount, sent_to, get_from in history])
+    return dbase
+
+
+def best_of(func, repeat=3) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def size_mb(connection) -> float:
+    cursor = connection.cursor()
+    pages = cursor.execute('PRAGMA page_count').fetchone()[0]
+    page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+    return pages * page_size / 2 ** 20
+
+
+def compiled(query, dialect) -> str:
+    return str(query.statement.compile(
+        dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+
+def main(sizes):
+    # the busiest wallet and one from the long tail
+    numbers = [0, WALLETS // 2]
+    for size in sizes:
+        history = make_history(size)
+        legacy = legacy_database(history).engine.raw_connection()
+        normalized = normalized_database(history)
+        dialect = normalized.engine.dialect
+        db = normalized.create_session()
+        raw = normalized.engine.raw_connection()
+        cursor = raw.cursor()
+        print(f'database size, MB: names {size_mb(legacy):.1f}, '
+              f'ids {size_mb(raw):.1f}')
+        print(f'{"operations":>10} {"wallet":>12} {"rows":>6} '
+              f'{"names, s":>9} {"ids, s":>9}')
+        for number in numbers:
+            name = wallet_name(number)
+            # query time only: plain DB-API cursors, no row processing
+            new_sql = compiled(
+                make_query(db, number + 1, models.Operation), dialect)
+
+            def old_query():
+                return legacy.cursor().execute(
+                    LEGACY_QUERY, (name, name)).fetchall()
+
+            def new_query():
+                return cursor.execute(new_sql).fetchall()
+
+            old_rows, new_rows = old_query(), new_query()
+            assert [r[3] for r in old_rows] == [r[3] for r in new_rows]
+            old, new = best_of(old_query), best_of(new_query)
+            print(f'{size:>10} {name:>12} {len(new_rows):>6} '
+                  f'{old:>9.4f} {new:>9.4f}')
+        db.close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100000, 500000])
@@ -0,0 +1,309 @@
+'''
+End-to-end load benchmark of the API routes.
+
+A database is seeded with benchmarks.seed, then every route is
+driven by concurrent clients, either in-process (Flask test
+client, no network and no WSGI server) or over HTTP against a
+local gunicorn running wsgi.py. Throughput and p50/p95/p99
+latencies are printed and saved as JSON, so runs could be
+compared.
+
+    python -m benchmarks.load [--driver inprocess|gunicorn]
+        [--wallets N] [--operations N] [--requests N]
+        [--concurrency N] [--routes balance,pay,...]
+        [--output results.json]
+'''
+import argparse
+import base64
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from benchmarks import seed as seeding
+
+
+ROUTES = ('create', 'balance', 'history', 'deposit', 'pay', 'wallets')
+
+# master token of wsgi.py in testing mode
+MASTER_TOKEN = 'whalesome'
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def auth_headers(name: str, password: str) -> dict:
+    '''
+    Basic authorization header of a wallet
+    '''
+    credentials = base64.b64encode(f'{name}:{password}'.encode()).decode()
+    return {'Authorization': f'Basic {credentials}'}
+
+
+class Scenario:
+    '''
+    Requests of every route for the seeded wallets,
+    users picked with the same skew as the data
+    '''
+    def __init__(self, wallets: int, random_seed=7):
+        self.rnd = random.Random(random_seed)
+        self.pick = seeding.skewed_picker(wallets, self.rnd)
+        self.created = itertools.count()
+        self.run_id = f'{self.rnd.getrandbits(16):04x}'
+        self.lock = threading.Lock()
+
+    def user(self) -> tuple:
+        with self.lock:
+            sender, recipient = self.pick(2)
+        return seeding.wallet_name(sender), seeding.wallet_name(recipient)
+
+    def request(self, route: str) -> tuple:
+        '''
+        (method, path, headers) of a request to given route
+        '''
+        name, other = self.user()
+        headers = auth_headers(name, seeding.PASSWORD)
+        if route == 'create':
+            new_name = f'c{self.run_id}{next(self.created):07}'
+            return 'POST', f'/v1/create?name={new_name}&pwd=secret1', {}
+        if route == 'balance':
+            return 'GET', '/v1/balance', headers
+        if route == 'history':
+            return 'GET', '/v1/history?limit=100', headers
+        if route == 'deposit':
+            return 'POST', (f'/v1/deposit?to={name}&sum=1.00'
+                            f'&token={MASTER_TOKEN}'), {}
+        if route == 'pay':
+            return 'POST', f'/v1/pay?to={other}&sum=0.01', headers
+        if route == 'wallets':
+            return 'GET', f'/v1/wallets?limit=100&token={MASTER_TOKEN}', {}
+        raise ValueError(route)
+
+
+class InProcessDriver:
+    '''
+    Requests made through Flask test clients, one per thread.
+    Routes read config once per process, so config given
+    here applies to the first driver of the process only.
+    '''
+    name = 'inprocess'
+
+    def __init__(self, url: str, config: dict = None):
+        from whalet import migrations, models
+        from whalet.check import Abort
+        from whalet.database import Database
+        from whalet.factory import create_app
+
+        self.app = create_app()
+        self.app.config['TESTING'] = True
+        dbase = Database(url=url)
+        migrations.upgrade(dbase.engine, models.Base.metadata)
+        self.app.config['DATABASE_SESSION'] = dbase.session
+        self.app.config['ABORT_HELPER'] = Abort(self.app, dbase.session)
+        self.app.config['MASTER_TOKEN'] = MASTER_TOKEN
+        self.app.config.update(config or {})
+        with self.app.app_context():
+            from whalet import routes
+            self.app.register_blueprint(routes.main)
+
+    def client(self):
+        test_client = self.app.test_client()
+
+        def send(method, path, headers) -> int:
+            return test_client.open(
+                path, method=method, headers=headers).status_code
+        return send
+
+    def stop(self):
+        pass
+
+
+class GunicornDriver:
+    '''
+    Requests made over keep-alive HTTP connections (one per
+    thread) to gunicorn serving wsgi:app. wsgi.py in testing
+    mode uses ./whalet.db, so gunicorn is started in the
+    directory of the seeded database.
+    '''
+    name = 'gunicorn'
+
+    def __init__(self, workdir: str, workers: int = 4):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'gunicorn',
+                '--chdir', workdir, '--pythonpath', REPO,
+                '--workers', str(workers), '--threads', '4',
+                '--bind', f'127.0.0.1:{self.port}',
+                '--log-level', 'warning', 'wsgi:app'
+            ],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait_ready()
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(('127.0.0.1', self.port)):
+                    return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError('gunicorn did not start')
+
+    def client(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+
+        def send(method, path, headers) -> int:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        return send
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def percentile(values: list, q: float) -> float:
+    '''
+    Nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return None
+    rank = max(1, round(q / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def run_route(driver, scenario: Scenario, route: str,
+              requests: int, concurrency: int) -> dict:
+    '''
+    Make requests to one route from concurrent clients
+    '''
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker():
+        send = driver.client()
+        mine, codes = [], {}
+        while next(counter) < requests:
+            method, path, headers = scenario.request(route)
+            started = time.perf_counter()
+            status = send(method, path, headers)
+            mine.append(time.perf_counter() - started)
+            codes[status] = codes.get(status, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for status, count in codes.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return dict(
+        route=route,
+        requests=len(latencies),
+        seconds=round(elapsed, 3),
+        throughput=round(len(latencies) / elapsed, 1),
+        p50_ms=round(percentile(latencies, 50) * 1000, 2),
+        p95_ms=round(percentile(latencies, 95) * 1000, 2),
+        p99_ms=round(percentile(latencies, 99) * 1000, 2),
+        statuses={str(code): count for code, count in sorted(
+            statuses.items())}
+    )
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.load',
+        description='Measure throughput and latency of API routes')
+    parser.add_argument(
+        '--driver', choices=('inprocess', 'gunicorn'), default='inprocess')
+    parser.add_argument('--wallets', type=int, default=1000)
+    parser.add_argument('--operations', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--gunicorn-workers', type=int, default=4)
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='JSON results file')
+    args = parser.parse_args(argv)
+    routes = args.routes.split(',')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        url = 'sqlite:///' + os.path.join(workdir, 'whalet.db')
+        started = time.perf_counter()
+        seeding.seed(url, args.wallets, args.operations, args.seed)
+        print(f'Seeded {args.wallets} wallets, {args.operations} '
+              f'operations in {time.perf_counter() - started:.1f}s')
+
+        if args.driver == 'gunicorn':
+            driver = GunicornDriver(workdir, args.gunicorn_workers)
+        else:
+            driver = InProcessDriver(url)
+
+        scenario = Scenario(args.wallets)
+        results = []
+        print(f'{"route":>8} {"req/s":>8} {"p50, ms":>8} '
+              f'{"p95, ms":>8} {"p99, ms":>8}  statuses')
+        try:
+            for route in routes:
+                # warm up caches (auth cache keeps password checks out)
+                run_route(driver, scenario, route,
+                          args.concurrency * 10, args.concurrency)
+                result = run_route(
+                    driver, scenario, route, args.requests,
+                    args.concurrency)
+                results.append(result)
+                print(f'{route:>8} {result["throughput"]:>8} '
+                      f'{result["p50_ms"]:>8} {result["p95_ms"]:>8} '
+                      f'{result["p99_ms"]:>8}  {result["statuses"]}')
+        finally:
+            driver.stop()
+
+    report = dict(
+        started=datetime.now().isoformat(),
+        revision=git_revision(),
+        python=platform.python_version(),
+        driver=args.driver,
+        wallets=args.wallets,
+        operations=args.operations,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        results=results
+    )
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+Seeded test data: N wallets and M operations with Zipf-like
+skew (a few wallets get most of the traffic, like real users).
+
+Rows are written with executemany INSERTs straight into the
+tables; balances and daily statistics are computed from the
+generated operations, so the ledger stays consistent and
+whalet.reconcile finds no drift.
+
+    python -m benchmarks.seed <database url> [wallets] [operations]
+'''
+import random
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+
+from whalet import migrations, models, passwords, stats
+from whalet.config import settings
+from whalet.database import Database
+
+
+# every seeded wallet has this password
+PASSWORD = 'bench-pass1'
+
+CHUNK = 50000
+
+
+def wallet_name(number: int) -> str:
+    return f'w{number:07}'
+
+
+def skewed_picker(count: int, rnd: random.Random, skew: float = 1.1):
+    '''
+    Function picking wallet numbers with Zipf-like weights
+    '''
+    weights = [1 / (n + 1) ** skew for n in range(count)]
+    cumulative, total = [], 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+
+    def pick(k=1) -> list:
+        return rnd.choices(range(count), cum_weights=cumulative, k=k)
+    return pick
+
+
+def generate_operations(wallets: int, operations: int, random_seed=42,
+                        skew: float = 1.1, days: int = 365):
+    '''
+    Yield operation rows (without wallet creations): a tenth
+    of deposits and transfers that never overdraw the sender
+    '''
+    rnd = random.Random(random_seed)
+    pick = skewed_picker(wallets, rnd, skew)
+    balances = [0] * wallets
+    start = datetime.now() - timedelta(days=days)
+    step = timedelta(days=days) / max(operations, 1)
+    for number in range(operations):
+        sent_to, get_from = pick(2)
+        time = start + step * number
+        amount = rnd.randint(1, 100000)
+        if number % 10 == 0 or balances[get_from] < amount:
+            balances[sent_to] += amount
+            yield dict(optype='deposit', time=time, amount=amount,
+                       sent_to_id=sent_to + 1, get_from_id=None)
+        else:
+            balances[get_from] -= amount
+            balances[sent_to] += amount
+            yield dict(optype='transaction', time=time, amount=amount,
+                       sent_to_id=sent_to + 1, get_from_id=get_from + 1)
+
+
+def seed(url: str, wallets: int, operations: int, random_seed=42,
+         skew: float = 1.1) -> Database:
+    '''
+    Create schema and fill it with generated data
+    '''
+    dbase = Database(url)
+    migrations.upgrade(dbase.engine, models.Base.metadata)
+    password_hash = passwords.PasswordHasher(
+        method=settings.PASSWORD_HASH_METHOD,
+        salt_length=settings.PASSWORD_SALT_LENGTH).hash(PASSWORD)
+    created = datetime.now() - timedelta(days=366)
+
+    balances = defaultdict(int)
+    session = dbase.create_session()
+    session.execute(models.Wallet.__table__.insert(), [
+        dict(id=n + 1, name=wallet_name(n), balance=0,
+             password_hash=password_hash)
+        for n in range(wallets)
+    ])
+    creations = [
+        dict(id=models.new_operation_id(), optype='creation',
+             time=created, amount=None, sent_to_id=n + 1, get_from_id=None)
+        for n in range(wallets)
+    ]
+    session.execute(models.Operation.__table__.insert(), creations)
+    stats.add(session, creations)
+
+    chunk = []
+    for row in generate_operations(
+            wallets, operations, random_seed, skew):
+        row['id'] = models.new_operation_id()
+        balances[row['sent_to_id']] += row['amount']
+        if row['get_from_id']:
+            balances[row['get_from_id']] -= row['amount']
+        chunk.append(row)
+        if len(chunk) >= CHUNK:
+            session.execute(models.Operation.__table__.insert(), chunk)
+            stats.add(session, chunk)
+            chunk = []
+    if chunk:
+        session.execute(models.Operation.__table__.insert(), chunk)
+        stats.add(session, chunk)
+
+    wallets_table = models.Wallet.__table__
+    session.execute(
+        wallets_table.update().where(
+            wallets_table.c.id == bindparam('wallet_id')
+        ).values(balance=bindparam('new_balance')),
+        [dict(wallet_id=w, new_balance=b) for w, b in balances.items()])
+    session.commit()
+    session.close()
+    return dbase
+
+
+if __name__ == '__main__':
+    url = sys.argv[1]
+    wallets = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    operations = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    seed(url, wallets, operations)
+    print(f'Seeded {wallets} wallets and {operations} operations')
@@ -0,0 +1,86 @@
+'''
+History serialization benchmark: marshmallow dump + change_sign()
++ json.dumps(default=...) against whalet.serializers.
+
+    python -m benchmarks.serialization [rows ...]
+'''
+import json
+import random
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from whalet.helpers import change_sign
+from whalet.schema import OperationSchema
+from whalet.serializers import dumps, operation_dicts, orjson
+
+
+WALLET = 'Tester'
+
+Row = namedtuple(
+    'Row', ['id', 'optype', 'time', 'amount', 'sent_to', 'get_from'])
+
+
+def make_rows(count: int, seed=42) -> list:
+    '''
+    Fake history of OPERATION_COLUMNS tuples: deposits,
+    incoming and outgoing transfers
+    '''
+    rnd = random.Random(seed)
+    start = datetime(2021, 1, 1)
+    rows = []
+    for i in range(count):
+        optype = rnd.choice(['deposit', 'transaction', 'transaction'])
+        outgoing = optype == 'transaction' and rnd.random() < 0.5
+        rows.append(Row(
+            rnd.getrandbits(128).to_bytes(16, 'big'),
+            optype,
+            start + timedelta(seconds=i),
+            rnd.randint(1, 10 ** 6),
+            'Someone' if outgoing else WALLET,
+            WALLET if outgoing else (
+                'Someone' if optype == 'transaction' else None)
+        ))
+    return rows
+
+
+def legacy(rows: list) -> str:
+    def decimal_json_default(obj):
+        if isinstance(obj, Decimal):
+            return str(obj)
+
+    result = OperationSchema(many=True).dump(rows)
+    result = change_sign(result, WALLET)
+    return json.dumps(
+        {f'{WALLET}:history': result}, default=decimal_json_default)
+
+
+def fast(rows: list) -> bytes:
+    result = list(operation_dicts(rows, WALLET))
+    return dumps({f'{WALLET}:history': result})
+
+
+def best_of(func, rows: list, repeat=3) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(rows)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main(sizes):
+    backend = 'orjson' if orjson is not None else 'json'
+    print(f'JSON backend: {backend}')
+    print(f'{"rows":>8} {"legacy, s":>10} {"fast, s":>10} {"speedup":>8}')
+    for size in sizes:
+        rows = make_rows(size)
+        assert json.loads(legacy(rows)) == json.loads(fast(rows))
+        old, new = best_of(legacy, rows), best_of(fast, rows)
+        print(f'{size:>8} {old:>10.3f} {new:>10.3f} {old / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,266 @@
+'''
+Concurrency stress test of money conservation.
+
+Client processes, each running several threads, make random
+/v1/pay and /v1/deposit calls (a few hot wallets get most of
+them, so writes contend for the same rows) against a local
+gunicorn with a file SQLite database, or against a running
+instance given by --server with its database given by
+--database (e.g. a local PostgreSQL seeded by benchmarks.seed
+with the same number of wallets).
+
+Afterwards the database is checked:
+
+* total of all balances equals total of all deposits,
+* deposits and transfers accepted by the service are all
+  recorded, and nothing else is,
+* no balance is negative,
+* every wallet history sums to its balance (whalet.reconcile).
+
+Achieved transactions per second and found anomalies are
+printed (and saved as JSON with --output). Exit status is 1
+if any anomaly is found.
+
+    python -m benchmarks.stress [--processes N] [--threads N]
+        [--seconds N] [--wallets N] [--operations N]
+        [--server URL --database URL] [--output FILE]
+'''
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+from sqlalchemy import text
+
+from benchmarks import seed as seeding
+from benchmarks.load import MASTER_TOKEN, GunicornDriver, auth_headers
+from whalet import reconcile
+from whalet.database import Database
+from whalet.money import to_cents, to_str
+
+
+# share of deposits among the calls, the rest are payments
+DEPOSIT_SHARE = 0.2
+# share of payments trying to spend (nearly) a whole balance
+DRAIN_SHARE = 0.1
+
+TOTALS = text(
+    'SELECT '
+    '(SELECT COALESCE(SUM(balance), 0) FROM "Wallets"), '
+    '(SELECT COALESCE(SUM(amount), 0) FROM "Operations" '
+    "WHERE optype = 'deposit') + "
+    '(SELECT COALESCE(SUM(amount), 0) FROM "OperationsArchive" '
+    "WHERE optype = 'deposit'), "
+    '(SELECT COUNT(*) FROM "Operations" '
+    "WHERE optype = 'deposit') + "
+    '(SELECT COUNT(*) FROM "OperationsArchive" '
+    "WHERE optype = 'deposit'), "
+    '(SELECT COUNT(*) FROM "Operations" '
+    "WHERE optype = 'transaction') + "
+    '(SELECT COUNT(*) FROM "OperationsArchive" '
+    "WHERE optype = 'transaction')")
+
+NEGATIVE_BALANCES = text(
+    'SELECT name, balance FROM "Wallets" WHERE balance < 0')
+
+
+def totals(engine) -> dict:
+    '''
+    Total balance, total and number of deposits
+    and number of transfers in the database
+    '''
+    with engine.connect() as conn:
+        balance, deposited, deposits, transfers = \
+            conn.execute(TOTALS).one()
+    return dict(balance=int(balance), deposited=int(deposited),
+                deposits=deposits, transfers=transfers)
+
+
+def client_process(server: str, wallets: int, threads: int,
+                   seconds: float, random_seed: int) -> dict:
+    '''
+    Make random calls from several threads for given
+    seconds, return what the service accepted
+    '''
+    host, port = urlsplit(server).hostname, urlsplit(server).port
+    deadline = time.monotonic() + seconds
+    results = dict(deposits=0, deposited=0, transfers=0, declined=0,
+                   errors={}, overdrafts=[])
+    lock = threading.Lock()
+
+    def worker(number):
+        rnd = random.Random(random_seed * 1000 + number)
+        pick = seeding.skewed_picker(wallets, rnd)
+        connection = http.client.HTTPConnection(host, port, timeout=60)
+        mine = dict(deposits=0, deposited=0, transfers=0, declined=0,
+                    errors={}, overdrafts=[])
+        while time.monotonic() < deadline:
+            sender, recipient = (seeding.wallet_name(n) for n in pick(2))
+            amount = rnd.randint(1, 5000)
+            if rnd.random() < DEPOSIT_SHARE:
+                path = (f'/v1/deposit?to={recipient}&sum={to_str(amount)}'
+                        f'&token={MASTER_TOKEN}')
+                headers = {}
+            else:
+                if rnd.random() < DRAIN_SHARE:
+                    amount = rnd.randint(1, 10 ** 8)
+                path = f'/v1/pay?to={recipient}&sum={to_str(amount)}'
+                headers = auth_headers(sender, seeding.PASSWORD)
+            try:
+                connection.request('POST', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as exc:
+                name = type(exc).__name__
+                mine['errors'][name] = mine['errors'].get(name, 0) + 1
+                connection.close()
+                continue
+
+            if response.status == 200 and path.startswith('/v1/deposit'):
+                mine['deposits'] += 1
+                mine['deposited'] += amount
+            elif response.status == 200:
+                mine['transfers'] += 1
+                balance = to_cents(json.loads(body)[f'{sender}:balance'])
+                if balance < 0:
+                    mine['overdrafts'].append(
+                        dict(wallet=sender, balance=to_str(balance)))
+            elif response.status == 409:
+                mine['declined'] += 1
+            else:
+                code = str(response.status)
+                mine['errors'][code] = mine['errors'].get(code, 0) + 1
+        connection.close()
+
+        with lock:
+            for key in ('deposits', 'deposited', 'transfers', 'declined'):
+                results[key] += mine[key]
+            for key, count in mine['errors'].items():
+                results['errors'][key] = \
+                    results['errors'].get(key, 0) + count
+            results['overdrafts'].extend(mine['overdrafts'])
+
+    running = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    for thread in running:
+        thread.start()
+    for thread in running:
+        thread.join()
+    return results
+
+
+def run(server: str, url: str, wallets: int, processes: int,
+        threads: int, seconds: float) -> dict:
+    '''
+    Stress the service and check the ledger, return report
+    '''
+    engine = Database(url).engine
+    before = totals(engine)
+
+    started = time.perf_counter()
+    accepted = dict(deposits=0, deposited=0, transfers=0, declined=0,
+                    errors={}, overdrafts=[])
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [
+            pool.submit(client_process, server, wallets, threads,
+                        seconds, number)
+            for number in range(processes)
+        ]
+        for future in futures:
+            result = future.result()
+            for key in ('deposits', 'deposited', 'transfers', 'declined'):
+                accepted[key] += result[key]
+            for key, count in result['errors'].items():
+                accepted['errors'][key] = \
+                    accepted['errors'].get(key, 0) + count
+            accepted['overdrafts'].extend(result['overdrafts'])
+    elapsed = time.perf_counter() - started
+
+    after = totals(engine)
+    anomalies = []
+    if after['balance'] != after['deposited']:
+        anomalies.append(dict(
+            kind='conservation', balances=to_str(after['balance']),
+            deposited=to_str(after['deposited'])))
+    for key in ('deposits', 'deposited', 'transfers'):
+        recorded = after[key] - before[key]
+        if recorded != accepted[key]:
+            anomalies.append(dict(
+                kind=f'lost {key}', accepted=accepted[key],
+                recorded=recorded))
+    with engine.connect() as conn:
+        for name, balance in conn.execute(NEGATIVE_BALANCES):
+            anomalies.append(dict(
+                kind='overdraft', wallet=name, balance=to_str(balance)))
+    for item in accepted['overdrafts']:
+        anomalies.append(dict(kind='overdraft response', **item))
+    for item in reconcile.reconcile(url, workers=1)['discrepancies']:
+        anomalies.append(dict(
+            kind='lost update', wallet=item['name'],
+            balance=item['balance'], history=item['expected']))
+
+    writes = accepted['deposits'] + accepted['transfers']
+    return dict(
+        processes=processes,
+        threads=threads,
+        seconds=round(elapsed, 3),
+        deposits=accepted['deposits'],
+        transfers=accepted['transfers'],
+        declined=accepted['declined'],
+        errors=accepted['errors'],
+        tps=round(writes / elapsed, 1),
+        anomalies=anomalies
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.stress',
+        description='Check money conservation under parallel writes')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--wallets', type=int, default=50)
+    parser.add_argument('--operations', type=int, default=10000)
+    parser.add_argument('--gunicorn-workers', type=int, default=4)
+    parser.add_argument(
+        '--server', help='URL of a running instance (local gunicorn '
+                         'with file SQLite if not set)')
+    parser.add_argument(
+        '--database', help='database URL of the running instance')
+    parser.add_argument('--output', help='JSON report file')
+    args = parser.parse_args(argv)
+    if bool(args.server) != bool(args.database):
+        parser.error('--server and --database go together')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        server, url, driver = args.server, args.database, None
+        if not server:
+            url = 'sqlite:///' + os.path.join(workdir, 'whalet.db')
+            seeding.seed(url, args.wallets, args.operations)
+            driver = GunicornDriver(workdir, args.gunicorn_workers)
+            server = f'http://127.0.0.1:{driver.port}'
+        try:
+            report = run(server, url, args.wallets, args.processes,
+                         args.threads, args.seconds)
+        finally:
+            if driver:
+                driver.stop()
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 1 if report['anomalies'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from pytest import fixture
+from sqlalchemy import func, text
+
+from whalet import archive, ledger, migrations, models, reconcile
+from whalet.database import Database
+
+
+@fixture
+def dbase():
+    '''
+    Database file with a year of operations
+    '''
+    db_fd, db_path = tempfile.mkstemp()
+    os.unlink(db_path)
+    dbase = Database(url='sqlite:///' + db_path)
+    migrations.upgrade(dbase.engine, models.Base.metadata)
+
+    session = dbase.create_session()
+    for name in ('Reachy', 'Alice', 'Bob'):
+        wallet = models.Wallet(name=name, balance=0)
+        session.add(wallet)
+        session.flush()
+        ledger.record_creation(session, wallet)
+    ledger.deposit(session, 'Reachy', 10000)
+    for day in range(10):
+        ledger.transfer(session, 'Reachy', 'Alice', 100 + day)
+        ledger.transfer(session, 'Alice', 'Bob', 10)
+    ledger.transfer(session, 'Bob', 'Bob', 5)
+    session.commit()
+
+    # spread operations over the past year, in order
+    ids = session.execute(text(
+        'SELECT id FROM "Operations" ORDER BY time, id')).scalars().all()
+    start = datetime.now() - timedelta(days=len(ids) * 10)
+    for number, op_id in enumerate(ids):
+        session.execute(text(
+            'UPDATE "Operations" SET time = :time WHERE id = :id'),
+            dict(time=start + timedelta(days=number * 10), id=op_id))
+    session.commit()
+    session.close()
+
+    yield dbase
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def count(session, model):
+    return session.query(func.count(model.id)).scalar()
+
+
+def test_archive_moves_old_operations(dbase):
+    session = dbase.create_session()
+    total = count(session, models.Operation)
+    cutoff = datetime.now() - timedelta(days=100)
+
+    moved = archive.archive(dbase.session_factory, cutoff, batch_size=4)
+    assert moved > 4
+    assert count(session, models.ArchivedOperation) == moved
+    assert count(session, models.Operation) == total - moved
+    assert session.query(func.min(models.Operation.time)).scalar() >= cutoff
+    assert session.query(
+        func.max(models.ArchivedOperation.time)).scalar() < cutoff
+
+    # checkpoints carry archived sums forward
+    checkpoints = {
+        c.wallet_id: c for c in session.query(models.Checkpoint)
+    }
+    assert sum(c.balance for c in checkpoints.values()) == 10000
+    assert sum(c.operations for c in checkpoints.values()) <= moved * 2
+    assert {c.archived_until for c in checkpoints.values()} == {cutoff}
+
+    # archived operations are still counted
+    assert reconcile.reconcile(dbase.url, workers=1)['discrepancies'] == []
+
+    # nothing left to archive
+    assert archive.archive(dbase.session_factory, cutoff) == 0
+    assert archive.archive(dbase.session_factory, datetime.now()) == \
+        total - moved
+    assert count(session, models.Operation) == 0
+    assert reconcile.reconcile(
+        dbase.url, workers=1)['discrepancies'] == []
+    session.close()
@@ -0,0 +1,123 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from pytest import fixture, raises
+from sqlalchemy import event
+
+from whalet import ledger, models
+from whalet.batcher import WriteBatcher
+from whalet.database import Database
+
+
+@fixture(scope='module')
+def dbase():
+    db_fd, db_path = tempfile.mkstemp()
+    dbase = Database(url='sqlite:///' + db_path)
+    models.Base.metadata.create_all(bind=dbase.engine)
+    session = dbase.create_session()
+    for name in ['Alex', 'Alice', 'Bob']:
+        session.add(models.Wallet(name=name, balance=0))
+    session.commit()
+    session.close()
+    yield dbase
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def balance(dbase, name):
+    session = dbase.create_session()
+    try:
+        return session.query(models.Wallet).filter_by(
+            name=name).one().balance
+    finally:
+        session.close()
+
+
+def test_concurrent_writes_are_batched(dbase):
+    batcher = WriteBatcher(dbase.session_factory, max_size=8, max_wait=0.05)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(
+            lambda _: batcher.run(ledger.deposit, 'Alex', 100),
+            range(32)))
+
+    assert balance(dbase, 'Alex') == 3200
+    assert sorted(results) == [i * 100 for i in range(1, 33)]
+
+    stats = batcher.stats()
+    assert stats['writes'] == 32
+    assert stats['batches'] < 32
+    assert stats['largest'] <= 8
+
+
+def test_failed_write_does_not_affect_batch(dbase):
+    batcher = WriteBatcher(dbase.session_factory, max_size=8, max_wait=0.05)
+
+    writes = [
+        (ledger.deposit, 'Alice', 500),
+        (ledger.transfer, 'Bob', 'Alice', 100),   # no money
+        (ledger.deposit, 'KingArthur', 100),      # no wallet
+        (ledger.transfer, 'Alice', 'Bob', 200)
+    ]
+    futures = [batcher.submit(func, *args) for func, *args in writes]
+
+    assert futures[0].result() == 500
+    with raises(ledger.InsufficientFunds):
+        futures[1].result()
+    with raises(ledger.WalletNotFound):
+        futures[2].result()
+    assert futures[3].result() == 300
+
+    assert balance(dbase, 'Alice') == 300
+    assert balance(dbase, 'Bob') == 200
+    assert batcher.stats()['replays'] == 0
+
+
+def test_rejected_write_is_rolled_back_alone(dbase):
+    batcher = WriteBatcher(dbase.session_factory, max_size=8, max_wait=0.05)
+    commits = []
+
+    def count_commit(connection):
+        commits.append(connection)
+
+    event.listen(dbase.engine, 'commit', count_commit)
+    alex, bob = balance(dbase, 'Alex'), balance(dbase, 'Bob')
+
+    writes = [
+        (ledger.deposit, 'Bob', 100),
+        # Alex is credited before Bob's debit fails
+        (ledger.transfer, 'Bob', 'Alex', 10 ** 6),
+        (ledger.deposit, 'Alex', 1)
+    ]
+    futures = [batcher.submit(func, *args) for func, *args in writes]
+    assert futures[0].result() == bob + 100
+    with raises(ledger.InsufficientFunds):
+        futures[1].result()
+    assert futures[2].result() == alex + 1
+    event.remove(dbase.engine, 'commit', count_commit)
+
+    assert balance(dbase, 'Alex') == alex + 1
+    assert balance(dbase, 'Bob') == bob + 100
+    stats = batcher.stats()
+    assert stats['replays'] == 0
+    assert len(commits) == stats['batches']
+
+
+def test_unexpected_error_replays_batch(dbase):
+    batcher = WriteBatcher(dbase.session_factory, max_size=8, max_wait=0.05)
+    bob = balance(dbase, 'Bob')
+
+    def broken(session):
+        raise RuntimeError('spam')
+
+    futures = [
+        batcher.submit(ledger.deposit, 'Bob', 10),
+        batcher.submit(broken),
+        batcher.submit(ledger.deposit, 'Bob', 10)
+    ]
+    assert futures[0].result() == bob + 10
+    with raises(RuntimeError):
+        futures[1].result()
+    assert futures[2].result() == bob + 20
+    assert batcher.stats()['replays'] == 1
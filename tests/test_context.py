@@ -0,0 +1,134 @@
+import logging
+
+from flask import Flask
+from sqlalchemy import text, update
+
+from whalet import context, models
+from whalet.database import Database
+
+
+def make_app():
+    app = Flask(__name__)
+
+    @app.route('/v1/things/<name>')
+    def things(name):
+        return ''
+    return app
+
+
+def test_statements_timed_and_reported(caplog):
+    engine = Database(url='sqlite://').engine
+    instrumentation = context.QueryInstrumentation(
+        engine, slow_ms=0, max_statements=2)
+    app = make_app()
+
+    with app.test_request_context('/v1/things/spam'):
+        with caplog.at_level(logging.WARNING, logger='whalet.context'):
+            with engine.connect() as conn:
+                for number in range(3):
+                    conn.execute(text('SELECT :n'), dict(n=number))
+            summary = instrumentation.finish_request()
+
+        assert summary['statements'] == 3
+        assert summary['seconds'] > 0
+        timing = context.server_timing()
+        assert timing.startswith('db;dur=')
+        assert timing.endswith(';desc="3 statements"')
+        context.reset()
+        assert context.server_timing() == ''
+
+    slow = [r.getMessage() for r in caplog.records
+            if r.getMessage().startswith('Slow SQL')]
+    assert len(slow) == 3
+    assert 'GET /v1/things/<name>: SELECT ?' in slow[0]
+    assert 'parameters: (0,)' in slow[0]
+    assert any(
+        r.getMessage().startswith(
+            'Possible N+1 in GET /v1/things/<name>: 3 statements, '
+            'repeated 3 times: SELECT ?')
+        for r in caplog.records)
+
+
+def test_slow_statement_credentials_redacted(caplog):
+    engine = Database(url='sqlite://').engine
+    models.Base.metadata.create_all(engine)
+    context.QueryInstrumentation(engine, slow_ms=0)
+    wallets = models.Wallet.__table__
+
+    with caplog.at_level(logging.WARNING, logger='whalet.context'):
+        with engine.begin() as conn:
+            conn.execute(wallets.insert(), [
+                dict(name='Alex', balance=0, password_hash='secret-1'),
+                dict(name='Alice', balance=0, password_hash='secret-2')])
+            conn.execute(
+                update(wallets).where(
+                    wallets.c.name == 'Alex',
+                    wallets.c.password_hash == 'secret-1'
+                ).values(password_hash='secret-3'))
+
+    logged = [r.getMessage() for r in caplog.records
+              if r.getMessage().startswith('Slow SQL')]
+    assert "parameters: [('Alex', 0, '<redacted>'), " in logged[-2]
+    assert "('<redacted>', 'Alex', '<redacted>')" in logged[-1]
+    assert not any('secret-' in message for message in logged)
+
+
+def test_fast_requests_not_reported(caplog):
+    engine = Database(url='sqlite://').engine
+    instrumentation = context.QueryInstrumentation(
+        engine, slow_ms=10000, max_statements=20)
+    app = make_app()
+
+    with app.test_request_context('/v1/things/spam'):
+        with caplog.at_level(logging.WARNING, logger='whalet.context'):
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            instrumentation.finish_request()
+        assert context.server_timing().endswith('"1 statements"')
+    assert not caplog.records
+
+
+def test_request_phases_timed(caplog):
+    engine = Database(url='sqlite://').engine
+    context.time_statements(engine)
+    timing = context.RequestTiming(sample_rate=1, log_requests=True)
+    app = make_app()
+
+    @context.timed('validation')
+    def check():
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+
+    with app.test_request_context('/v1/things/spam'):
+        timing.start_request()
+        with context.span('auth'):
+            # nested spans go to the outer one
+            check()
+        check()
+        with caplog.at_level(logging.INFO, logger='whalet.context'):
+            phases = timing.finish_request(status=200, seconds=0.5)
+        header = context.server_timing()
+        context.reset()
+
+    assert set(phases) == {'auth', 'validation', 'db'}
+    assert 0 < phases['db'] < phases['auth'] + phases['validation']
+    assert [entry.split(';')[0] for entry in header.split(', ')] == [
+        'auth', 'validation', 'db', 'total']
+    assert 'total;dur=500.00' in header
+    logged = [r.fields for r in caplog.records]
+    assert logged[0]['route'] == 'GET /v1/things/<name>'
+    assert logged[0]['total_ms'] == 500
+    assert set(logged[0]) == {
+        'route', 'status', 'total_ms', 'auth_ms', 'validation_ms', 'db_ms'}
+
+
+def test_unsampled_requests_not_timed():
+    timing = context.RequestTiming(sample_rate=0)
+    app = make_app()
+
+    with app.test_request_context('/v1/things/spam'):
+        timing.start_request()
+        with context.span('auth'):
+            pass
+        assert timing.finish_request(status=200, seconds=0.5) is None
+        assert context.server_timing() == ''
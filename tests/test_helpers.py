@@ -1,25 +1,43 @@
+import base64
+import json
+import uuid
+from collections import namedtuple
+from datetime import datetime
 from decimal import Decimal
 
-from whalet.helpers import change_sign, safe_round, represent
+from pytest import raises
 
+from whalet.helpers import change_sign
+from whalet.money import to_cents, to_str
+from whalet.pagination import (BACKWARD, BadCursor, decode_cursor,
+                               encode_cursor)
 
-def test_safe_round():
-    n = Decimal('1.19999999999999911199')
-    assert safe_round(n) == Decimal('1.19')
-    n = Decimal('128')
-    assert safe_round(n) == Decimal('128')
-    n = Decimal('0.01')
-    assert safe_round(n) == Decimal('0.01')
-    assert safe_round(Decimal('0')) == Decimal('0')
-    assert safe_round(Decimal('0.00000000000000')) == Decimal('0')
 
+def test_to_cents():
+    assert to_cents('1.19999999999999911199') == 119
+    assert to_cents('128') == 12800
+    assert to_cents('0.01') == 1
+    assert to_cents('0') == 0
+    assert to_cents('0.00000000000000') == 0
+    assert to_cents('-0.189') == -18
+    assert to_cents(Decimal('42.221001')) == 4222
+    assert to_cents(0.5) == 50
+    # no float rounding for large values
+    assert to_cents('92233720368547758.07') == 2 ** 63 - 1
 
-def test_represent():
-    assert represent(Decimal('2')) == '2.00'
-    assert represent(Decimal('156')) == '156.00'
-    assert represent(Decimal('0.01')) == '0.01'
-    assert represent(Decimal('12891.1')) == '12891.10'
-    assert represent(Decimal('0')) == '0.00'
+    for bad in ['SPAM', 'nan', 'inf']:
+        with raises(ValueError):
+            to_cents(bad)
+
+
+def test_to_str():
+    assert to_str(200) == '2.00'
+    assert to_str(15600) == '156.00'
+    assert to_str(1) == '0.01'
+    assert to_str(1289110) == '12891.10'
+    assert to_str(0) == '0.00'
+    assert to_str(-4209) == '-42.09'
+    assert to_str(None) is None
 
 
 def test_change_sign():
@@ -40,3 +58,71 @@ def test_change_sign():
     new_lst = change_sign(lst, 'Tester')
     assert new_lst[0]['amount'] == '-42.09'  # sign changed
     assert new_lst[1]['amount'] == '42.09'   # sign unchanged
+
+
+def test_cursor_roundtrip():
+    key = (datetime(2021, 9, 8, 10, 15, 45, 856743), 'some-id')
+    cursor = encode_cursor(key, BACKWARD)
+    assert decode_cursor(cursor) == (BACKWARD, key)
+
+    with raises(BadCursor):
+        decode_cursor('deadparrot')
+
+
+def test_malformed_cursor_keys():
+    from whalet import models
+
+    columns = [models.Operation.time, models.Operation.id]
+    good = (datetime(2021, 9, 8), b'\x01' * 16)
+    assert decode_cursor(encode_cursor(good), columns) == ('next', good)
+
+    def raw_cursor(content):
+        raw = json.dumps(content).encode()
+        return base64.urlsafe_b64encode(raw).decode()
+
+    for key in ([], [1], [None, None], ['x', 'y', 'z', 'w'],
+                [[1], [2]], [{'t': 'x'}, {'b': 'zz'}],
+                [{'t': '2021-09-08', 'b': '01'}, 1],
+                [{'b': '01'}, {'t': '2021-09-08'}], [True, 1]):
+        with raises(BadCursor):
+            decode_cursor(raw_cursor(['next', key]), columns)
+    with raises(BadCursor):
+        decode_cursor(raw_cursor({'next': 1, 'prev': 2}))
+
+
+def test_operation_dicts_match_schema():
+    from whalet import models
+    from whalet.schema import OperationSchema
+    from whalet.serializers import operation_dicts
+
+    Row = namedtuple(
+        'Row', ['id', 'optype', 'time', 'amount', 'sent_to', 'get_from'])
+    rows = [
+        Row(models.new_operation_id(), 'creation', datetime(2021, 9, 8),
+            None, 'Tester', None),
+        Row(models.new_operation_id(), 'deposit',
+            datetime(2021, 9, 8, 10, 15, 45, 856743), 4200, 'Tester', None),
+        Row(models.new_operation_id(), 'transaction', datetime(2021, 9, 9),
+            10, 'spam007', 'Tester'),
+        Row(models.new_operation_id(), 'transaction', datetime(2021, 9, 10),
+            1289110, 'Tester', 'KingArthur1957')
+    ]
+    expected = change_sign(
+        OperationSchema(many=True).dump(rows), 'Tester')
+    assert list(operation_dicts(rows, 'Tester')) == expected
+
+
+def test_operation_ids():
+    from whalet import models
+
+    first = models.new_operation_id()
+    text = models.format_operation_id(first)
+    assert len(first) == 16
+    assert str(uuid.UUID(bytes=first)) == text
+    assert uuid.UUID(text).version == 7
+    assert models.parse_operation_id(text) == first
+    assert models.parse_operation_id('deadparrot') is None
+
+    # time-ordered: later ids sort after earlier ones
+    ids = [models.new_operation_id() for _ in range(10000)]
+    assert ids == sorted(ids) and first < ids[0]
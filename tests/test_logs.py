@@ -0,0 +1,76 @@
+import io
+import json
+import logging
+import sys
+import threading
+
+from whalet.logs import AsyncHandler, JsonFormatter, RateLimitFilter
+
+
+def make_record(msg, *args, level=logging.INFO, name='whalet.test'):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+def test_rate_limit():
+    limiter = RateLimitFilter(burst=3, period=60)
+    passed = [limiter.filter(make_record('Paid %s', n)) for n in range(10)]
+    assert passed == [True] * 3 + [False] * 7
+    # other messages and warnings are not limited
+    assert limiter.filter(make_record('Got %s', 1))
+    assert limiter.filter(make_record('Paid %s', 1, level=logging.WARNING))
+
+    # dropped records are reported by the next passing one
+    limiter.period = 0
+    record = make_record('Paid %s', 11)
+    assert limiter.filter(record)
+    assert record.suppressed == 7
+
+
+def test_json_formatter():
+    formatter = JsonFormatter()
+    record = make_record('Paid %s to %s', '1.00', 'Alice')
+    record.fields = {'route': 'POST /v1/pay'}
+    entry = json.loads(formatter.format(record))
+    assert entry['message'] == 'Paid 1.00 to Alice'
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'whalet.test'
+    assert entry['route'] == 'POST /v1/pay'
+
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        record = logging.LogRecord(
+            'whalet.test', logging.ERROR, __file__, 1, 'Failed', (),
+            exc_info=sys.exc_info())
+    entry = json.loads(formatter.format(record))
+    assert 'ZeroDivisionError' in entry['exception']
+
+
+class SlowStream(io.StringIO):
+    '''
+    Stream blocking writes until released
+    '''
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+
+    def write(self, text):
+        self.released.wait()
+        return super().write(text)
+
+
+def test_async_handler_never_blocks():
+    stream = SlowStream()
+    handler = AsyncHandler(stream=stream, maxsize=2)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+
+    # writer is stuck on the first record, queue holds two more
+    for number in range(10):
+        handler.handle(make_record('Record %s', number))
+    assert handler.dropped >= 6
+
+    stream.released.set()
+    handler.close()
+    written = stream.getvalue().splitlines()
+    assert written[0] == 'Record 0'
+    assert len(written) == 10 - handler.dropped
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import tempfile
+
+from whalet import metrics
+from whalet.logs import AsyncHandler
+
+
+def make_registry():
+    registry = metrics.Registry()
+    requests = registry.counter(
+        'requests_total', 'Requests', ('route', 'status'))
+    latency = registry.histogram(
+        'latency_seconds', 'Latency', ('route',), buckets=(0.1, 1))
+    registry.gauge('pool', 'Pool', function=lambda: {(): 3})
+    return registry, requests, latency
+
+
+def test_render():
+    registry, requests, latency = make_registry()
+    requests.inc('/v1/pay', '200')
+    requests.inc('/v1/pay', '200')
+    requests.inc('/v1/pay', '409')
+    latency.observe(0.05, '/v1/pay')
+    latency.observe(0.5, '/v1/pay')
+    latency.observe(5, '/v1/pay')
+
+    text = metrics.render(registry.collect())
+    lines = text.splitlines()
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{route="/v1/pay",status="200"} 2' in lines
+    assert 'requests_total{route="/v1/pay",status="409"} 1' in lines
+    # buckets are cumulative
+    assert 'latency_seconds_bucket{route="/v1/pay",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/v1/pay",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="/v1/pay",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{route="/v1/pay"} 5.55' in lines
+    assert 'latency_seconds_count{route="/v1/pay"} 3' in lines
+    assert 'pool 3' in lines
+
+
+def test_label_values_escaped():
+    registry = metrics.Registry()
+    registry.counter('c', 'C', ('route',)).inc('say "hi"\n')
+    assert 'c{route="say \\"hi\\"\\n"} 1' in metrics.render(
+        registry.collect())
+
+
+def test_workers_summed_through_files():
+    directory = tempfile.mkdtemp()
+    registry, requests, latency = make_registry()
+    exporter = metrics.FileExporter(registry, directory)
+    requests.inc('/v1/pay', '200')
+    latency.observe(0.05, '/v1/pay')
+
+    # snapshot of an exited worker
+    other, other_requests, other_latency = make_registry()
+    other_requests.inc('/v1/pay', '200', amount=4)
+    other_latency.observe(0.5, '/v1/pay')
+    with open(os.path.join(directory, 'metrics-999999999.json'), 'w') as f:
+        json.dump(other.collect(), f)
+
+    lines = metrics.render(exporter.collect()).splitlines()
+    assert 'requests_total{route="/v1/pay",status="200"} 5' in lines
+    assert 'latency_seconds_count{route="/v1/pay"} 2' in lines
+    assert 'latency_seconds_bucket{route="/v1/pay",le="0.1"} 1' in lines
+    # gauges of exited workers are dropped
+    assert 'pool 3' in lines
+    assert os.path.exists(exporter.path(os.getpid()))
+
+
+def test_dropped_log_records_exported():
+    logger = logging.getLogger('whalet.test.dropped')
+    handler = AsyncHandler(maxsize=1)
+    logger.addHandler(handler)
+    app_metrics = metrics.AppMetrics()
+    app_metrics.watch_logs(logger)
+    try:
+        handler.dropped = 3
+        lines = app_metrics.render().splitlines()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    assert 'whalet_log_records_dropped_total 3' in lines
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import uuid
+
+from pytest import fixture
+from sqlalchemy import inspect, text
+
+from whalet import migrations, models
+from whalet.database import Database
+
+
+LEGACY_UUID = '6f1c1c4e-1b8f-4c53-9a55-8b4f1d2c3e4a'
+
+
+@fixture
+def legacy_dbase():
+    '''
+    Database made by create_all() before any migrations existed
+    '''
+    db_fd, db_path = tempfile.mkstemp()
+    dbase = Database(url='sqlite:///' + db_path)
+    with dbase.engine.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE "Wallets" (id INTEGER PRIMARY KEY, '
+            'name VARCHAR(20), balance NUMERIC(10, 2), '
+            'password_hash VARCHAR(128))'))
+        conn.execute(text(
+            'CREATE TABLE "Operations" (id VARCHAR(36) PRIMARY KEY, '
+            'optype VARCHAR(20), time DATETIME, amount NUMERIC(10, 2), '
+            'sent_to VARCHAR(20), get_from VARCHAR(20))'))
+        conn.execute(text(
+            'INSERT INTO "Wallets" (name, balance) VALUES '
+            '("Reachy", 15133.21), ("Alice", 0)'))
+        conn.execute(text(
+            'INSERT INTO "Operations" (id, optype, amount, sent_to) '
+            'VALUES ("1", "creation", NULL, "Reachy"), '
+            '("2", "deposit", 15133.21, "Reachy")'))
+        conn.execute(text(
+            'INSERT INTO "Operations" '
+            '(id, optype, time, amount, sent_to, get_from) VALUES '
+            '(:id, "transaction", "2021-09-08 10:15:45.856743", 0.01, '
+            '"Alice", "Reachy")'),
+            dict(id=LEGACY_UUID))
+    yield dbase
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@fixture
+def fresh_dbase():
+    db_fd, db_path = tempfile.mkstemp()
+    os.unlink(db_path)
+    yield Database(url='sqlite:///' + db_path)
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def index_names(engine, table):
+    return {ix['name'] for ix in inspect(engine).get_indexes(table)}
+
+
+def test_upgrade_legacy_database(legacy_dbase):
+    engine = legacy_dbase.engine
+    assert not index_names(engine, 'Wallets')
+
+    version = migrations.upgrade(engine, models.Base.metadata)
+    assert version == migrations.head()
+    assert {
+        'ix_Wallets_name', 'ix_Wallets_balance_id'
+    } <= index_names(engine, 'Wallets')
+    assert {
+        'ix_Operations_sent_to_id_time', 'ix_Operations_get_from_id_time'
+    } <= index_names(engine, 'Operations')
+
+    # money converted to cents, names replaced with wallet ids
+    with engine.connect() as conn:
+        assert conn.execute(text(
+            'SELECT name, balance FROM "Wallets" ORDER BY name'
+        )).all() == [('Alice', 0), ('Reachy', 1513321)]
+        assert sorted(conn.execute(text(
+            'SELECT optype, amount, sent_to_id, get_from_id '
+            'FROM "Operations"'
+        )).all(), key=repr) == [
+            ('creation', None, 1, None),
+            ('deposit', 1513321, 1, None),
+            ('transaction', 1, 2, 1)
+        ]
+        # ids given out by API are kept
+        assert conn.execute(text(
+            'SELECT optype FROM "Operations" WHERE id = :id'),
+            dict(id=uuid.UUID(LEGACY_UUID).bytes)
+        ).scalar() == 'transaction'
+
+        # daily statistics built from operations with time
+        assert conn.execute(text(
+            'SELECT wallet_id, day, deposited, received, sent, operations '
+            'FROM "DailyStats" ORDER BY wallet_id'
+        )).all() == [
+            (1, '2021-09-08', 0, 0, 1, 1),
+            (2, '2021-09-08', 0, 1, 0, 1)
+        ]
+
+    # running again is a no-op
+    assert migrations.upgrade(
+        engine, models.Base.metadata) == migrations.head()
+
+
+def test_fresh_database_is_stamped(fresh_dbase):
+    engine = fresh_dbase.engine
+    version = migrations.upgrade(engine, models.Base.metadata)
+    assert version == migrations.head()
+    with engine.connect() as conn:
+        assert migrations.current_version(conn) == migrations.head()
+    assert 'ix_Wallets_name' in index_names(engine, 'Wallets')
@@ -1,17 +1,20 @@
+import base64
 import json
 import os
 import tempfile
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from decimal import Decimal
 import html
 
 from pytest import fixture
 from pytest import mark
 
-from whalet import models
+from whalet import ledger, models
 from whalet.check import Abort
 from whalet.database import Database
 from whalet.factory import create_app
+from whalet.money import to_cents
 from tests.instruments import get_headers, RequestData
 
 
@@ -34,6 +37,9 @@ def app():
     app.testing = True
     app.config['SQLALCHEMY_DATABASE_URI'] = TEST_URI
     app.config['MASTER_TOKEN'] = MASTER_TOKEN
+    app.config['DEBUG_QUERY_COUNT'] = True
+    app.config['SQL_INSTRUMENTATION'] = True
+    app.config['REQUEST_TIMING_SAMPLE_RATE'] = 1.0
     yield app
 
     # cleaning up
@@ -60,7 +66,7 @@ def tst_engine(dbase):
 
 @fixture(scope='module')
 def db(dbase):
-    db = dbase.create_session()
+    db = dbase.session
     yield db
 
 
@@ -88,7 +94,7 @@ def create_wallets(app, db):
     '''
     with app.app_context():
 
-        from whalet.routes import operation_schema, wallet_schema
+        from whalet.routes import hasher, wallet_schema
 
         # create wallets with common password
         usernames = ['Alex', 'Alice', 'Bob', 'Ann']
@@ -100,19 +106,12 @@ def create_wallets(app, db):
                 dict(
                     name=name,
                     balance=Decimal('0'),
-                    password_hash=models.Wallet.hash_password(
-                        password=common_password)
+                    password_hash=hasher.hash(common_password)
                 )
             )
-            operation = operation_schema.load(
-                dict(
-                    optype='creation',
-                    time=datetime.now().isoformat(),
-                    sent_to=name
-                    )
-                )
             db.add(wallet)
-            db.add(operation)
+            db.flush()
+            ledger.record_creation(db, wallet)
         db.commit()
         return True
 
@@ -567,3 +566,790 @@ def test_mass_transaction(client, credentials):
     assert rv.status_code == 200
     alice_balance = json.loads(rv.data)[f'{name}:balance']
     assert alice_balance == '1.26'
+
+
+def test_auth_cache_hits(client, credentials):
+
+    c = credentials
+    from whalet.routes import credential_cache
+
+    rv = client.get('/v1/balance', headers=c.headers)
+    assert rv.status_code == 200
+    hits = credential_cache.hits
+
+    # credentials verified already, no key derivation needed
+    rv = client.get('/v1/balance', headers=c.headers)
+    assert rv.status_code == 200
+    assert credential_cache.hits == hits + 1
+
+    # wrong password should never hit the cache
+    headers = get_headers(c.from_wallet, 'thisparrotisnomore')
+    rv = client.get('/v1/balance', headers=headers)
+    assert rv.status_code == 401
+    assert credential_cache.hits == hits + 1
+
+
+def test_auth_cache_invalidated_on_password_change(client):
+
+    name = 'Parrot'
+    old_password = 'pining4fjords'
+    new_password = 'exparrot1'
+    rv = client.post(f'/v1/create?name={name}&pwd={old_password}')
+    assert rv.status_code == 201
+
+    old_headers = get_headers(name, old_password)
+    rv = client.get('/v1/balance', headers=old_headers)
+    assert rv.status_code == 200
+
+    rv = client.put(
+        f'/v1/change_pass?pwd={new_password}', headers=old_headers)
+    assert rv.status_code == 200
+
+    # old password should be rejected right away
+    rv = client.get('/v1/balance', headers=old_headers)
+    assert rv.status_code == 401
+
+    rv = client.get('/v1/balance', headers=get_headers(name, new_password))
+    assert rv.status_code == 200
+
+
+def test_sessions_are_request_scoped(client, dbase):
+    import threading
+
+    sessions = []
+    thread = threading.Thread(
+        target=lambda: sessions.append(dbase.session()))
+    thread.start()
+    thread.join()
+
+    # every thread gets its own session
+    assert sessions[0] is not dbase.session()
+
+    # and the session is released on request teardown
+    session = dbase.session()
+    rv = client.get('/')
+    assert rv.status_code == 200
+    assert dbase.session() is not session
+
+
+def test_history_pagination(client):
+
+    name = 'Pager'
+    headers = get_headers(name, common_password)
+    rv = client.post(f'/v1/create?name={name}&pwd={common_password}')
+    assert rv.status_code == 201
+    for i in range(1, 8):
+        rv = client.put(
+            f'/v1/deposit?to={name}&sum={i}&token={MASTER_TOKEN}')
+        assert rv.status_code == 200
+
+    # creation + 7 deposits
+    rv = client.get('/v1/history', headers=headers)
+    full = json.loads(rv.data)[f'{name}:history']
+    assert len(full) == 8
+
+    # going forward page by page
+    pages, cursor = [], ''
+    while True:
+        rv = client.get(
+            f'/v1/history?limit=3&cursor={cursor}', headers=headers)
+        assert rv.status_code == 200
+        data = json.loads(rv.data)
+        pages.append(data)
+        cursor = data['next']
+        if not cursor:
+            break
+
+    assert [len(p[f'{name}:history']) for p in pages] == [3, 3, 2]
+    assert pages[0]['prev'] is None
+    assert sum((p[f'{name}:history'] for p in pages), []) == full
+
+    # and one page back
+    rv = client.get(
+        f'/v1/history?limit=3&cursor={pages[2]["prev"]}', headers=headers)
+    data = json.loads(rv.data)
+    assert data[f'{name}:history'] == pages[1][f'{name}:history']
+    assert data['next'] and data['prev']
+
+
+def test_history_pagination_bad_args(client, credentials):
+
+    c = credentials
+    for limit in ['0', '-1', 'SPAM', '100000', '\u00b2', '\u0663']:
+        rv = client.get(f'/v1/history?limit={limit}', headers=c.headers)
+        assert rv.status_code == 400
+        assert 'bad limit' in str(rv.data).lower()
+
+    rv = client.get('/v1/history?cursor=deadparrot', headers=c.headers)
+    assert rv.status_code == 400
+    assert 'bad cursor' in str(rv.data).lower()
+
+    for key in ([], [1], [None, None], ['x', 'y', 'z', 'w'], [[1], [2]]):
+        cursor = base64.urlsafe_b64encode(
+            json.dumps(['next', key]).encode()).decode()
+        rv = client.get(f'/v1/history?cursor={cursor}', headers=c.headers)
+        assert rv.status_code == 400
+        assert 'bad cursor' in str(rv.data).lower()
+
+
+def test_history_page_alias(client, credentials):
+
+    c = credentials
+    rv = client.get('/v1/history', headers=c.headers)
+    history = json.loads(rv.data)
+    rv = client.get('/v1/history/page/2', headers=c.headers)
+    assert rv.status_code == 200
+    assert rv.headers['Deprecation'] == 'true'
+    assert json.loads(rv.data) == history
+
+
+def test_stream_history(client):
+
+    name = 'Pager'
+    headers = get_headers(name, common_password)
+    rv = client.get('/v1/history', headers=headers)
+    full = json.loads(rv.data)[f'{name}:history']
+
+    rv = client.get('/v1/history/stream', headers=headers)
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/x-ndjson'
+    lines = rv.data.decode().splitlines()
+    assert [json.loads(line) for line in lines] == full
+
+    rv = client.get('/v1/history/stream?format=json', headers=headers)
+    assert json.loads(rv.data) == {f'{name}:history': full}
+
+    rv = client.get('/v1/history/stream?format=csv', headers=headers)
+    assert rv.mimetype == 'text/csv'
+    assert len(rv.data.decode().splitlines()) == len(full) + 1
+
+    rv = client.get('/v1/history/stream?format=xml', headers=headers)
+    assert rv.status_code == 400
+
+
+def test_export_wallet(client, credentials):
+
+    c = credentials
+    rv = client.get('/v1/history', headers=c.headers)
+    full = json.loads(rv.data)[f'{c.from_wallet}:history']
+
+    rv = client.get('/v1/export?format=json', headers=c.headers)
+    assert rv.status_code == 200
+    assert 'attachment' in rv.headers['Content-Disposition']
+    data = json.loads(rv.data)
+    assert data['wallet'] == c.from_wallet
+    assert data['balance'] == '15132.96'
+    assert data['history'] == full
+
+    rv = client.get('/v1/export', headers=c.headers)
+    lines = rv.data.decode().splitlines()
+    assert json.loads(lines[0])['wallet'] == c.from_wallet
+    assert len(lines) == len(full) + 1
+
+
+def test_concurrent_transactions_do_not_overdraw(app, client):
+    from concurrent.futures import ThreadPoolExecutor
+
+    name = 'Spender'
+    headers = get_headers(name, common_password)
+    rv = client.post(f'/v1/create?name={name}&pwd={common_password}')
+    assert rv.status_code == 201
+    rv = client.put(f'/v1/deposit?to={name}&sum=1&token={MASTER_TOKEN}')
+    assert rv.status_code == 200
+
+    def pay(_):
+        with app.test_client() as thread_client:
+            rv = thread_client.put(
+                '/v1/pay?to=Bob&sum=0.30', headers=headers)
+            return rv.status_code
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        codes = list(executor.map(pay, range(10)))
+
+    # only three payments fit into 1.00
+    assert codes.count(200) == 3
+    assert codes.count(409) == 7
+
+    rv = client.get('/v1/balance', headers=headers)
+    assert json.loads(rv.data)[f'{name}:balance'] == '0.10'
+
+
+def test_deposit_to_fake_wallet(client):
+    rv = client.put(
+        f'/v1/deposit?to=KingArthur&sum=1&token={MASTER_TOKEN}')
+    assert rv.status_code == 404
+
+
+def test_batch_transaction_atomic(client):
+
+    name = 'Payroll'
+    headers = get_headers(name, common_password)
+    rv = client.post(f'/v1/create?name={name}&pwd={common_password}')
+    assert rv.status_code == 201
+    rv = client.put(f'/v1/deposit?to={name}&sum=10&token={MASTER_TOKEN}')
+    assert rv.status_code == 200
+
+    # one bad recipient: nothing applied
+    items = [{'to': 'Alex', 'sum': '1.50'}, {'to': 'KingArthur', 'sum': 1}]
+    rv = client.post('/v1/pay/batch', json=items, headers=headers)
+    assert rv.status_code == 400
+    data = json.loads(rv.data)
+    assert data['applied'] == 0
+    assert data['results'][0]['status'] == 'ok'
+    assert data['results'][1]['code'] == 404
+
+    # more than balance: nothing applied
+    items = [{'to': 'Alex', 'sum': '6'}, {'to': 'Ann', 'sum': '6'}]
+    rv = client.post('/v1/pay/batch', json=items, headers=headers)
+    assert rv.status_code == 409
+    data = json.loads(rv.data)
+    assert data['applied'] == 0
+    assert [r['status'] for r in data['results']] == ['rejected'] * 2
+    assert data['results'][0]['code'] == 409
+    assert 'not enough money' in data['results'][0]['error'].lower()
+
+    items = [
+        {'to': 'Alex', 'sum': '1.509'},
+        {'to': 'Ann', 'sum': 2},
+        {'to': 'Alex', 'sum': '0.5'}
+    ]
+    rv = client.post('/v1/pay/batch', json=items, headers=headers)
+    assert rv.status_code == 200
+    data = json.loads(rv.data)
+    assert data['applied'] == 3
+    assert data[f'{name}:balance'] == '6.00'
+
+    rv = client.get('/v1/balance', headers=get_headers('Ann', common_password))
+    assert json.loads(rv.data)['Ann:balance'] == '2.00'
+
+    rv = client.get('/v1/history', headers=headers)
+    history = json.loads(rv.data)[f'{name}:history']
+    assert [op['amount'] for op in history[-3:]] == ['-1.50', '-2.00', '-0.50']
+
+
+def test_batch_transaction_best_effort(client):
+
+    name = 'Payroll'
+    headers = get_headers(name, common_password)
+    body = {
+        'mode': 'best_effort',
+        'items': [
+            {'to': 'Ann', 'sum': '5'},
+            {'to': 'Ann', 'sum': 'SPAM'},
+            {'to': 'Alex', 'sum': '5'},
+            {'to': 'KingArthur', 'sum': '0.5'},
+            {'to': 'Alex', 'sum': '0.99'},
+            {'sum': '0.99'}
+        ]
+    }
+    rv = client.post('/v1/pay/batch', json=body, headers=headers)
+    assert rv.status_code == 200
+    data = json.loads(rv.data)
+    assert data['applied'] == 2
+    assert [r['status'] == 'ok' for r in data['results']] == \
+        [True, False, False, False, True, False]
+    assert data['results'][2]['code'] == 409
+    assert data[f'{name}:balance'] == '0.01'
+
+    rv = client.post('/v1/pay/batch', json={'items': []}, headers=headers)
+    assert rv.status_code == 400
+
+
+def test_batch_transaction_best_effort_batched(client, dbase, monkeypatch):
+    from whalet import routes
+    from whalet.batcher import WriteBatcher
+
+    batcher = WriteBatcher(dbase.session_factory)
+    monkeypatch.setattr(routes, 'write_batcher', batcher)
+
+    # balance is read (and locked) by the writer, not the request
+    readers = []
+    balance_for_update = ledger.balance_for_update
+
+    def reading_balance(session, wallet_name):
+        readers.append(threading.current_thread().name)
+        return balance_for_update(session, wallet_name)
+    monkeypatch.setattr(ledger, 'balance_for_update', reading_balance)
+
+    name = 'Batched'
+    headers = get_headers(name, common_password)
+    rv = client.post(f'/v1/create?name={name}&pwd={common_password}')
+    assert rv.status_code == 201
+    rv = client.put(f'/v1/deposit?to={name}&sum=5&token={MASTER_TOKEN}')
+    assert rv.status_code == 200
+
+    body = {
+        'mode': 'best_effort',
+        'items': [
+            {'to': 'Ann', 'sum': '3'},
+            {'to': 'Alex', 'sum': '3'},
+            {'to': 'Bob', 'sum': '2'}
+        ]
+    }
+    rv = client.post('/v1/pay/batch', json=body, headers=headers)
+    assert rv.status_code == 200
+    data = json.loads(rv.data)
+    assert data['applied'] == 2
+    assert [r['status'] for r in data['results']] == \
+        ['ok', 'rejected', 'ok']
+    assert data[f'{name}:balance'] == '0.00'
+    assert readers == ['whalet-write-batcher']
+    assert batcher.stats()['writes'] == 2
+
+
+def test_bulk_deposit(client):
+
+    items = [
+        {'to': 'Alice', 'sum': '1.009'},
+        {'to': 'KingArthur', 'sum': '1'},
+        {'to': 'Bob', 'sum': '-1'},
+        {'to': 'Bob', 'sum': '2'},
+        {'to': 'Alice', 'sum': 0.5}
+    ]
+    rv = client.post('/v1/deposit/bulk', json=items)
+    assert rv.status_code == 401
+
+    alice_headers = get_headers('Alice', common_password)
+    rv = client.get('/v1/balance', headers=alice_headers)
+    alice_balance = Decimal(json.loads(rv.data)['Alice:balance'])
+
+    rv = client.post(
+        f'/v1/deposit/bulk?token={MASTER_TOKEN}', json=items)
+    assert rv.status_code == 200
+    data = json.loads(rv.data)
+    assert data['accepted'] == 3
+    assert data['total'] == '3.50'
+    assert [(r['index'], r['code']) for r in data['rejected']] == \
+        [(1, 404), (2, 400)]
+
+    rv = client.get('/v1/balance', headers=alice_headers)
+    assert json.loads(rv.data)['Alice:balance'] == \
+        str(alice_balance + Decimal('1.50'))
+
+    # the same as NDJSON, with one broken line
+    lines = [json.dumps(item) for item in items[:2]] + ['{"to": SPAM']
+    rv = client.post(
+        f'/v1/deposit/bulk?token={MASTER_TOKEN}',
+        data='\n'.join(lines),
+        content_type='application/x-ndjson')
+    assert rv.status_code == 200
+    data = json.loads(rv.data)
+    assert data['accepted'] == 1
+    assert [r['index'] for r in data['rejected']] == [1, 2]
+
+
+def test_async_payment(app, client, dbase):
+    from whalet.payqueue import PaymentProcessor
+
+    name = 'Merchant'
+    headers = get_headers(name, common_password)
+    rv = client.post(f'/v1/create?name={name}&pwd={common_password}')
+    assert rv.status_code == 201
+    rv = client.put(f'/v1/deposit?to={name}&sum=5&token={MASTER_TOKEN}')
+    assert rv.status_code == 200
+
+    rv = client.put('/v1/pay?to=Alice&sum=2&async=1', headers=headers)
+    assert rv.status_code == 202
+    first = json.loads(rv.data)['operation']
+    assert rv.headers['Location'].endswith(f'/v1/operations/{first}')
+
+    rv = client.put(
+        '/v1/pay?to=Alice&sum=4',
+        headers={**headers, 'Prefer': 'respond-async'})
+    assert rv.status_code == 202
+    second = json.loads(rv.data)['operation']
+
+    # checks are made before queueing
+    rv = client.put('/v1/pay?to=Alice&sum=-4&async=1', headers=headers)
+    assert rv.status_code == 400
+
+    rv = client.get(f'/v1/operations/{first}', headers=headers)
+    assert json.loads(rv.data)[f'{name}:operation']['status'] == 'queued'
+
+    processor = PaymentProcessor(dbase.session_factory, workers=2)
+    assert processor.process_once() == 2
+    assert processor.process_once() == 0
+
+    rv = client.get(f'/v1/operations/{first}', headers=headers)
+    assert json.loads(rv.data)[f'{name}:operation']['status'] == 'done'
+    rv = client.get(f'/v1/operations/{second}', headers=headers)
+    operation = json.loads(rv.data)[f'{name}:operation']
+    assert operation['status'] == 'failed'
+    assert 'Not enough money' in operation['error']
+
+    rv = client.get('/v1/balance', headers=headers)
+    assert json.loads(rv.data)[f'{name}:balance'] == '3.00'
+
+    # applied payment is an operation with the same id
+    alice_headers = get_headers('Alice', common_password)
+    rv = client.get(f'/v1/operations/{first}', headers=alice_headers)
+    operation = json.loads(rv.data)['Alice:operation']
+    assert operation['status'] == 'done'
+    assert operation['amount'] == '2.00'
+
+    rv = client.get(f'/v1/operations/{second}', headers=alice_headers)
+    assert rv.status_code == 404
+
+    # queue is full
+    app.config['PAYMENT_QUEUE_MAX_DEPTH'] = 0
+    rv = client.put('/v1/pay?to=Alice&sum=1&async=1', headers=headers)
+    app.config['PAYMENT_QUEUE_MAX_DEPTH'] = 10000
+    assert rv.status_code == 503
+
+
+def test_payment_claims_are_exclusive(client, dbase):
+    from whalet.payqueue import PaymentProcessor
+
+    for name in ('Shopper', 'Haggler'):
+        rv = client.post(f'/v1/create?name={name}&pwd={common_password}')
+        assert rv.status_code == 201
+        rv = client.put(f'/v1/deposit?to={name}&sum=5&token={MASTER_TOKEN}')
+        assert rv.status_code == 200
+    headers = get_headers('Shopper', common_password)
+    for _ in range(3):
+        rv = client.put('/v1/pay?to=Alice&sum=1&async=1', headers=headers)
+        assert rv.status_code == 202
+    rv = client.put(
+        '/v1/pay?to=Alice&sum=1&async=1',
+        headers=get_headers('Haggler', common_password))
+    assert rv.status_code == 202
+
+    # the last payment of Shopper waits for the first claim
+    first = PaymentProcessor(dbase.session_factory, batch_size=2)
+    second = PaymentProcessor(dbase.session_factory, batch_size=2)
+    claimed, rest = first.claim(), second.claim()
+    assert [p.get_from for p in claimed] == ['Shopper', 'Shopper']
+    assert [p.get_from for p in rest] == ['Haggler']
+    assert second.claim() == []
+
+    # fresh claims are kept, stale ones are given back
+    assert second.requeue_stale() == 0
+    session = dbase.create_session()
+    session.query(models.QueuedPayment).filter(
+        models.QueuedPayment.claimed_by == claimed[0].claimed_by
+    ).update({'claimed_at': datetime.now() - timedelta(hours=1)})
+    session.commit()
+    session.close()
+    successor = PaymentProcessor(dbase.session_factory)
+    assert successor.requeue_stale() == 2
+    assert successor.process_once() == 3
+    assert successor.applied == 3
+
+    # the first processor lost its claim, nothing is applied twice
+    first.apply_group(claimed)
+    assert first.applied == 0 and first.failed == 0
+    second.apply_group(rest)
+    assert second.applied == 1
+
+    rv = client.get('/v1/balance', headers=headers)
+    assert json.loads(rv.data)['Shopper:balance'] == '2.00'
+
+
+def test_payment_claims_keep_sender_order(client, dbase):
+    from whalet.payqueue import PaymentProcessor
+
+    headers = get_headers('Haggler', common_password)
+    for amount in (1, 2, 3):
+        rv = client.put(
+            f'/v1/pay?to=Alice&sum={amount}&async=1', headers=headers)
+        assert rv.status_code == 202
+
+    # one sender split across batches of two processors
+    first = PaymentProcessor(dbase.session_factory, batch_size=2)
+    second = PaymentProcessor(dbase.session_factory, batch_size=2)
+    claimed = first.claim()
+    assert [p.amount for p in claimed] == [100, 200]
+    assert second.claim() == []
+
+    first.apply_group(claimed)
+    rest = second.claim()
+    assert [p.amount for p in rest] == [300]
+    second.apply_group(rest)
+
+    # the last payment did not fit after the first two
+    assert first.applied == 2 and second.failed == 1
+    rv = client.get('/v1/balance', headers=headers)
+    assert json.loads(rv.data)['Haggler:balance'] == '1.00'
+
+
+def test_too_large_amount(client, credentials):
+
+    c = credentials
+    rv = client.put(
+        f'/v1/deposit?to=Reachy&sum=1e20&token={MASTER_TOKEN}')
+    assert rv.status_code == 400
+    assert 'should be less or equal' in str(rv.data)
+
+    rv = client.put(
+        f'/v1/pay?to={c.to_wallet}&sum=99999999999999999', headers=c.headers)
+    assert rv.status_code == 400
+
+
+def test_balance_ceiling(client, credentials, monkeypatch):
+
+    c = credentials
+    rv = client.get('/v1/balance', headers=c.headers)
+    balance = to_cents(json.loads(rv.data)[f'{c.from_wallet}:balance'])
+    monkeypatch.setattr(ledger, 'MAX_BALANCE', balance + 100)
+
+    rv = client.put(
+        f'/v1/deposit?to={c.from_wallet}&sum=2&token={MASTER_TOKEN}')
+    assert rv.status_code == 409
+    assert 'would exceed' in str(rv.data)
+    rv = client.put(
+        f'/v1/pay?to={c.from_wallet}&sum=2',
+        headers=get_headers(c.to_wallet, common_password))
+    assert rv.status_code == 409
+
+    rv = client.put(
+        f'/v1/deposit?to={c.from_wallet}&sum=1&token={MASTER_TOKEN}')
+    assert rv.status_code == 200
+    rv = client.get('/v1/balance', headers=c.headers)
+    assert to_cents(
+        json.loads(rv.data)[f'{c.from_wallet}:balance']) == balance + 100
+
+
+def test_wallets_loaded_once_per_request(client, credentials):
+
+    c = credentials
+
+    # wallet loaded by auth is reused
+    rv = client.get('/v1/balance', headers=c.headers)
+    assert rv.status_code == 200
+    assert rv.headers['X-Query-Count'] == '1'
+    timing = rv.headers['Server-Timing']
+    assert timing.startswith('db;dur=')
+    assert ';desc="1 statements"' in timing
+
+    rv = client.get('/v1/history?limit=1', headers=c.headers)
+    assert rv.status_code == 200
+    # auth, two index scans of hot and of archived operations
+    assert rv.headers['X-Query-Count'] == '5'
+
+    # no wallet lookups by name left for the ledger: auth,
+    # recipient, balance changes, operation and its statistics
+    rv = client.put(
+        f'/v1/pay?to={c.to_wallet}&sum=0.01', headers=c.headers)
+    assert rv.status_code == 200
+    assert int(rv.headers['X-Query-Count']) <= 7
+
+    # unknown wallets are looked up once as well
+    rv = client.put('/v1/pay?to=Nobody&sum=0.01', headers=c.headers)
+    assert rv.status_code == 404
+    assert rv.headers['X-Query-Count'] == '2'
+
+
+def test_wallets_listing(client):
+    url = f'/v1/wallets?token={MASTER_TOKEN}'
+    rv = client.get(url)
+    everyone = json.loads(rv.data)['wallets']
+    names = [wallet['name'] for wallet in everyone]
+    assert names == sorted(names)
+    assert 'password_hash' not in everyone[0]
+
+    rv = client.get(url + '&prefix=Al')
+    found = [wallet['name'] for wallet in json.loads(rv.data)['wallets']]
+    assert found == [name for name in names if name.startswith('Al')]
+    assert 'Alex' in found and 'Alice' in found
+
+    # walking pages gives the same listing in every order
+    for sort in ('name', 'balance'):
+        rv = client.get(url + f'&sort={sort}')
+        expected = json.loads(rv.data)['wallets']
+        pages, cursor = [], ''
+        while True:
+            rv = client.get(url + f'&sort={sort}&limit=2&cursor={cursor}')
+            assert rv.status_code == 200
+            page = json.loads(rv.data)
+            pages.extend(page['wallets'])
+            if not page['next']:
+                break
+            cursor = page['next']
+        assert pages == expected
+    balances = [to_cents(wallet['balance']) for wallet in expected]
+    assert balances == sorted(balances)
+
+    rv = client.get(
+        f'/v1/wallets/stream?token={MASTER_TOKEN}&format=csv&sort=balance')
+    assert rv.status_code == 200
+    lines = rv.data.decode().splitlines()
+    assert lines[0] == 'id,name,balance'
+    assert len(lines) == len(expected) + 1
+
+    # cursor of balance order does not fit name order
+    rv = client.get(url + '&limit=1&sort=balance')
+    cursor = json.loads(rv.data)['next']
+    rv = client.get(url + f'&limit=1&sort=name&cursor={cursor}')
+    assert rv.status_code == 400
+    assert client.get(url + '&sort=spam').status_code == 400
+    for limit in ('0', '\u00b2'):
+        rv = client.get(url + f'&limit={limit}')
+        assert rv.status_code == 400
+        assert 'bad limit' in str(rv.data).lower()
+
+    # malformed keys of the right length
+    for sort, key in (('name', [[1]]), ('name', [1]),
+                      ('balance', ['x', 1]), ('balance', [1, None])):
+        cursor = base64.urlsafe_b64encode(
+            json.dumps(['next', key]).encode()).decode()
+        rv = client.get(url + f'&limit=1&sort={sort}&cursor={cursor}')
+        assert rv.status_code == 400
+        assert 'bad cursor' in str(rv.data).lower()
+    assert client.get(url + '&prefix=%25').status_code == 400
+
+
+def test_stats_match_history(client, credentials):
+
+    c = credentials
+    rv = client.get('/v1/history', headers=c.headers)
+    history = json.loads(rv.data)[f'{c.from_wallet}:history']
+    expected = {'deposited': 0, 'received': 0, 'sent': 0}
+    for op in history:
+        amount = to_cents(op['amount'] or '0')
+        if op['optype'] == 'deposit':
+            expected['deposited'] += amount
+        elif op['optype'] == 'transaction':
+            if op['get_from'] == c.from_wallet:
+                expected['sent'] -= amount
+            if op['sent_to'] == c.from_wallet:
+                expected['received'] += amount
+
+    rv = client.get('/v1/stats?granularity=total', headers=c.headers)
+    assert rv.status_code == 200
+    total, = json.loads(rv.data)[f'{c.from_wallet}:stats']
+    assert {
+        key: to_cents(total[key]) for key in expected
+    } == expected
+    assert total['operations'] == len(history)
+
+    # everything happened today
+    today = history[-1]['time'][:10]
+    rv = client.get(
+        f'/v1/stats?from={today}&to={today}&granularity=month',
+        headers=c.headers)
+    month, = json.loads(rv.data)[f'{c.from_wallet}:stats']
+    assert month['period'] == today[:8] + '01'
+    assert month['operations'] == len(history)
+
+    rv = client.get('/v1/stats?to=2000-01-01', headers=c.headers)
+    assert json.loads(rv.data)[f'{c.from_wallet}:stats'] == []
+
+    rv = client.get(
+        '/v1/stats?from=20210101&to=2021-02-01', headers=c.headers)
+    assert rv.status_code == 200
+
+    for args in ('from=yesterday', 'granularity=decade',
+                 'from=2021-02-01&to=2021-01-01',
+                 'from=2021-02-01&to=20210101'):
+        rv = client.get(f'/v1/stats?{args}', headers=c.headers)
+        assert rv.status_code == 400
+
+
+def test_history_reads_archive(client, dbase, credentials):
+    from datetime import datetime
+
+    from whalet import archive
+
+    c = credentials
+    rv = client.get('/v1/history', headers=c.headers)
+    before = json.loads(rv.data)[f'{c.from_wallet}:history']
+
+    # archive older half of the history
+    middle = datetime.fromisoformat(before[len(before) // 2]['time'])
+    moved = archive.archive(dbase.session_factory, middle, batch_size=7)
+    assert moved
+
+    rv = client.get('/v1/history', headers=c.headers)
+    assert json.loads(rv.data)[f'{c.from_wallet}:history'] == before
+
+    pages, cursor = [], ''
+    while True:
+        rv = client.get(
+            f'/v1/history?limit=3&cursor={cursor}', headers=c.headers)
+        page = json.loads(rv.data)
+        pages.extend(page[f'{c.from_wallet}:history'])
+        if not page['next']:
+            break
+        cursor = page['next']
+    assert pages == before
+
+    rv = client.get(
+        f'/v1/operations/{before[0]["id"]}', headers=c.headers)
+    assert rv.status_code == 200
+    assert json.loads(rv.data)[f'{c.from_wallet}:operation']['id'] == \
+        before[0]['id']
+
+
+def test_metrics(client, credentials):
+    c = credentials
+    client.get('/v1/balance', headers=c.headers)
+    client.put('/v1/pay?to=Nobody&sum=0.01', headers=c.headers)
+
+    rv = client.get('/metrics')
+    assert rv.status_code == 401
+    rv = client.get('/metrics', headers={'Authorization': 'Bearer wrong'})
+    assert rv.status_code == 401
+
+    rv = client.get(
+        '/metrics', headers={'Authorization': f'Bearer {MASTER_TOKEN}'})
+    assert rv.status_code == 200
+    assert rv.content_type.startswith('text/plain; version=0.0.4')
+    lines = rv.data.decode().splitlines()
+    assert any(line.startswith(
+        'whalet_requests_total{route="/v1/pay",method="PUT",status="404"}')
+        for line in lines)
+    assert any(line.startswith(
+        'whalet_request_duration_seconds_count{route="/v1/balance"}')
+        for line in lines)
+    assert any(line.startswith(
+        'whalet_db_statements_total{route="/v1/balance"}')
+        for line in lines)
+    assert any(line.startswith('whalet_password_verify_seconds_count')
+               for line in lines)
+    assert any(line.startswith('whalet_db_statement_duration_seconds_sum')
+               for line in lines)
+    assert any(line.startswith('whalet_db_pool_connections{state=')
+               for line in lines)
+    assert any(line.startswith('whalet_auth_cache_hits_total')
+               for line in lines)
+    assert any(line.startswith('whalet_log_records_dropped_total')
+               for line in lines)
+
+
+def test_request_phases_timed(client, credentials):
+    c = credentials
+    rv = client.put(
+        f'/v1/pay?to={c.to_wallet}&sum=0.01', headers=c.headers)
+    assert rv.status_code == 200
+    phases = [entry.split(';')[0]
+              for entry in rv.headers['Server-Timing'].split(', ')]
+    assert sorted(phases) == [
+        'auth', 'db', 'serialization', 'total', 'validation']
+
+
+def test_outdated_hash_replaced_on_login(app, client, db):
+    from werkzeug.security import generate_password_hash
+
+    wallet = models.Wallet(
+        name='Oldhash', balance=0,
+        password_hash=generate_password_hash(
+            'oldpassword1', 'pbkdf2:sha256:1000', 8))
+    db.add(wallet)
+    db.commit()
+    db.remove()
+    headers = get_headers(name='Oldhash', password='oldpassword1')
+
+    rv = client.get('/v1/balance', headers=headers)
+    assert rv.status_code == 200
+    stored = db.query(models.Wallet.password_hash).filter(
+        models.Wallet.name == 'Oldhash').scalar()
+    db.remove()
+    method, salt, _ = stored.split('$')
+    assert method == app.config['PASSWORD_HASH_METHOD']
+    assert len(salt) == app.config['PASSWORD_SALT_LENGTH']
+
+    rv = client.get('/v1/balance', headers=headers)
+    assert rv.status_code == 200
+    rv = client.get('/v1/balance', headers=get_headers(
+        name='Oldhash', password='wrongpassword1'))
+    assert rv.status_code == 401
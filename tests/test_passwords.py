@@ -0,0 +1,53 @@
+import threading
+
+from pytest import raises
+from werkzeug.security import generate_password_hash
+
+from whalet import passwords
+
+
+def test_hash_with_configured_cost():
+    hasher = passwords.PasswordHasher(
+        method='pbkdf2:sha256:1000', salt_length=8)
+    password_hash = hasher.hash('secret1')
+    assert password_hash.startswith('pbkdf2:sha256:1000$')
+    assert len(password_hash.split('$')[1]) == 8
+    assert hasher.verify(password_hash, 'secret1')
+    assert not hasher.verify(password_hash, 'secret2')
+    assert not hasher.needs_rehash(password_hash)
+
+    # hashes made with other settings verify and need a rehash
+    for method, salt_length in [
+            ('pbkdf2:sha256:2000', 8), ('pbkdf2:sha512:1000', 8),
+            ('pbkdf2:sha256:1000', 16)]:
+        other = generate_password_hash('secret1', method, salt_length)
+        assert hasher.verify(other, 'secret1')
+        assert hasher.needs_rehash(other)
+    assert hasher.needs_rehash('plain')
+
+
+def test_busy_when_saturated(monkeypatch):
+    running, release = threading.Semaphore(0), threading.Event()
+
+    def slow_hash(password, method, salt_length):
+        running.release()
+        release.wait()
+        return 'hash'
+    monkeypatch.setattr(passwords, 'generate_password_hash', slow_hash)
+    hasher = passwords.PasswordHasher(workers=2, max_pending=0)
+
+    threads = [threading.Thread(target=hasher.hash, args=('secret1',))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for _ in threads:
+        assert running.acquire(timeout=5)
+    # both workers busy and nothing may wait: refused at once
+    with raises(passwords.Busy):
+        hasher.hash('secret1')
+    assert hasher.stats()['rejected'] == 1
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert hasher.hash('secret1') == 'hash'
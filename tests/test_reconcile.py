@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+
+from pytest import fixture
+from sqlalchemy import text
+
+from whalet import ledger, migrations, models, reconcile
+from whalet.database import Database
+
+
+@fixture
+def url():
+    '''
+    Database file with a few wallets and operations
+    '''
+    db_fd, db_path = tempfile.mkstemp()
+    os.unlink(db_path)
+    url = 'sqlite:///' + db_path
+    dbase = Database(url=url)
+    migrations.upgrade(dbase.engine, models.Base.metadata)
+
+    session = dbase.create_session()
+    for number in range(7):
+        wallet = models.Wallet(name=f'wallet{number}', balance=0)
+        session.add(wallet)
+        session.flush()
+        ledger.record_creation(session, wallet)
+        ledger.deposit(session, wallet.name, 1000 * (number + 1))
+    ledger.transfer(session, 'wallet0', 'wallet6', 250)
+    ledger.transfer_many(
+        session, 'wallet6', [('wallet1', 100), ('wallet6', 5)])
+    session.commit()
+    session.close()
+
+    yield url
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def set_balance(url, name, balance):
+    with Database(url=url).engine.begin() as conn:
+        conn.execute(text(
+            'UPDATE "Wallets" SET balance = :balance WHERE name = :name'),
+            dict(balance=balance, name=name))
+
+
+def test_balances_match(url):
+    report = reconcile.reconcile(url, workers=2, range_size=3)
+    assert report['wallets'] == 7
+    assert report['ranges'] == 3
+    assert report['discrepancies'] == []
+
+
+def test_drift_reported_and_repaired(url):
+    set_balance(url, 'wallet6', 1)
+
+    report = reconcile.reconcile(url, workers=2, range_size=3)
+    assert report['discrepancies'] == [dict(
+        wallet_id=7, name='wallet6', balance='0.01',
+        expected='71.50', difference='-71.49')]
+    assert report['repaired'] == 0
+
+    report = reconcile.reconcile(url, workers=1, fix=True)
+    assert report['repaired'] == 1
+    assert reconcile.reconcile(url)['discrepancies'] == []
+
+
+def test_command_line(url, tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URI', url)
+    set_balance(url, 'wallet2', 0)
+
+    report_path = tmp_path / 'report.json'
+    assert reconcile.main(['--report', str(report_path)]) == 1
+    report = json.loads(report_path.read_text())
+    assert [d['name'] for d in report['discrepancies']] == ['wallet2']
+
+    assert reconcile.main(
+        ['--repair', '--report', str(report_path)]) == 0
+    assert reconcile.main(['--report', str(report_path)]) == 0
@@ -0,0 +1,129 @@
+'''
+Operations archiving.
+
+Moves operations older than a cutoff from the hot Operations
+table into OperationsArchive, a batch per transaction, so the
+hot table and its indexes stay small. Every wallet taking part
+in archived operations gets a Checkpoint row with their net sum
+and number, which whalet.reconcile uses instead of reading the
+archive. History endpoints read both tables (see
+whalet.routes.history_queries), so archiving is not visible
+to clients.
+
+    python -m whalet.archive [--before YYYY-MM-DD | --days N]
+                             [--batch-size N]
+
+Database is taken from DATABASE_URI (sqlite:///./whalet.db by
+default), cutoff defaults to ARCHIVE_AFTER_DAYS days ago.
+'''
+import argparse
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from whalet import models, stats
+from whalet.ledger import IN_CHUNK_SIZE
+
+
+operations = models.Operation.__table__
+archived = models.ArchivedOperation.__table__
+checkpoints = models.Checkpoint.__table__
+
+
+def checkpoint_deltas(rows: list, cutoff: datetime) -> list:
+    '''
+    Net sum and number of operations per wallet
+    as Checkpoint rows to add to the existing ones
+    '''
+    deltas = defaultdict(lambda: [0, 0])
+    for row in rows:
+        amount = row.amount or 0
+        if row.sent_to_id is not None:
+            deltas[row.sent_to_id][0] += amount
+            deltas[row.sent_to_id][1] += 1
+        if row.get_from_id is not None:
+            deltas[row.get_from_id][0] -= amount
+            if row.get_from_id != row.sent_to_id:
+                deltas[row.get_from_id][1] += 1
+    return [
+        dict(wallet_id=wallet_id, archived_until=cutoff,
+             balance=balance, operations=count)
+        for wallet_id, (balance, count) in sorted(deltas.items())
+    ]
+
+
+def archive_batch(session, cutoff: datetime, batch_size: int) -> int:
+    '''
+    Move one batch of operations older than cutoff,
+    return number of operations moved
+    '''
+    rows = session.execute(
+        select(operations).where(operations.c.time < cutoff)
+        .order_by(operations.c.time, operations.c.id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+
+    session.execute(archived.insert(), [dict(row._mapping) for row in rows])
+    stats.increment(
+        session, checkpoints,
+        keys=('wallet_id',),
+        counters=('balance', 'operations'),
+        values=checkpoint_deltas(rows, cutoff),
+        replace=('archived_until',))
+    ids = [row.id for row in rows]
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        session.execute(operations.delete().where(
+            operations.c.id.in_(ids[start:start + IN_CHUNK_SIZE])))
+    return len(rows)
+
+
+def archive(
+        session_factory,
+        cutoff: datetime,
+        batch_size: int = 10000) -> int:
+    '''
+    Move all operations older than cutoff, return their number.
+    Every batch is moved in its own transaction.
+    '''
+    moved = 0
+    session = session_factory()
+    try:
+        while True:
+            count = archive_batch(session, cutoff, batch_size)
+            session.commit()
+            moved += count
+            if count < batch_size:
+                return moved
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    from whalet.database import Database
+    from whalet.factory import create_app
+
+    app = create_app()
+    parser = argparse.ArgumentParser(
+        prog='python -m whalet.archive',
+        description='Move old operations into the archive table')
+    parser.add_argument('--before', type=datetime.fromisoformat)
+    parser.add_argument(
+        '--days', type=int, default=app.config['ARCHIVE_AFTER_DAYS'])
+    parser.add_argument(
+        '--batch-size', type=int,
+        default=app.config['ARCHIVE_BATCH_SIZE'])
+    args = parser.parse_args()
+
+    cutoff = args.before or datetime.now() - timedelta(days=args.days)
+    dbase = Database(url=os.environ.get(
+        'DATABASE_URI', 'sqlite:///./whalet.db'))
+    app.logger.info('Archiving operations older than %s...', cutoff)
+    moved = archive(dbase.session_factory, cutoff, args.batch_size)
+    app.logger.info('Archived %s operations', moved)
@@ -0,0 +1,192 @@
+'''
+Group commit of concurrent writes.
+
+Every mutating request used to commit on its own, so the write
+rate was limited by fsync rate. WriteBatcher collects writes of
+concurrent requests and applies them in micro-batches: up to
+max_size writes or max_wait seconds, one transaction and one
+commit per batch. Every caller still gets its own result or
+error.
+
+A write is a function taking a session as first argument, like
+whalet.ledger functions. Every write of a batch runs in a
+savepoint of its own: a write rejected with LedgerError is
+rolled back alone and the rest are still committed together.
+On any other error the batch is rolled back and writes are
+replayed one by one, each with its own commit, so one failing
+write does not affect others.
+'''
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from sqlalchemy import text
+
+from whalet.ledger import LedgerError
+
+
+log = logging.getLogger(__name__)
+
+
+class WriteBatcher:
+    '''
+    Background writer applying submitted writes in batches.
+
+    The writer thread is started lazily in the process that
+    submits first, so the batcher survives gunicorn's
+    --preload forking.
+    '''
+    def __init__(
+            self,
+            session_factory,
+            max_size=64,
+            max_wait=0.002):
+        self.session_factory = session_factory
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.writes = 0
+        self.replays = 0
+        self.largest = 0
+        self.sizes = Counter()    # batch size bucket (power of 2): count
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, func, *args) -> Future:
+        '''
+        Queue a write, get a future of its result
+        '''
+        self._ensure_started()
+        future = Future()
+        self._queue.put((func, args, future))
+        return future
+
+    def run(self, func, *args):
+        '''
+        Queue a write and wait for its result
+        (or exception raised by the write)
+        '''
+        return self.submit(func, *args).result()
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'writes': self.writes,
+            'replays': self.replays,
+            'largest': self.largest,
+            'average': self.writes / self.batches if self.batches else 0,
+            'sizes': dict(sorted(self.sizes.items()))
+        }
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(
+                target=self._loop, name='whalet-write-batcher',
+                daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._apply(batch)
+            except Exception as exc:   # never let the writer die
+                log.exception('Write batch failed')
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    def _apply(self, batch: list):
+        self._record(len(batch))
+        session = self.session_factory()
+        try:
+            if len(batch) == 1:
+                self._replay(session, batch)
+                return
+            try:
+                outcomes = self._apply_each(session, batch)
+                session.commit()
+            except Exception:
+                session.rollback()
+                self.replays += 1
+                self._replay(session, batch)
+                return
+            for (_, _, future), (result, error) in zip(batch, outcomes):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+        finally:
+            session.close()
+
+    def _apply_each(self, session, batch: list) -> list:
+        '''
+        Run writes of a batch in one transaction, each in a
+        savepoint, return (result, LedgerError) pairs. Other
+        exceptions are raised.
+        '''
+        if session.get_bind().dialect.name == 'sqlite':
+            # pysqlite begins a transaction only before DML, so
+            # the first SAVEPOINT would start (and its RELEASE
+            # commit) a transaction of its own
+            session.execute(text('BEGIN'))
+        outcomes = []
+        for func, args, _ in batch:
+            savepoint = session.begin_nested()
+            try:
+                result = func(session, *args)
+            except LedgerError as exc:
+                savepoint.rollback()
+                outcomes.append((None, exc))
+            except Exception:
+                # close the savepoint first, so rollback() of the
+                # caller ends the whole transaction
+                savepoint.rollback()
+                raise
+            else:
+                savepoint.commit()
+                outcomes.append((result, None))
+        return outcomes
+
+    def _replay(self, session, batch: list):
+        for func, args, future in batch:
+            try:
+                result = func(session, *args)
+                session.commit()
+            except Exception as exc:
+                session.rollback()
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def _record(self, size: int):
+        self.batches += 1
+        self.writes += size
+        self.largest = max(self.largest, size)
+        self.sizes[1 << (size - 1).bit_length()] += 1
+        log.debug('Applying write batch of %s', size)
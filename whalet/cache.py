@@ -0,0 +1,110 @@
+'''
+In-memory cache of already verified credentials.
+
+HTTP Basic auth sends the password with every request, so
+without a cache every call pays for a full PBKDF2 key
+derivation in werkzeug's check_password_hash.
+'''
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CredentialCache:
+    '''
+    Bounded TTL cache of verified credentials.
+
+    Keys are salted digests of wallet name, password and the
+    stored password hash, plaintext is never kept. Since the
+    stored hash is part of the key, an entry stops matching
+    as soon as the password is changed (in every worker).
+    '''
+    def __init__(
+            self,
+            maxsize=1024,
+            ttl=60,
+            enabled=True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._salt = os.urandom(16)
+        self._entries = OrderedDict()   # digest -> (name, expires)
+        self._lock = threading.Lock()
+
+    def _digest(
+            self,
+            name: str,
+            password: str,
+            password_hash: str) -> bytes:
+        message = '\x00'.join((name, password, password_hash))
+        return hmac.new(
+            self._salt, message.encode('utf-8'), hashlib.sha256
+        ).digest()
+
+    def check(
+            self,
+            name: str,
+            password: str,
+            password_hash: str) -> bool:
+        '''
+        Return True if credentials were verified recently
+        '''
+        if not self.enabled:
+            return False
+        key = self._digest(name, password, password_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(
+            self,
+            name: str,
+            password: str,
+            password_hash: str):
+        '''
+        Remember credentials which passed the password check
+        '''
+        if not self.enabled:
+            return
+        key = self._digest(name, password, password_hash)
+        with self._lock:
+            self._entries[key] = (name, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, name: str):
+        '''
+        Drop every cached entry for given wallet name
+        '''
+        with self._lock:
+            stale = [
+                key for key, (owner, _) in self._entries.items()
+                if owner == name
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -2,17 +2,36 @@
 Provides tools for checking conditions and aborting
 with appropriate HTTPs codes and messages.
 
-While aborting flask.abort is used.
+While aborting flask.abort is used. Wallets are read
+through whalet.context, so a wallet checked several times
+during a request is loaded once.
 '''
-from decimal import Decimal
+import math
 import string
+from datetime import date
 from typing import Any
 
 from flask import abort
+from werkzeug.exceptions import HTTPException
 
+from whalet.context import request_wallets, timed
+from whalet.money import MAX_AMOUNT, to_str
+from whalet.pagination import BadCursor, decode_cursor
 # from whalet.registry import IdStorage
 
 
+def timed_checks(cls):
+    '''
+    Class decorator timing every if_* check as
+    validation phase of the request
+    '''
+    for name, value in list(vars(cls).items()):
+        if name.startswith('if_') and callable(value):
+            setattr(cls, name, timed('validation')(value))
+    return cls
+
+
+@timed_checks
 class Abort:
     '''
     Provides ready-to-use abort functions.
@@ -32,16 +51,33 @@ class Abort:
     #
     # Abort functions
     #
+    def collect(self, check, *args, **kwargs) -> tuple:
+        '''
+        Run check (or several checks wrapped in a function)
+        without aborting the request. Return (result, None)
+        if passed and (None, HTTPException) otherwise.
+
+        Handy for validating batch items one by one.
+        '''
+        try:
+            return check(*args, **kwargs), None
+        except HTTPException as exc:
+            return None, exc
+
     def if_wallet_doesnt_exist(
             self,
             wallet_name: str,
-            model: object):
+            model: object,
+            known: set = None):
         '''
-        Abort if given wallet name doesn't exist
+        Abort if given wallet name doesn't exist.
+        With known set of existing names given,
+        no query is made.
         '''
-        c = self.db.query(
-                model.id).filter_by(
-                    name=wallet_name).scalar()
+        if known is not None:
+            c = wallet_name in known
+        else:
+            c = request_wallets(self.db, model).get(wallet_name)
         if not c:
             abort(
                 404, f"Wallet {wallet_name} does not exist"
@@ -54,9 +90,7 @@ class Abort:
         '''
         Abort if given wallet name exists already
         '''
-        c = self.db.query(
-                model.id).filter_by(
-                    name=wallet_name).scalar()
+        c = request_wallets(self.db, model).get(wallet_name)
         if c:
             abort(
                 409, f'Wallet {wallet_name} already exists.\
@@ -120,24 +154,23 @@ class Abort:
             request.args[arg]
         except KeyError:
             self.app.logger.info(
-                f'Could not find {arg} in request.args')
+                'Could not find %s in request.args', arg)
             abort(code, message)
 
     def if_balance_falls_below_zero(
             self,
             from_wallet: str,
-            value: Decimal or float,
+            value: int,
             model: object):
         '''
         Abort if balance of given wallet
         dives below zero after initialized
-        operation.
+        operation (value in cents).
         '''
-        balance = self.db.query(model).filter(
-            model.name == from_wallet).first().balance
-        balance = Decimal(str(balance))
+        balance = request_wallets(
+            self.db, model).get(from_wallet).balance
 
-        if balance - Decimal(value) < Decimal('0'):
+        if balance - value < 0:
             abort(
                 409,
                 f'Not enough money in wallet {from_wallet}'
@@ -145,12 +178,12 @@ class Abort:
 
     def if_negative_arg(
             self,
-            arg: Decimal or float,
+            arg: int,
             operation=None):
         '''
-        Abort if an argument is negative
+        Abort if an argument (in cents) is negative
         '''
-        if arg < Decimal('0'):
+        if arg < 0:
             err_message = 'Negative argument is not allowed'
             if operation:
                 ' '.join(
@@ -158,16 +191,26 @@ class Abort:
                 )
             abort(400, err_message)
 
-    def if_zero_amount(self, arg: Decimal or float):
-        if arg < Decimal('0.01'):
+    def if_zero_amount(self, arg: int):
+        if arg < 1:
             abort(
                 400, 'Operation sum should be more or equal 0.01'
             )
 
+    def if_amount_too_large(self, arg: int):
+        if arg > MAX_AMOUNT:
+            abort(
+                400,
+                f'Operation sum should be less or equal {to_str(MAX_AMOUNT)}'
+            )
+
     def if_not_numeric(self, arg: Any):
         try:
-            float(arg)
-        except ValueError:
+            # nan and inf are not numbers to pay with
+            numeric = math.isfinite(float(arg))
+        except (TypeError, ValueError):
+            numeric = False
+        if not numeric:
             abort(
                 400, f'Argument {arg}: wrong format (expected numeric)'
             )
@@ -216,14 +259,139 @@ class Abort:
         '''
         Abort if username doesn't exist
         '''
-        c = self.db.query(
-                model.id).filter_by(
-                    name=username).scalar()
+        c = request_wallets(self.db, model).get(username)
         if not c:
             abort(
                 404, f"User {username} does not exist. Check login"
             )
 
+    def if_bad_limit(self, arg: str, maximum: int):
+        '''
+        Abort if page size is not an integer from 1 to maximum
+        '''
+        # str.isdigit() is also true for non-ASCII digits,
+        # some of them (like '²') int() could not parse
+        valid = arg.isascii() and arg.isdigit()
+        if not valid or not 1 <= int(arg) <= maximum:
+            abort(
+                400,
+                f'Bad limit. Should be an integer from 1 to {maximum}'
+                )
+
+    def if_bad_cursor(self, cursor: str, columns: list = None):
+        '''
+        Abort if pagination cursor could not be decoded
+        (or was made for other sort columns)
+        '''
+        if not cursor:
+            return
+        try:
+            decode_cursor(cursor, columns)
+        except BadCursor:
+            abort(
+                400, 'Bad cursor. Use one returned by the previous page'
+            )
+
+    def if_bad_prefix(self, prefix: str):
+        '''
+        Abort if name prefix has chars wallet names could not have
+        '''
+        allowed = set(
+            string.ascii_lowercase
+            + string.ascii_uppercase
+            + string.digits
+            + '-' + '_'
+        )
+        if len(prefix) > 14 or not set(prefix) <= allowed:
+            abort(
+                400,
+                'Bad prefix. Only letters, digits and "-", "_" chars allowed'
+                )
+
+    def if_bad_date(self, arg: str):
+        '''
+        Abort if given date is not in YYYY-MM-DD format
+        '''
+        if not arg:
+            return
+        try:
+            date.fromisoformat(arg)
+        except ValueError:
+            abort(
+                400, f'Bad date {arg}. Expected YYYY-MM-DD'
+            )
+
+    def if_bad_date_range(self, start: str, end: str):
+        '''
+        Abort if start date is after end date. Dates are
+        compared parsed, as fromisoformat() also accepts
+        other forms than YYYY-MM-DD (e.g. 20210201)
+        '''
+        if start and end and \
+                date.fromisoformat(start) > date.fromisoformat(end):
+            abort(
+                400, 'Bad date range. Start should not be after end'
+            )
+
+    def if_bad_granularity(self, granularity: str, supported):
+        if granularity not in supported:
+            abort(
+                400,
+                f'Bad granularity. Supported: {", ".join(supported)}'
+                )
+
+    def if_bad_sort(self, sort: str, supported):
+        if sort not in supported:
+            abort(
+                400,
+                f'Bad sort. Supported: {", ".join(supported)}'
+                )
+
+    def if_bad_format(self, format: str, supported):
+        '''
+        Abort if requested response format is not supported
+        '''
+        if format not in supported:
+            abort(
+                400,
+                f'Bad format. Supported: {", ".join(supported)}'
+                )
+
+    def if_bad_batch(self, body: Any, max_items: int):
+        '''
+        Abort if request body is not a list of batch items
+        (or {"items": [...]} object) of acceptable size
+        '''
+        items = body.get('items') if isinstance(body, dict) else body
+        if not isinstance(items, list) or not items:
+            abort(
+                400,
+                'Bad batch. Expected a non-empty JSON list of items'
+                )
+        if len(items) > max_items:
+            abort(
+                400,
+                f'Bad batch. Too many items (max {max_items})'
+                )
+
+    def if_item_incomplete(self, item: Any, keys=('to', 'sum')):
+        '''
+        Abort if batch item is not an object with given keys
+        '''
+        if not isinstance(item, dict) or not all(
+                key in item for key in keys):
+            abort(
+                400,
+                f'Batch item should have {", ".join(keys)} values'
+                )
+
+    def if_bad_mode(self, mode: str, supported):
+        if mode not in supported:
+            abort(
+                400,
+                f'Bad mode. Supported: {", ".join(supported)}'
+                )
+
     def if_token_incorrect(
             self,
             token: str,
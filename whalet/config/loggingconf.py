@@ -1,15 +1,40 @@
+'''
+Logging configuration.
+
+Records go to a queue written to stderr by a background thread
+(whalet.logs.AsyncHandler), messages repeated on hot paths are
+rate-limited. Level, format and limits are taken from
+whalet.config.settings.
+'''
+from whalet.config import settings
+
+
 flask_log_conf = {
     'version': 1,
-    'formatters': {'default': {
-        'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
-    }},
+    'formatters': {
+        'text': {
+            'format':
+                '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
+        },
+        'json': {
+            '()': 'whalet.logs.JsonFormatter'
+        }
+    },
+    'filters': {
+        'rate_limit': {
+            '()': 'whalet.logs.RateLimitFilter',
+            'burst': settings.LOG_RATE_LIMIT,
+            'period': 1.0
+        }
+    },
     'handlers': {'wsgi': {
-        'class': 'logging.StreamHandler',
-        'stream': 'ext://flask.logging.wsgi_errors_stream',
-        'formatter': 'default'
+        '()': 'whalet.logs.AsyncHandler',
+        'maxsize': settings.LOG_QUEUE_SIZE,
+        'formatter': settings.LOG_FORMAT,
+        'filters': ['rate_limit']
     }},
     'root': {
-        'level': 'INFO',
+        'level': settings.LOG_LEVEL,
         'handlers': ['wsgi']
     }
 }
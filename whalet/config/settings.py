@@ -0,0 +1,81 @@
+'''
+Default application settings.
+
+Loaded into app.config by whalet.factory.create_app(),
+any value could be overridden afterwards.
+'''
+
+# logging (whalet.config.loggingconf, read when app is created)
+LOG_LEVEL = 'INFO'
+LOG_FORMAT = 'json'          # 'json' lines or 'text'
+LOG_QUEUE_SIZE = 10000       # records waiting for the writer, more dropped
+LOG_RATE_LIMIT = 10          # same message per second below WARNING
+
+# password hashing (whalet.passwords); hashes made with other
+# settings are replaced on login
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:260000'   # pbkdf2:<hash>:<iterations>
+PASSWORD_SALT_LENGTH = 16
+PASSWORD_REHASH_ON_LOGIN = True
+HASH_WORKERS = 4             # hashes computed at once
+HASH_MAX_PENDING = 16        # hashes waiting for a worker, more get 503
+
+# cache of verified Basic auth credentials
+AUTH_CACHE_ENABLED = True
+AUTH_CACHE_SIZE = 1024     # entries
+AUTH_CACHE_TTL = 60        # seconds
+
+# database connection pool
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_RECYCLE = 1800     # seconds
+DB_POOL_PRE_PING = True
+DB_POOL_TIMEOUT = 30       # seconds
+
+# keyset pagination
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+WALLETS_PAGE_SIZE = 100
+WALLETS_MAX_PAGE_SIZE = 1000
+
+# rows fetched per round trip by streaming responses
+STREAM_BATCH_SIZE = 1000
+
+# operations archiving (whalet.archive)
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_BATCH_SIZE = 10000
+
+# batch operations
+PAY_BATCH_MAX_ITEMS = 10000
+DEPOSIT_BULK_MAX_ITEMS = 100000
+
+# group commit of deposits and transfers (whalet.batcher)
+WRITE_BATCHER_ENABLED = False
+WRITE_BATCH_MAX_SIZE = 64
+WRITE_BATCH_MAX_WAIT_MS = 2
+
+# asynchronous payments (whalet.payqueue)
+PAYMENT_QUEUE_MAX_DEPTH = 10000
+PAYMENT_QUEUE_BATCH_SIZE = 500
+PAYMENT_QUEUE_WORKERS = 0    # > 0 starts processor inside the app
+PAYMENT_QUEUE_LEASE = 300    # seconds, older claims are requeued
+
+# X-Query-Count header and debug log with number of SQL
+# statements made by every request (whalet.context)
+DEBUG_QUERY_COUNT = False
+
+# SQL statements time in Server-Timing header, slow statements
+# and N+1 warnings in log (whalet.context.QueryInstrumentation)
+SQL_INSTRUMENTATION = False
+SLOW_QUERY_MS = 100
+N_PLUS_ONE_STATEMENTS = 20   # more statements per request are logged
+
+# auth, validation, db and serialization time of sampled requests
+# in Server-Timing header (whalet.context.RequestTiming)
+REQUEST_TIMING_SAMPLE_RATE = 0.0   # share of requests, 0 disables
+REQUEST_TIMING_LOG = False         # log timed requests as JSON lines
+
+# Prometheus metrics at /metrics (whalet.metrics)
+METRICS_ENABLED = True
+METRICS_TOKEN = None         # MASTER_TOKEN if not set
+METRICS_DIR = None           # directory shared by gunicorn workers
+METRICS_FLUSH_INTERVAL = 5   # seconds
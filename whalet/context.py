@@ -0,0 +1,374 @@
+'''
+Per-request state: wallets already loaded by the request,
+SQL statements it has issued, time spent in request phases
+and Server-Timing entries.
+
+Auth, Abort checks and routes all ask for the same wallets
+(sender in auth and balance checks, recipient in existence
+checks). Getting them through request_wallets() loads each
+wallet row at most once per request.
+
+QueryInstrumentation (opt-in, SQL_INSTRUMENTATION setting)
+sums statement time per request, logs slow statements with
+their parameters (credentials redacted) and the route which
+issued them, and warns
+about requests issuing too many statements (usually an N+1
+pattern: one query per item of a list).
+
+RequestTiming (REQUEST_TIMING_SAMPLE_RATE setting) times phases
+of sampled requests: spans of code run in span() or timed()
+functions (auth, validation, serialization) and SQL statements
+(db). Spans do not nest, time of a span opened inside another
+one goes to the outer span. SQL statements are timed on their
+own, so db time is a part of the other phases as well.
+'''
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from whalet import models
+
+
+log = logging.getLogger(__name__)
+
+
+class WalletMap:
+    '''
+    Wallets by name, each loaded at most once.
+    Missing wallets are remembered as None.
+    '''
+    def __init__(self, session, model: object = models.Wallet):
+        self.session = session
+        self.model = model
+        self.rows = {}
+
+    def get(self, name: str):
+        '''
+        Wallet with given name or None
+        '''
+        if name not in self.rows:
+            self.rows[name] = self.session.query(self.model).filter(
+                self.model.name == name).first()
+        return self.rows[name]
+
+    def add(self, wallet):
+        '''
+        Remember a wallet created by the request
+        '''
+        self.rows[wallet.name] = wallet
+
+    def forget(self, name: str):
+        self.rows.pop(name, None)
+
+
+def request_wallets(session, model: object = models.Wallet) -> WalletMap:
+    '''
+    WalletMap of the current request (a throwaway one
+    outside of request context)
+    '''
+    if not has_request_context():
+        return WalletMap(session, model)
+    if 'wallets' not in g:
+        g.wallets = WalletMap(session, model)
+    return g.wallets
+
+
+def reset():
+    '''
+    Drop per-request state, called at request teardown
+    '''
+    for name in ('wallets', 'query_count', 'query_time', 'statements',
+                 'request_started', 'server_timing'):
+        g.pop(name, None)
+    _phases.set(None)
+    _open_span.set(None)
+
+
+def route_name() -> str:
+    '''
+    Method and route rule of the current request
+    ('-' outside of request context)
+    '''
+    if not has_request_context():
+        return '-'
+    rule = request.url_rule
+    return f'{request.method} {rule.rule if rule else request.path}'
+
+
+def add_timing(name: str, seconds: float, description: str = None):
+    '''
+    Add an entry to the Server-Timing header of the response
+    '''
+    g.setdefault('server_timing', []).append((name, seconds, description))
+
+
+def server_timing() -> str:
+    '''
+    Server-Timing header value of the current request
+    (empty if nothing was timed)
+    '''
+    entries = []
+    for name, seconds, description in g.get('server_timing', ()):
+        entry = f'{name};dur={seconds * 1000:.2f}'
+        if description:
+            entry += f';desc="{description}"'
+        entries.append(entry)
+    return ', '.join(entries)
+
+
+#
+# SQL statements counter
+#
+def _count_statement(*args, **kwargs):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+def count_queries(engine):
+    '''
+    Count statements executed by requests on given engine.
+    Statements of background threads (write batcher, payment
+    queue) are not counted.
+    '''
+    if not event.contains(engine, 'before_cursor_execute', _count_statement):
+        event.listen(engine, 'before_cursor_execute', _count_statement)
+
+
+def query_count() -> int:
+    '''
+    Statements executed by the current request so far
+    '''
+    return g.get('query_count', 0)
+
+
+#
+# SQL statements timing
+#
+def _statement_started(conn, cursor, statement, parameters, execution,
+                       executemany):
+    if execution is not None:
+        execution._whalet_started = time.perf_counter()
+
+
+def _statement_finished(conn, cursor, statement, parameters, execution,
+                        executemany):
+    seconds = statement_seconds(execution)
+    if seconds is not None and has_request_context():
+        g.query_time = g.get('query_time', 0) + seconds
+
+
+def time_statements(engine):
+    '''
+    Time every statement executed on given engine, sum time
+    of statements of every request (see query_time()).
+    Time of a just executed statement is given by
+    statement_seconds() to after_cursor_execute listeners.
+    '''
+    if not event.contains(
+            engine, 'before_cursor_execute', _statement_started):
+        event.listen(engine, 'before_cursor_execute', _statement_started)
+        event.listen(engine, 'after_cursor_execute', _statement_finished)
+
+
+def query_time() -> float:
+    '''
+    Seconds the current request spent in SQL statements so far
+    '''
+    return g.get('query_time', 0)
+
+
+def statement_seconds(execution) -> float:
+    '''
+    Time of a just executed statement (in after_cursor_execute
+    listeners) or None if it was not timed
+    '''
+    started = getattr(execution, '_whalet_started', None)
+    if started is None:
+        return None
+    return time.perf_counter() - started
+
+
+def _shorten(value, limit: int = 500) -> str:
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+# parameters with these words in their names are not logged
+SECRET_PARAMETERS = ('password', 'token', 'secret')
+REDACTED = '<redacted>'
+
+
+def _secret(name: str) -> bool:
+    return any(word in name.lower() for word in SECRET_PARAMETERS)
+
+
+def redact(parameters, names: list = None, executemany: bool = False):
+    '''
+    Statement parameters with values of credential parameters
+    (password hashes, tokens) replaced. Positional parameters
+    are matched to bind names given; without names they are
+    all replaced.
+    '''
+    if executemany:
+        return [redact(params, names) for params in parameters]
+    if isinstance(parameters, dict):
+        return {
+            key: REDACTED if _secret(str(key)) else value
+            for key, value in parameters.items()
+        }
+    if not parameters:
+        return parameters
+    if names is None or len(names) != len(parameters):
+        return REDACTED
+    return tuple(
+        REDACTED if _secret(name) else value
+        for name, value in zip(names, parameters))
+
+
+class QueryInstrumentation:
+    '''
+    Per-request statement number and time, slow statement
+    log and N+1 warning for statements of given engine
+    '''
+    def __init__(
+            self,
+            engine,
+            slow_ms: float = 100,
+            max_statements: int = 20):
+        self.slow = slow_ms / 1000
+        self.max_statements = max_statements
+        count_queries(engine)
+        time_statements(engine)
+        event.listen(engine, 'after_cursor_execute', self._statement_done)
+
+    def _statement_done(self, conn, cursor, statement, parameters,
+                        execution, executemany):
+        seconds = statement_seconds(execution)
+        if seconds is None:
+            return
+        if has_request_context():
+            g.setdefault('statements', Counter())[statement] += 1
+        if seconds >= self.slow:
+            compiled = getattr(execution, 'compiled', None)
+            names = getattr(compiled, 'positiontup', None)
+            log.warning(
+                'Slow SQL statement (%.1f ms) in %s: %s; parameters: %s',
+                seconds * 1000, route_name(), statement,
+                _shorten(redact(parameters, names, executemany)))
+
+    def finish_request(self) -> dict:
+        '''
+        Summary of statements of the current request, added
+        to Server-Timing. Too many statements are logged as
+        a possible N+1 pattern.
+        '''
+        count, seconds = query_count(), query_time()
+        add_timing('db', seconds, f'{count} statements')
+        if count > self.max_statements:
+            statements = g.get('statements') or Counter({'?': count})
+            statement, repeated = statements.most_common(1)[0]
+            log.warning(
+                'Possible N+1 in %s: %s statements, repeated %s times: %s',
+                route_name(), count, repeated, statement)
+        return dict(statements=count, seconds=seconds)
+
+
+#
+# request phases timing
+#
+
+# {phase: seconds} of the current request if it is sampled
+# (a context variable, which is much cheaper to read than g)
+_phases = ContextVar('whalet_phases', default=None)
+_open_span = ContextVar('whalet_span', default=None)
+
+
+@contextmanager
+def span(name: str):
+    '''
+    Add time of the block to given phase of the request
+    (if the request is sampled by RequestTiming)
+    '''
+    phases = _phases.get()
+    if phases is None or _open_span.get() is not None:
+        yield
+        return
+    _open_span.set(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0) + time.perf_counter() - started
+        _open_span.set(None)
+
+
+def timed(name: str):
+    '''
+    Decorator adding time of every call to given phase
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            phases = _phases.get()
+            if phases is None or _open_span.get() is not None:
+                return func(*args, **kwargs)
+            _open_span.set(name)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                phases[name] = phases.get(name, 0) + \
+                    time.perf_counter() - started
+                _open_span.set(None)
+        return wrapper
+    return decorator
+
+
+class RequestTiming:
+    '''
+    Time phases of a share of requests (sample_rate from 0
+    to 1), report them in Server-Timing and, if asked, log
+    them as JSON lines
+    '''
+    def __init__(self, sample_rate: float = 1.0, log_requests=False):
+        self.sample_rate = sample_rate
+        self.log_requests = log_requests
+
+    def start_request(self):
+        _open_span.set(None)
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            _phases.set({})
+        else:
+            _phases.set(None)
+
+    def finish_request(self, status: int, seconds: float) -> dict:
+        '''
+        Phases of the current request (None if not sampled)
+        '''
+        phases = _phases.get()
+        if phases is None:
+            return None
+        _phases.set(None)
+        phases.setdefault('db', query_time())
+        added = {name for name, _, _ in g.get('server_timing', ())}
+        for name, phase_seconds in phases.items():
+            if name not in added:
+                add_timing(name, phase_seconds)
+        add_timing('total', seconds)
+        if self.log_requests:
+            fields = dict(
+                route=route_name(),
+                status=status,
+                total_ms=round(seconds * 1000, 3),
+                **{f'{name}_ms': round(value * 1000, 3)
+                   for name, value in phases.items()}
+            )
+            log.info('Request timing %s', fields, extra=dict(fields=fields))
+        return phases
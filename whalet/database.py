@@ -2,30 +2,78 @@
 Defining database
 '''
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 
 
 class Database:
     '''
-    Create engine on initialization and
-    create session.
+    Create pooled engine on initialization and
+    provide sessions bound to it.
+
+    Database.session is a thread-local scoped session: every
+    request thread gets its own Session, which should be
+    released with Database.session.remove() at request teardown.
     '''
 
     def __init__(
             self,
-            url='sqlite:///./whalet.db'
+            url='sqlite:///./whalet.db',
+            pool_size=5,
+            max_overflow=10,
+            pool_recycle=1800,
+            pool_pre_ping=True,
+            pool_timeout=30
     ):
 
         self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        self.pool_timeout = pool_timeout
         self.engine = self.make_engine()
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.session = scoped_session(self.session_factory)
 
     def make_engine(self):
+        url = make_url(self.url)
+
+        if url.get_backend_name() == 'sqlite':
+            if url.database in (None, '', ':memory:'):
+                # in-memory database exists within one connection only
+                return create_engine(
+                    self.url,
+                    connect_args={'check_same_thread': False},
+                    poolclass=StaticPool
+                )
+            # pysqlite uses NullPool for files by default
+            engine = create_engine(
+                self.url,
+                connect_args={'check_same_thread': False},
+                poolclass=QueuePool,
+                **self.pool_options()
+            )
+            return engine
+
         engine = create_engine(
-            self.url
-            # connect_args={'check_same_thread': False}
+            self.url,
+            **self.pool_options()
         )
         return engine
 
+    def pool_options(self) -> dict:
+        return dict(
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_recycle=self.pool_recycle,
+            pool_pre_ping=self.pool_pre_ping,
+            pool_timeout=self.pool_timeout
+        )
+
     def create_session(self):
-        SessionLocal = sessionmaker(bind=self.engine)
-        return SessionLocal()
+        '''
+        Make a standalone session (not request-scoped)
+        '''
+        return self.session_factory()
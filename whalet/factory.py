@@ -17,5 +17,6 @@ def create_app():
 
     # setting Flask
     app = Flask(__name__)
+    app.config.from_object('whalet.config.settings')
 
     return app
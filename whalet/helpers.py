@@ -3,13 +3,17 @@ Useful functions to leverage responses
 '''
 import json
 from decimal import Decimal
-from math import trunc
 
 from flask import Flask, request
-from sqlalchemy import or_
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import session
 
+from whalet.context import timed
+from whalet.serializers import (WALLET_COLUMNS, dumps, operation_columns,
+                                operations_query)
 
+
+@timed('serialization')
 def cook_response(app: 'Flask', data, format='json'):
     '''
     Slightly modified json.dumps(). Returns
@@ -35,30 +39,17 @@ def cook_response(app: 'Flask', data, format='json'):
     return resp
 
 
-def safe_round(arg: Decimal):
-    '''
-    Truncate given number up to 2 digits after
-    delimiter (without any rounding):
-
-    >>> safe_round(15.0199999999)
-    >>> 15.01
+@timed('serialization')
+def fast_response(app: 'Flask', data):
     '''
-    arg = arg * 100
-    arg = trunc(arg)
-    arg = Decimal(str(arg / 100))
-    return arg
-
-
-def represent(arg: Decimal) -> str:
-    '''
-    Make string from Decimal number, with
-    2 digits after delimiter:
-
-    >>> represent(Decimal('42'))
-    >>> 42.00
+    JSON response for already serialized data
+    (no Decimals), dumped with the fastest JSON
+    backend available (see whalet.serializers)
     '''
-    arg = '{:.2f}'.format(arg)
-    return arg
+    return app.response_class(
+        dumps(data),
+        mimetype="application/json"
+    )
 
 
 def change_sign(result, wallet_name):
@@ -79,19 +70,82 @@ def change_sign(result, wallet_name):
 
 def make_query(
         db: session,
-        wallet_name: str,
-        model: object):
+        wallet_id: int,
+        model: object,
+        columns: tuple = None):
     '''
     Get ordered query object of all operations
+    of given wallet (with wallet names joined)
     '''
-    result = db.query(model).filter(
+    columns = columns or operation_columns(model)
+    result = operations_query(db, columns, model).filter(
         or_(
-            model.sent_to == wallet_name,
-            model.get_from == wallet_name
+            model.sent_to_id == wallet_id,
+            model.get_from_id == wallet_id
         )).order_by(model.time)
     return result
 
 
+def make_history_queries(
+        db: session,
+        wallet_id: int,
+        model: object,
+        columns: tuple = None) -> list:
+    '''
+    Get queries of incoming and outgoing operations.
+    Every query is served by its own (wallet_id, time) index,
+    results are merged by whalet.pagination.fetch_page()
+    '''
+    columns = columns or operation_columns(model)
+    return [
+        operations_query(db, columns, model).filter(
+            model.sent_to_id == wallet_id),
+        operations_query(db, columns, model).filter(
+            model.get_from_id == wallet_id)
+    ]
+
+
+def name_prefix_filter(column, prefix: str):
+    '''
+    Names starting with prefix as a range condition
+    ("name >= 'ab' AND name < 'ac'"), which unlike LIKE
+    is served by an index on every backend
+    '''
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return and_(column >= prefix, column < upper)
+
+
+def make_wallets_query(
+        db: session,
+        model: object,
+        prefix: str = None,
+        columns: tuple = WALLET_COLUMNS):
+    '''
+    Get query of wallet columns (no password hashes),
+    optionally of names starting with prefix
+    '''
+    result = db.query(*columns)
+    if prefix:
+        result = result.filter(name_prefix_filter(model.name, prefix))
+    return result
+
+
+def parse_ndjson(text: str) -> list:
+    '''
+    Parse newline delimited JSON, one document per
+    non-empty line. Unparsable lines become None.
+    '''
+    items = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+
 def shutdown_server():
     func = request.environ.get('werkzeug.server.shutdown')
     if func is None:
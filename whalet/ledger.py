@@ -0,0 +1,373 @@
+'''
+Money movements between wallets.
+
+Every function makes its changes in the current transaction
+of given session and never commits: the caller commits on
+success and rolls back on LedgerError.
+
+Amounts and balances are integer cents (see whalet.money).
+Wallets are passed by name; operations reference them by id,
+names are translated when operation rows are recorded.
+Recorded operations are added to daily statistics (whalet.stats)
+in the same transaction.
+Balances are changed with conditional UPDATE statements
+("balance = balance - :amount WHERE balance >= :amount"), so
+the check and the debit are a single atomic statement on
+both SQLite and PostgreSQL and no update could be lost.
+Credits are guarded the same way against MAX_BALANCE.
+'''
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import bindparam, select, update
+
+from whalet import models, stats
+from whalet.money import MAX_BALANCE, to_str
+
+
+wallets = models.Wallet.__table__
+operations = models.Operation.__table__
+
+# names per IN (...) list, keeps under SQLite parameters limit
+IN_CHUNK_SIZE = 500
+
+
+class LedgerError(Exception):
+    '''
+    Operation could not be applied. Carries HTTP code
+    and message to abort with.
+    '''
+    code = 400
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+
+class WalletNotFound(LedgerError):
+    code = 404
+
+
+class InsufficientFunds(LedgerError):
+    code = 409
+
+
+class BalanceTooLarge(LedgerError):
+    code = 409
+
+
+def supports_returning(session) -> bool:
+    '''
+    Check if UPDATE ... RETURNING could be used
+    '''
+    dialect = session.get_bind().dialect
+    return bool(
+        getattr(dialect, 'update_returning', False)    # SQLAlchemy 2
+        or getattr(dialect, 'full_returning', False)   # SQLAlchemy 1.4
+    )
+
+
+def change_balance(
+        session,
+        wallet_name: str,
+        delta: int,
+        guard: int = None):
+    '''
+    Add delta to wallet balance and return new balance.
+
+    With guard given the row is changed only if balance is
+    not less than guard. Credits are applied only while the
+    balance stays within MAX_BALANCE. Return None if no row
+    was changed.
+    '''
+    statement = update(wallets).where(
+        wallets.c.name == wallet_name
+    ).values(balance=wallets.c.balance + delta)
+    if guard is not None:
+        statement = statement.where(wallets.c.balance >= guard)
+    if delta > 0:
+        statement = statement.where(
+            wallets.c.balance <= MAX_BALANCE - delta)
+
+    if supports_returning(session):
+        return session.execute(
+            statement.returning(wallets.c.balance)).scalar()
+
+    if session.execute(statement).rowcount == 0:
+        return None
+    return session.execute(
+        select(wallets.c.balance).where(
+            wallets.c.name == wallet_name)).scalar()
+
+
+def balance_too_large() -> BalanceTooLarge:
+    return BalanceTooLarge(
+        f'Wallet balance would exceed {to_str(MAX_BALANCE)}')
+
+
+def credit_many(session, credits: dict):
+    '''
+    Add money to several wallets with one executemany
+    UPDATE, rows are changed in wallet name order.
+    Raise BalanceTooLarge if a balance would exceed
+    MAX_BALANCE.
+    '''
+    if not credits:
+        return
+    params = [
+        {'_name': name, '_amount': credits[name]}
+        for name in sorted(credits)
+    ]
+    # some drivers do not count rows of executemany,
+    # their balances are checked after the update
+    dialect = session.get_bind().dialect
+    counted = len(params) == 1 or dialect.supports_sane_multi_rowcount
+
+    statement = update(wallets).where(
+        wallets.c.name == bindparam('_name')
+    ).values(balance=wallets.c.balance + bindparam('_amount'))
+    if counted:
+        statement = statement.where(
+            wallets.c.balance <= MAX_BALANCE - bindparam('_amount'))
+    changed = session.execute(statement, params).rowcount
+
+    if not counted:
+        changed = len(existing_wallets(session, credits))
+        if existing_wallets(session, credits, above=MAX_BALANCE):
+            raise balance_too_large()
+
+    if changed != len(params):
+        missing = set(credits) - existing_wallets(session, credits)
+        if not missing:
+            raise balance_too_large()
+        raise WalletNotFound(
+            f'Wallet {", ".join(sorted(missing))} does not exist')
+
+
+def existing_wallets(session, names, above: int = None) -> set:
+    '''
+    Get which of given wallet names exist (with balance
+    above given one), with one IN query per chunk of names
+    '''
+    names = list(set(names))
+    found = set()
+    for start in range(0, len(names), IN_CHUNK_SIZE):
+        chunk = names[start:start + IN_CHUNK_SIZE]
+        query = select(wallets.c.name).where(wallets.c.name.in_(chunk))
+        if above is not None:
+            query = query.where(wallets.c.balance > above)
+        found.update(session.execute(query).scalars())
+    return found
+
+
+def wallet_ids(session, names) -> dict:
+    '''
+    Map wallet names to ids, unknown names are left out
+    '''
+    names = list(set(names))
+    ids = {}
+    for start in range(0, len(names), IN_CHUNK_SIZE):
+        chunk = names[start:start + IN_CHUNK_SIZE]
+        ids.update(session.execute(
+            select(wallets.c.name, wallets.c.id).where(
+                wallets.c.name.in_(chunk))).all())
+    return ids
+
+
+def balance_for_update(session, wallet_name: str) -> int:
+    '''
+    Read wallet balance locking the row where the
+    backend supports SELECT ... FOR UPDATE
+    '''
+    return session.execute(
+        select(wallets.c.balance).where(
+            wallets.c.name == wallet_name).with_for_update()
+    ).scalar()
+
+
+def record_operations(session, rows: list, known_ids: dict = None):
+    '''
+    Insert operation rows with one executemany INSERT.
+    Rows are dicts of Operation columns with wallet names
+    as sent_to and get_from instead of wallet ids. Ids of
+    names missing in known_ids are looked up.
+    '''
+    if not rows:
+        return
+    ids = dict(known_ids or {})
+    missing = {
+        name for row in rows
+        for name in (row.get('sent_to'), row.get('get_from'))
+        if name and name not in ids
+    }
+    if missing:
+        ids.update(wallet_ids(session, missing))
+    time = datetime.now()
+    values = [
+        dict(
+            id=row.get('id') or models.new_operation_id(),
+            optype=row['optype'],
+            time=row.get('time') or time,
+            amount=row.get('amount'),
+            sent_to_id=ids.get(row.get('sent_to')),
+            get_from_id=ids.get(row.get('get_from'))
+        )
+        for row in rows
+    ]
+    session.execute(operations.insert(), values)
+    stats.add(session, values)
+
+
+def record_operation(
+        session,
+        optype: str,
+        amount: int = None,
+        sent_to: str = None,
+        get_from: str = None):
+    record_operations(session, [dict(
+        optype=optype,
+        amount=amount,
+        sent_to=sent_to,
+        get_from=get_from
+    )])
+
+
+def record_creation(session, wallet: 'models.Wallet'):
+    '''
+    Record creation of a just flushed wallet
+    '''
+    values = [dict(
+        id=models.new_operation_id(),
+        optype='creation',
+        time=datetime.now(),
+        sent_to_id=wallet.id
+    )]
+    session.execute(operations.insert(), values)
+    stats.add(session, values)
+
+
+def deposit(session, wallet_name: str, amount: int) -> int:
+    '''
+    Add money to wallet, return new balance
+    '''
+    balance = change_balance(session, wallet_name, amount)
+    if balance is None:
+        if existing_wallets(session, [wallet_name]):
+            raise balance_too_large()
+        raise WalletNotFound(f'Wallet {wallet_name} does not exist')
+    record_operation(
+        session, 'deposit', amount=amount, sent_to=wallet_name)
+    return balance
+
+
+def deposit_many(session, deposits: list) -> int:
+    '''
+    Add money to many wallets from (wallet_name, amount)
+    pairs, return total deposited
+    '''
+    credits = defaultdict(int)
+    for wallet_name, amount in deposits:
+        credits[wallet_name] += amount
+    credit_many(session, credits)
+
+    record_operations(session, [
+        dict(optype='deposit', amount=amount, sent_to=wallet_name)
+        for wallet_name, amount in deposits
+    ])
+    return sum(credits.values())
+
+
+def transfer(
+        session,
+        from_wallet: str,
+        to_wallet: str,
+        amount: int,
+        operation_id: bytes = None,
+        known_ids: dict = None) -> int:
+    '''
+    Move money between wallets, return new sender balance
+    '''
+    return transfer_many(
+        session, from_wallet, [(to_wallet, amount)],
+        operation_ids=[operation_id] if operation_id else None,
+        known_ids=known_ids)
+
+
+def transfer_many(
+        session,
+        from_wallet: str,
+        payments: list,
+        operation_ids: list = None,
+        known_ids: dict = None) -> int:
+    '''
+    Pay (to_wallet, amount) pairs from one wallet, return
+    new sender balance. Operation ids (16 bytes, e.g. given
+    out by the payment queue) are generated unless passed.
+    Wallet ids already known to the caller (name: id) save
+    a lookup when operations are recorded.
+
+    Sender is debited once with the total, so either every
+    payment fits into its balance or nothing is changed.
+    Rows are always changed in wallet name order, so two
+    transfers running at once lock them in the same order
+    and could not deadlock each other.
+    '''
+    total = sum(amount for _, amount in payments)
+    credits = defaultdict(int)
+    for to_wallet, amount in payments:
+        credits[to_wallet] += amount
+
+    credit_many(session, {
+        name: amount for name, amount in credits.items()
+        if name < from_wallet
+    })
+    balance = change_balance(session, from_wallet, -total, guard=total)
+    if balance is None:
+        raise InsufficientFunds(f'Not enough money in wallet {from_wallet}')
+    credit_many(session, {
+        name: amount for name, amount in credits.items()
+        if name >= from_wallet
+    })
+
+    # paying to oneself: balance after both changes
+    balance += credits.get(from_wallet, 0)
+
+    rows = [
+        dict(
+            optype='transaction',
+            amount=amount,
+            sent_to=to_wallet,
+            get_from=from_wallet
+        )
+        for to_wallet, amount in payments
+    ]
+    if operation_ids:
+        for row, operation_id in zip(rows, operation_ids):
+            row['id'] = operation_id
+    record_operations(session, rows, known_ids)
+    return balance
+
+
+def transfer_fitting(session, from_wallet: str, payments: list) -> tuple:
+    '''
+    Pay (to_wallet, amount) pairs from one wallet in given
+    order while its balance allows, skip the rest. Return new
+    sender balance and indexes of paid pairs.
+
+    Balance is read (and its row locked) in the same
+    transaction as the debit, so the write could be handed
+    to the write batcher as a whole.
+    '''
+    available = balance_for_update(session, from_wallet)
+    if available is None:
+        raise WalletNotFound(f'Wallet {from_wallet} does not exist')
+    paid = []
+    for index, (_, amount) in enumerate(payments):
+        if amount <= available:
+            paid.append(index)
+            available -= amount
+    if not paid:
+        return available, paid
+    balance = transfer_many(
+        session, from_wallet, [payments[index] for index in paid])
+    return balance, paid
@@ -0,0 +1,168 @@
+'''
+Logging pipeline which never stalls a request.
+
+AsyncHandler puts records into a bounded queue, a background
+thread formats and writes them (to stderr by default). When
+the queue is full the record is dropped instead of blocking
+the request; dropped records are counted (exported by
+whalet.metrics). Records are formatted by the writer thread
+only, so messages should be logged lazily, %-style:
+
+    log.info('Paid %s to %s', amount, name)
+
+RateLimitFilter lets through a few records of every message
+per period, so a hot path logging on every request could not
+flood the log. JsonFormatter writes records as JSON lines,
+with fields given as extra=dict(fields={...}) merged in.
+'''
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+
+class _Writer(QueueListener):
+    def enqueue_sentinel(self):
+        # waits for room, unlike records (used on shutdown only)
+        self.queue.put(self._sentinel)
+
+
+class AsyncHandler(QueueHandler):
+    '''
+    Handler queueing records for a background writer.
+
+    The writer thread is started lazily in the process that
+    logs first, so the handler survives gunicorn forking.
+    '''
+    def __init__(self, stream=None, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._dropped_lock = threading.Lock()
+        atexit.register(self.flush_queue)
+
+    def setFormatter(self, fmt):
+        # records are formatted by the writer
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # no formatting in the logging thread; the queue is
+        # in-process, so the record needs no pickling
+        return record
+
+    def enqueue(self, record):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.maxsize)
+            self._listener = _Writer(self.queue, self.target)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def flush_queue(self):
+        '''
+        Write all queued records and stop the writer
+        '''
+        with self._start_lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def close(self):
+        self.flush_queue()
+        self.target.close()
+        super().close()
+
+
+def async_handlers(logger: logging.Logger = None) -> list:
+    '''
+    AsyncHandlers of given logger (root by default)
+    '''
+    logger = logger or logging.getLogger()
+    return [h for h in logger.handlers if isinstance(h, AsyncHandler)]
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Let through at most burst records of every message (same
+    logger and format string) per period seconds. Records of
+    level and above always pass. Number of records dropped
+    in the last period is given to the next passing record
+    as its "suppressed" attribute.
+    '''
+    # messages tracked at most (format strings are few,
+    # unless messages are formatted eagerly)
+    MAX_MESSAGES = 1000
+
+    def __init__(self, burst: int = 10, period: float = 1.0,
+                 level=logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.level = level if isinstance(level, int) \
+            else logging.getLevelName(level)
+        self._windows = {}   # (logger, msg): [started, passed, dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        if record.levelno >= self.level:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                if len(self._windows) >= self.MAX_MESSAGES:
+                    self._windows.clear()
+                self._windows[key] = [now, 1, 0]
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Record as one JSON line
+    '''
+    def format(self, record) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage()
+        }
+        # structured data given as extra=dict(fields={...})
+        entry.update(getattr(record, 'fields', None) or {})
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
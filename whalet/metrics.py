@@ -0,0 +1,431 @@
+'''
+Metrics registry and Prometheus text exposition.
+
+Counters and histograms are kept in memory of the process;
+recording a value costs a dict lookup and an addition under
+a per-metric lock. Gauges (and counters kept elsewhere, like
+auth cache hits) are read from callbacks when collected.
+
+With several gunicorn workers every worker has its own
+registry. Given a directory, FileExporter writes a snapshot
+of the worker registry there every few seconds (and when
+/metrics is served), and the worker serving /metrics sums
+snapshots of all workers. Counters and histograms of exited
+workers are kept, so totals never go back; gauges of exited
+workers are dropped. The directory should be emptied when
+the server is (re)started.
+'''
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+
+from whalet import logs
+from whalet.context import statement_seconds, time_statements
+
+
+# seconds
+REQUEST_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    '''
+    Values of one metric by label values. Metrics with a
+    function get {label values: value} from it on collect.
+    '''
+    kind = None
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: tuple = (),
+            function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def samples(self) -> dict:
+        if self.function is not None:
+            return dict(self.function())
+        with self._lock:
+            return dict(self.values)
+
+    def collect(self) -> dict:
+        return dict(
+            kind=self.kind, help=self.help, labels=self.labels,
+            samples=[[list(key), value]
+                     for key, value in self.samples().items()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    '''
+    Values are [bucket counts (the last one is +Inf), sum]
+    '''
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: tuple = REQUEST_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self) -> dict:
+        with self._lock:
+            return {key: [list(counts), total]
+                    for key, (counts, total) in self.values.items()}
+
+    def collect(self) -> dict:
+        return dict(super().collect(), buckets=self.buckets)
+
+
+class Registry:
+    '''
+    Metrics of one process by name
+    '''
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=(), function=None) -> Counter:
+        return self._add(Counter(name, help, labels, function))
+
+    def gauge(self, name, help, labels=(), function=None) -> Gauge:
+        return self._add(Gauge(name, help, labels, function))
+
+    def histogram(
+            self, name, help, labels=(),
+            buckets=REQUEST_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets=buckets))
+
+    def collect(self) -> dict:
+        '''
+        JSON-serializable snapshot of all metrics
+        '''
+        return {name: metric.collect()
+                for name, metric in self.metrics.items()}
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def merge(snapshots: list) -> dict:
+    '''
+    Sum snapshots of several processes, given as
+    (pid, snapshot, alive) triples
+    '''
+    merged = {}
+    for pid, snapshot, alive in snapshots:
+        for name, family in snapshot.items():
+            if family['kind'] == 'gauge' and not alive:
+                continue
+            target = merged.setdefault(
+                name, dict(family, samples={}))
+            samples = target['samples']
+            for key, value in family['samples']:
+                key = tuple(key)
+                if family['kind'] == 'histogram':
+                    counts, total = samples.get(
+                        key, [[0] * len(value[0]), 0])
+                    samples[key] = [
+                        [a + b for a, b in zip(counts, value[0])],
+                        total + value[1]]
+                else:
+                    samples[key] = samples.get(key, 0) + value
+    for family in merged.values():
+        family['samples'] = [
+            [list(key), value] for key, value in family['samples'].items()]
+    return merged
+
+
+class FileExporter:
+    '''
+    Periodic snapshots of a registry in a directory
+    shared by the workers. The flushing thread is started
+    lazily in the worker, so it survives gunicorn forking.
+    '''
+    def __init__(self, registry: Registry, directory: str, interval=5):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, pid: int) -> str:
+        return os.path.join(self.directory, f'metrics-{pid}.json')
+
+    def flush(self):
+        '''
+        Write snapshot of this worker (atomically)
+        '''
+        pid = os.getpid()
+        temporary = self.path(pid) + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.registry.collect(), file)
+        os.replace(temporary, self.path(pid))
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(
+                target=self._loop, name='whalet-metrics-flush',
+                daemon=True).start()
+            self._pid = os.getpid()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self) -> dict:
+        '''
+        Sum of snapshots of all workers
+        '''
+        self.flush()
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith('metrics-')
+                    and filename.endswith('.json')):
+                continue
+            pid = int(filename[len('metrics-'):-len('.json')])
+            try:
+                with open(os.path.join(self.directory, filename)) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            snapshots.append((pid, snapshot, _alive(pid)))
+        return merge(snapshots)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace(
+        '\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value) -> str:
+    if isinstance(value, float):
+        return repr(value) if value != float('inf') else '+Inf'
+    return str(value)
+
+
+def render(families: dict) -> str:
+    '''
+    Prometheus text exposition (version 0.0.4) of collected
+    metrics (Registry.collect() or FileExporter.collect())
+    '''
+    lines = []
+    for name, family in sorted(families.items()):
+        lines.append(f'# HELP {name} {_escape(family["help"])}')
+        lines.append(f'# TYPE {name} {family["kind"]}')
+        names = family['labels']
+        for key, value in sorted(family['samples']):
+            if family['kind'] != 'histogram':
+                lines.append(
+                    f'{name}{_labels(names, key)} {_number(value)}')
+                continue
+            counts, total = value
+            cumulative = 0
+            bounds = [_number(float(b)) for b in family['buckets']]
+            for bound, count in zip(bounds + ['+Inf'], counts):
+                cumulative += count
+                le = 'le="' + bound + '"'
+                lines.append(
+                    f'{name}_bucket{_labels(names, key, le)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(names, key)} '
+                         f'{_number(float(total))}')
+            lines.append(f'{name}_count{_labels(names, key)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+#
+# metrics of the app
+#
+class AppMetrics:
+    '''
+    Request, SQL and password check metrics of the app
+    '''
+    def __init__(self, directory: str = None, flush_interval=5):
+        self.registry = registry = Registry()
+        self.exporter = None
+        if directory:
+            self.exporter = FileExporter(registry, directory, flush_interval)
+        self.requests = registry.counter(
+            'whalet_requests_total', 'Requests served',
+            ('route', 'method', 'status'))
+        self.latency = registry.histogram(
+            'whalet_request_duration_seconds', 'Request handling time',
+            ('route',))
+        self.statements = registry.counter(
+            'whalet_db_statements_total', 'SQL statements of requests',
+            ('route',))
+        self.statement_time = registry.histogram(
+            'whalet_db_statement_duration_seconds',
+            'SQL statement execution time', buckets=QUERY_BUCKETS)
+        self.password_time = registry.histogram(
+            'whalet_password_verify_seconds',
+            'Password hash verification time', buckets=REQUEST_BUCKETS)
+
+    def observe_request(
+            self,
+            route: str,
+            method: str,
+            status: int,
+            seconds: float,
+            statements: int = 0):
+        if self.exporter is not None:
+            self.exporter.ensure_started()
+        self.requests.inc(route, method, str(status))
+        self.latency.observe(seconds, route)
+        if statements:
+            self.statements.inc(route, amount=statements)
+
+    def instrument_engine(self, engine):
+        '''
+        Time every statement executed on given engine
+        '''
+        def statement_done(conn, cursor, statement, parameters,
+                           execution, executemany):
+            seconds = statement_seconds(execution)
+            if seconds is not None:
+                self.statement_time.observe(seconds)
+
+        time_statements(engine)
+        event.listen(engine, 'after_cursor_execute', statement_done)
+
+    def watch_pool(self, pool):
+        '''
+        Connection pool gauges (QueuePool only)
+        '''
+        if not hasattr(pool, 'checkedout'):
+            return
+
+        def connections():
+            return {
+                ('size',): pool.size(),
+                ('checked_in',): pool.checkedin(),
+                ('checked_out',): pool.checkedout(),
+                ('overflow',): max(pool.overflow(), 0)
+            }
+        self.registry.gauge(
+            'whalet_db_pool_connections', 'Database pool connections',
+            ('state',), function=connections)
+
+    def watch_cache(self, cache):
+        '''
+        Auth credential cache counters
+        '''
+        self.registry.counter(
+            'whalet_auth_cache_hits_total', 'Credentials found in cache',
+            function=lambda: {(): cache.stats()['hits']})
+        self.registry.counter(
+            'whalet_auth_cache_misses_total',
+            'Credentials not found in cache',
+            function=lambda: {(): cache.stats()['misses']})
+        self.registry.gauge(
+            'whalet_auth_cache_entries', 'Credentials in cache',
+            function=lambda: {(): cache.stats()['size']})
+
+    def watch_hasher(self, hasher):
+        '''
+        Password hashes refused by the bounded hashing pool
+        '''
+        self.registry.counter(
+            'whalet_password_hash_rejected_total',
+            'Password hashes refused as too many were running',
+            function=lambda: {(): hasher.stats()['rejected']})
+
+    def watch_logs(self, logger=None):
+        '''
+        Log records dropped by full AsyncHandler queues of given
+        logger (root by default), handlers are looked up on collect
+        '''
+        def dropped():
+            return {(): sum(h.dropped for h in logs.async_handlers(logger))}
+        self.registry.counter(
+            'whalet_log_records_dropped_total',
+            'Log records dropped as the log queue was full',
+            function=dropped)
+
+    def watch_batcher(self, batcher):
+        '''
+        Write batcher counters
+        '''
+        for name, help in (
+                ('batches', 'Write batches committed'),
+                ('writes', 'Writes applied in batches'),
+                ('replays', 'Write batches replayed one by one')):
+            self.registry.counter(
+                f'whalet_write_batcher_{name}_total', help,
+                function=lambda name=name: {(): getattr(batcher, name)})
+
+    def render(self) -> str:
+        '''
+        Metrics of all workers in Prometheus text format
+        '''
+        if self.exporter is not None:
+            return render(self.exporter.collect())
+        return render(self.registry.collect())
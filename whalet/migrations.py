@@ -0,0 +1,270 @@
+'''
+Versioned schema migrations.
+
+Base.metadata.create_all() only creates missing tables, it never
+touches tables that exist already. Changes to existing tables
+(indexes, column types) are made here as numbered steps. The
+number of the last applied step is kept in the schema_version
+table.
+
+A fresh database is created from the models directly and stamped
+with the latest version. Run manually with:
+
+    python -m whalet.migrations <database url>
+'''
+import logging
+import sys
+import uuid
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, text
+
+
+log = logging.getLogger(__name__)
+
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, nullable=False)
+)
+
+# (version, description, function) in order of versions
+MIGRATIONS = []
+
+# rows per statement when data is copied between tables
+MIGRATION_BATCH_SIZE = 1000
+
+
+def migration(version: int, description: str):
+    '''
+    Register decorated function as migration step.
+    Function gets a connection inside a transaction.
+    '''
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda step: step[0])
+        return func
+    return decorator
+
+
+def head() -> int:
+    '''
+    Latest known schema version
+    '''
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(connection) -> int:
+    version = connection.execute(
+        schema_version.select()).scalar()
+    return version or 0
+
+
+def set_version(connection, version: int):
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def upgrade(engine, metadata) -> int:
+    '''
+    Bring database schema up to date, return resulting version.
+    '''
+    with engine.begin() as connection:
+        fresh = not inspect(connection).has_table('Wallets')
+        version_metadata.create_all(connection)
+
+        if fresh:
+            metadata.create_all(connection)
+            set_version(connection, head())
+            log.info('Created fresh database, schema version %s', head())
+            return head()
+
+        version = current_version(connection)
+
+    for step, description, func in MIGRATIONS:
+        if step <= version:
+            continue
+        log.info('Applying migration %s: %s', step, description)
+        with engine.begin() as connection:
+            func(connection)
+            set_version(connection, step)
+        version = step
+
+    # tables added to models after the last migration
+    metadata.create_all(engine)
+    return version
+
+
+#
+# Migration steps
+#
+@migration(1, 'indexes for wallet names and operation history')
+def add_lookup_indexes(connection):
+    connection.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_Wallets_name" '
+        'ON "Wallets" (name)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS "ix_Operations_sent_to_time" '
+        'ON "Operations" (sent_to, time)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS "ix_Operations_get_from_time" '
+        'ON "Operations" (get_from, time)'))
+
+
+@migration(2, 'integer cents for balances and amounts')
+def money_to_cents(connection):
+    columns = [
+        ('Wallets', 'balance'),
+        ('Operations', 'amount'),
+        ('PaymentQueue', 'amount')
+    ]
+    existing = inspect(connection)
+    for table, column in columns:
+        if not existing.has_table(table):
+            continue
+        if connection.dialect.name == 'sqlite':
+            # column types are not enforced, converting values only
+            connection.execute(text(
+                f'UPDATE "{table}" SET {column} = '
+                f'CAST(ROUND({column} * 100) AS INTEGER)'))
+        else:
+            connection.execute(text(
+                f'ALTER TABLE "{table}" ALTER COLUMN {column} '
+                f'TYPE BIGINT USING ROUND({column} * 100)'))
+
+
+@migration(3, 'wallet ids and binary ids in operations')
+def operations_to_wallet_ids(connection):
+    binary = 'BYTEA' if connection.dialect.name == 'postgresql' else 'BLOB'
+    connection.execute(text(
+        f'CREATE TABLE "Operations_new" ('
+        f'id {binary} NOT NULL PRIMARY KEY, '
+        f'optype VARCHAR(20), time TIMESTAMP, amount BIGINT, '
+        f'sent_to_id INTEGER REFERENCES "Wallets" (id), '
+        f'get_from_id INTEGER REFERENCES "Wallets" (id))'))
+
+    # copy in batches of old ids, names resolved by joins
+    select_batch = text(
+        'SELECT o.id, o.optype, o.time, o.amount, s.id, g.id '
+        'FROM "Operations" o '
+        'LEFT JOIN "Wallets" s ON s.name = o.sent_to '
+        'LEFT JOIN "Wallets" g ON g.name = o.get_from '
+        'WHERE o.id > :last ORDER BY o.id LIMIT :size')
+    insert = text(
+        'INSERT INTO "Operations_new" '
+        '(id, optype, time, amount, sent_to_id, get_from_id) '
+        'VALUES (:id, :optype, :time, :amount, :sent_to_id, :get_from_id)')
+    last = ''
+    while True:
+        rows = connection.execute(
+            select_batch, dict(last=last, size=MIGRATION_BATCH_SIZE)).all()
+        if not rows:
+            break
+        connection.execute(insert, [
+            dict(
+                id=_operation_id(op_id), optype=optype, time=time,
+                amount=amount, sent_to_id=sent_to_id,
+                get_from_id=get_from_id)
+            for op_id, optype, time, amount, sent_to_id, get_from_id in rows
+        ])
+        last = rows[-1][0]
+
+    connection.execute(text('DROP TABLE "Operations"'))
+    connection.execute(text(
+        'ALTER TABLE "Operations_new" RENAME TO "Operations"'))
+    connection.execute(text(
+        'CREATE INDEX "ix_Operations_sent_to_id_time" '
+        'ON "Operations" (sent_to_id, time)'))
+    connection.execute(text(
+        'CREATE INDEX "ix_Operations_get_from_id_time" '
+        'ON "Operations" (get_from_id, time)'))
+
+
+@migration(4, 'index for wallets listing by balance')
+def add_balance_index(connection):
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS "ix_Wallets_balance_id" '
+        'ON "Wallets" (balance, id)'))
+
+
+@migration(5, 'daily statistics of wallets')
+def add_daily_stats(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS "DailyStats" ('
+        'wallet_id INTEGER NOT NULL REFERENCES "Wallets" (id), '
+        'day DATE NOT NULL, deposited BIGINT, received BIGINT, '
+        'sent BIGINT, operations INTEGER, '
+        'PRIMARY KEY (wallet_id, day))'))
+
+    # backfill: both sides of every operation summed by day
+    if connection.dialect.name == 'sqlite':
+        day = 'date(time)'
+    else:
+        day = 'CAST(time AS DATE)'
+    connection.execute(text(
+        f'INSERT INTO "DailyStats" '
+        f'(wallet_id, day, deposited, received, sent, operations) '
+        f'SELECT wallet_id, day, SUM(deposited), SUM(received), '
+        f'SUM(sent), SUM(operations) FROM ('
+        f'SELECT sent_to_id AS wallet_id, {day} AS day, '
+        f"CASE WHEN optype = 'deposit' THEN amount ELSE 0 END "
+        f'AS deposited, '
+        f"CASE WHEN optype = 'transaction' THEN amount ELSE 0 END "
+        f'AS received, '
+        f'0 AS sent, 1 AS operations '
+        f'FROM "Operations" '
+        f'WHERE sent_to_id IS NOT NULL AND time IS NOT NULL '
+        f'UNION ALL '
+        f'SELECT get_from_id, {day}, 0, 0, amount, '
+        f'CASE WHEN sent_to_id = get_from_id THEN 0 ELSE 1 END '
+        f'FROM "Operations" '
+        f'WHERE get_from_id IS NOT NULL AND time IS NOT NULL'
+        f') AS sides GROUP BY wallet_id, day'))
+
+
+@migration(6, 'longer password hashes')
+def widen_password_hash(connection):
+    # sqlite does not enforce VARCHAR lengths
+    if connection.dialect.name != 'sqlite':
+        connection.execute(text(
+            'ALTER TABLE "Wallets" ALTER COLUMN password_hash '
+            'TYPE VARCHAR(255)'))
+
+
+@migration(7, 'claims of queued payments')
+def add_payment_claims(connection):
+    if not inspect(connection).has_table('PaymentQueue'):
+        return   # created from the model
+    connection.execute(text(
+        'ALTER TABLE "PaymentQueue" ADD COLUMN claimed_by VARCHAR(32)'))
+    connection.execute(text(
+        'ALTER TABLE "PaymentQueue" ADD COLUMN claimed_at TIMESTAMP'))
+
+
+@migration(8, 'index for queued payments by sender')
+def add_payment_sender_index(connection):
+    if not inspect(connection).has_table('PaymentQueue'):
+        return   # created from the model
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS "ix_PaymentQueue_get_from_status" '
+        'ON "PaymentQueue" (get_from, status)'))
+
+
+def _operation_id(value: str) -> bytes:
+    '''
+    Binary form of an old operation id. UUIDs given out
+    by API are kept, anything else gets a new id.
+    '''
+    try:
+        return uuid.UUID(value).bytes
+    except ValueError:
+        return uuid.uuid4().bytes
+
+
+if __name__ == '__main__':
+    from whalet import models
+    from whalet.database import Database
+
+    logging.basicConfig(level=logging.INFO)
+    url = sys.argv[1] if len(sys.argv) > 1 else 'sqlite:///./whalet.db'
+    version = upgrade(Database(url).engine, models.Base.metadata)
+    print(f'Schema version: {version}')
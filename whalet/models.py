@@ -1,54 +1,173 @@
+import os
+import threading
+import time
 import uuid
 
-from sqlalchemy import Column, Integer, Numeric, String
-from sqlalchemy.types import DateTime
+from sqlalchemy import (BigInteger, Column, ForeignKey, Index, Integer,
+                        LargeBinary, String)
+from sqlalchemy.types import Date, DateTime
 from sqlalchemy.ext.declarative import declarative_base
-from werkzeug.security import generate_password_hash, check_password_hash
 
 
 Base = declarative_base()
 
 
+# (unix time in ms, sequence) of the last operation id
+_last_id = [0, 0]
+_id_lock = threading.Lock()
+
+
+def new_operation_id() -> bytes:
+    '''
+    Time-ordered 16-byte UUID (version 7: unix time in ms,
+    a 12-bit sequence, random bits), so new operations are
+    appended at the end of the primary key index. Ids made
+    by one process are strictly increasing.
+    '''
+    with _id_lock:
+        ms = time.time_ns() // 1000000
+        if ms > _last_id[0]:
+            seq = 0
+        else:
+            ms, seq = _last_id[0], _last_id[1] + 1
+            if seq > 0xfff:
+                ms, seq = ms + 1, 0
+        _last_id[:] = ms, seq
+    rand = int.from_bytes(os.urandom(8), 'big')
+    value = (
+        ms << 80
+        | 0x7 << 76                          # version
+        | seq << 64
+        | 0b10 << 62                         # variant
+        | rand & (1 << 62) - 1
+    )
+    return value.to_bytes(16, 'big')
+
+
+def format_operation_id(value: bytes) -> str:
+    '''
+    Operation id in API (UUID) format
+    '''
+    h = value.hex()
+    return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+
+def parse_operation_id(value: str) -> bytes:
+    '''
+    Operation id from API format, None if malformed
+    '''
+    try:
+        return uuid.UUID(value).bytes
+    except ValueError:
+        return None
+
+
 class Operation(Base):
 
     __tablename__ = 'Operations'
+    __table_args__ = (
+        # history lookups: filter by wallet, order by time
+        Index('ix_Operations_sent_to_id_time', 'sent_to_id', 'time'),
+        Index('ix_Operations_get_from_id_time', 'get_from_id', 'time'),
+    )
 
     id = Column(
-        String(36), primary_key=True, default=lambda: str(uuid.uuid4())
+        LargeBinary(16), primary_key=True, default=new_operation_id
     )
     optype = Column(String(20))    # enum?
     time = Column(DateTime)
-    amount = Column(Numeric(10, 2))
+    amount = Column(BigInteger)    # cents
+    sent_to_id = Column(Integer, ForeignKey('Wallets.id'))
+    get_from_id = Column(Integer, ForeignKey('Wallets.id'))
+
+
+class ArchivedOperation(Base):
+    '''
+    Operation moved out of the hot Operations table
+    by whalet.archive, columns are the same
+    '''
+    __tablename__ = 'OperationsArchive'
+    __table_args__ = (
+        Index('ix_OperationsArchive_sent_to_id_time', 'sent_to_id', 'time'),
+        Index(
+            'ix_OperationsArchive_get_from_id_time', 'get_from_id', 'time'),
+    )
+
+    id = Column(LargeBinary(16), primary_key=True)
+    optype = Column(String(20))
+    time = Column(DateTime)
+    amount = Column(BigInteger)    # cents
+    sent_to_id = Column(Integer, ForeignKey('Wallets.id'))
+    get_from_id = Column(Integer, ForeignKey('Wallets.id'))
+
+
+class Checkpoint(Base):
+    '''
+    Carry-forward of archived operations of a wallet: their
+    net sum (cents) and number, up to archived_until
+    '''
+    __tablename__ = 'Checkpoints'
+
+    wallet_id = Column(
+        Integer, ForeignKey('Wallets.id'), primary_key=True)
+    archived_until = Column(DateTime)
+    balance = Column(BigInteger, default=0)
+    operations = Column(Integer, default=0)
+
+
+class DailyStats(Base):
+    '''
+    Per-wallet daily totals of operations (cents), kept
+    up to date by whalet.ledger (see whalet.stats)
+    '''
+    __tablename__ = 'DailyStats'
+
+    wallet_id = Column(
+        Integer, ForeignKey('Wallets.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    deposited = Column(BigInteger, default=0)
+    received = Column(BigInteger, default=0)
+    sent = Column(BigInteger, default=0)
+    operations = Column(Integer, default=0)
+
+
+class QueuedPayment(Base):
+    '''
+    Payment accepted by /v1/pay?async=1 and waiting for
+    whalet.payqueue to apply it. Applied payment becomes an
+    Operation with the same id.
+    '''
+    __tablename__ = 'PaymentQueue'
+    __table_args__ = (
+        Index('ix_PaymentQueue_status_seq', 'status', 'seq'),
+        Index('ix_PaymentQueue_get_from_status', 'get_from', 'status'),
+    )
+
+    seq = Column(Integer, primary_key=True)    # arrival order
+    id = Column(
+        String(36), unique=True,
+        default=lambda: format_operation_id(new_operation_id())
+    )
+    status = Column(String(10), default='queued')
+    amount = Column(BigInteger)    # cents
     sent_to = Column(String(20))
     get_from = Column(String(20))
+    error = Column(String(200))
+    created = Column(DateTime)
+    processed = Column(DateTime)
+    claimed_by = Column(String(32))    # claim token of the processor
+    claimed_at = Column(DateTime)
 
 
 class Wallet(Base):
 
     __tablename__ = 'Wallets'
+    __table_args__ = (
+        # wallets listing sorted by balance
+        Index('ix_Wallets_balance_id', 'balance', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(20))
-    balance = Column((Numeric(10, 2)))
-    password_hash = Column(String(128))
-
-    def hash_password(password) -> str:
-        '''
-        Hashing given password string to store
-        '''
-        hash = generate_password_hash(password)
-        return hash
-
-    def verify_password(session, name, password) -> bool:
-        '''
-        Varifying given password for given wallet name.
-        Argument session (<db> var in whalet.routes)
-        needed.
-        '''
-        wallet = session.query(Wallet).filter(
-            Wallet.name == name).first()
-        result = check_password_hash(
-            pwhash=wallet.password_hash,
-            password=password
-        )
-        return result
+    name = Column(String(20), unique=True, index=True)
+    balance = Column(BigInteger)   # cents
+    password_hash = Column(String(255))   # pbkdf2:sha512 needs 166
@@ -0,0 +1,51 @@
+'''
+Money representation.
+
+Balances and amounts are stored and computed as 64-bit integer
+minor units (cents), so arithmetic, comparisons and SQL
+aggregates are plain integer operations. Conversion happens
+only at the API edge: to_cents() parses request values,
+to_str() formats cents for responses.
+'''
+from decimal import Decimal, InvalidOperation
+
+
+# largest amount of a single operation
+MAX_AMOUNT = 10 ** 15
+
+# largest wallet balance, credits above it are refused by
+# whalet.ledger, so balances stay far below the 64-bit
+# integer ceiling
+MAX_BALANCE = 10 ** 17
+
+
+def to_cents(arg) -> int:
+    '''
+    Parse a number (given as string, int or Decimal) into
+    cents, truncating digits after 2 (without any rounding):
+
+    >>> to_cents('15.0199999999')
+    >>> 1501
+    '''
+    try:
+        value = Decimal(str(arg))
+    except InvalidOperation:
+        raise ValueError(f'Not a number: {arg}')
+    if not value.is_finite():
+        raise ValueError(f'Not a finite number: {arg}')
+    # int() truncates towards zero
+    return int(value.scaleb(2))
+
+
+def to_str(cents: int) -> str:
+    '''
+    Make string from cents, with 2 digits after delimiter:
+
+    >>> to_str(4200)
+    >>> 42.00
+    '''
+    if cents is None:
+        return None
+    sign = '-' if cents < 0 else ''
+    units, rest = divmod(abs(cents), 100)
+    return f'{sign}{units}.{rest:02d}'
@@ -0,0 +1,192 @@
+'''
+Keyset (cursor) pagination.
+
+Pages are read with "WHERE (time, id) > (:time, :id) ORDER BY
+time, id LIMIT :n" instead of OFFSET, so every page costs one
+index range scan no matter how deep the client has paged.
+
+Cursors handed out to clients are opaque urlsafe base64 strings
+with the sort key of the boundary row and paging direction.
+'''
+import base64
+import binascii
+import heapq
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+
+FORWARD = 'next'
+BACKWARD = 'prev'
+
+Page = namedtuple('Page', ['items', 'next', 'prev'])
+
+
+class BadCursor(ValueError):
+    pass
+
+
+def _pack(value):
+    if isinstance(value, datetime):
+        return {'t': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'b': value.hex()}
+    return value
+
+
+def _unpack(value):
+    if isinstance(value, dict) and len(value) == 1:
+        if 't' in value:
+            return datetime.fromisoformat(value['t'])
+        if 'b' in value:
+            return bytes.fromhex(value['b'])
+    if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        return value
+    raise ValueError(f'Bad cursor key value: {value!r}')
+
+
+def key_types(columns: list) -> tuple:
+    '''
+    Python types of sort key values of given columns
+    '''
+    return tuple(col.type.python_type for col in columns)
+
+
+def encode_cursor(key: tuple, direction=FORWARD) -> str:
+    '''
+    Make opaque cursor from sort key of a boundary row
+    '''
+    raw = json.dumps([direction, [_pack(v) for v in key]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, columns: list = None) -> tuple:
+    '''
+    Return (direction, key) pair stored in cursor. With
+    sort columns given, key should have a value of the
+    column type for every column.
+    Raise BadCursor if cursor is malformed.
+    '''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, key = json.loads(base64.urlsafe_b64decode(padded))
+        if direction not in (FORWARD, BACKWARD):
+            raise ValueError(direction)
+        if not isinstance(key, list) or not key:
+            raise ValueError(key)
+        key = tuple(_unpack(v) for v in key)
+    except (ValueError, TypeError, binascii.Error) as exc:
+        raise BadCursor(f'Bad cursor: {cursor}') from exc
+    if columns is not None:
+        types = key_types(columns)
+        if len(key) != len(types) or not all(
+                isinstance(value, kind) and not isinstance(value, bool)
+                for value, kind in zip(key, types)):
+            raise BadCursor(f'Bad cursor: {cursor}')
+    return direction, key
+
+
+def keyset_filter(columns: list, key: tuple, direction=FORWARD):
+    '''
+    Rows strictly after (or before) key in (col_1, col_2, ...)
+    order. The leading column gets a plain range condition
+    so the index could be used for seeking.
+    '''
+    first, *rest = columns
+    value, *rest_values = key
+    if direction == FORWARD:
+        strict, bound = first > value, first >= value
+    else:
+        strict, bound = first < value, first <= value
+    if not rest:
+        return strict
+    return and_(
+        bound,
+        or_(strict,
+            and_(first == value,
+                 keyset_filter(rest, tuple(rest_values), direction)))
+    )
+
+
+def query_columns(query, columns: list) -> list:
+    '''
+    Columns of given query with the same names as given
+    ones, so queries of several tables with the same
+    columns (e.g. hot and archived operations) could be
+    sorted and filtered by one list of columns
+    '''
+    found = {
+        desc['name']: desc['expr'] for desc in query.column_descriptions
+    }
+    return [found.get(col.key, col) for col in columns]
+
+
+def merge_rows(iterables: list, key, reverse=False):
+    '''
+    Merge already sorted row iterables into one sorted stream,
+    skipping duplicates (a row found by several queries).
+    '''
+    previous = None
+    for row in heapq.merge(*iterables, key=key, reverse=reverse):
+        row_key = key(row)
+        if row_key == previous:
+            continue
+        previous = row_key
+        yield row
+
+
+def fetch_page(
+        queries: list,
+        columns: list,
+        limit: int,
+        cursor: str = None) -> Page:
+    '''
+    Read one page of rows ordered by given columns.
+
+    Several queries (e.g. one per index used) could be passed,
+    their results are merged and deduplicated, which lets every
+    query use its own index instead of one OR filter.
+    '''
+    direction, key = FORWARD, None
+    if cursor:
+        direction, key = decode_cursor(cursor, columns)
+
+    def sort_key(row):
+        return tuple(getattr(row, col.key) for col in columns)
+
+    results = []
+    for query in queries:
+        query_cols = query_columns(query, columns)
+        if key is not None:
+            query = query.filter(keyset_filter(query_cols, key, direction))
+        order = [
+            col.asc() if direction == FORWARD else col.desc()
+            for col in query_cols
+        ]
+        results.append(query.order_by(*order).limit(limit + 1).all())
+
+    items = []
+    merged = merge_rows(
+        results, key=sort_key, reverse=(direction == BACKWARD))
+    for row in merged:
+        items.append(row)
+        if len(items) > limit:
+            break
+
+    has_more = len(items) > limit
+    items = items[:limit]
+    if direction == BACKWARD:
+        items.reverse()
+    if not items:
+        return Page(items, None, None)
+
+    first, last = sort_key(items[0]), sort_key(items[-1])
+    if direction == FORWARD:
+        next_cursor = encode_cursor(last, FORWARD) if has_more else None
+        prev_cursor = encode_cursor(first, BACKWARD) if key else None
+    else:
+        next_cursor = encode_cursor(last, FORWARD)
+        prev_cursor = encode_cursor(first, BACKWARD) if has_more else None
+    return Page(items, next_cursor, prev_cursor)
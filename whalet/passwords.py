@@ -0,0 +1,90 @@
+'''
+Password hashing with configured cost.
+
+Hashes are made by werkzeug with the method and salt length set
+in app config (PASSWORD_HASH_METHOD, PASSWORD_SALT_LENGTH), so
+the cost is ours to choose, not fixed by the werkzeug version.
+Hashes made with other settings still verify, and
+needs_rehash() tells the login to store a fresh one.
+
+Key derivation runs in a bounded thread pool (hashlib releases
+the GIL meanwhile). At most workers hashes are computed at once
+and max_pending more wait for a worker; any request beyond that
+gets Busy right away, so a burst of wallet creations or logins
+could not hold every request thread.
+'''
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class Busy(Exception):
+    pass
+
+
+class PasswordHasher:
+    '''
+    Hash and verify passwords in a bounded pool
+    '''
+    def __init__(
+            self,
+            method='pbkdf2:sha256:260000',
+            salt_length=16,
+            workers=4,
+            max_pending=16):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def hash(self, password: str) -> str:
+        '''
+        Hash of password made with configured method
+        '''
+        return self._run(
+            generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        '''
+        True if hash was made with other method or salt length
+        '''
+        method, salt, _ = password_hash.split('$', 2) \
+            if password_hash.count('$') >= 2 else ('', '', '')
+        return method != self.method or len(salt) != self.salt_length
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'rejected': self.rejected
+        }
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise Busy('Too many password checks at once, retry later')
+        try:
+            return self._ensure_started().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def _ensure_started(self) -> ThreadPoolExecutor:
+        # a new pool in every forked worker
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix='whalet-hashing')
+                    self._pid = os.getpid()
+        return self._executor
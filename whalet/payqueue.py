@@ -0,0 +1,344 @@
+'''
+Asynchronous payment queue.
+
+/v1/pay?async=1 stores a payment in the PaymentQueue table and
+answers 202 right away. PaymentProcessor applies queued payments
+in the background:
+
+- payments are claimed in arrival order, a batch at a time,
+  so several processors could share the queue; a sender with
+  payments claimed by one processor is skipped by the others
+- a batch is split by sender, senders are processed in parallel
+  by a thread pool, payments of one sender strictly in order
+- all payments of a sender are applied in one transaction,
+  together with their queue status; if any of them fails, they
+  are replayed one by one so only the failing one is rejected
+
+Run it as a separate process (or several of them):
+
+    python -m whalet.payqueue
+
+or start it inside the app with PAYMENT_QUEUE_WORKERS > 0
+(single-worker deployments only).
+'''
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from sqlalchemy import exists, func, or_, select, update
+
+from whalet import ledger, models
+
+
+log = logging.getLogger(__name__)
+
+queued = models.QueuedPayment.__table__
+
+QUEUED = 'queued'
+PROCESSING = 'processing'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    pass
+
+
+def depth(session) -> int:
+    '''
+    Number of payments waiting in queue
+    '''
+    return session.execute(
+        select(func.count()).select_from(queued).where(
+            queued.c.status.in_((QUEUED, PROCESSING)))
+    ).scalar()
+
+
+def enqueue(
+        session,
+        from_wallet: str,
+        to_wallet: str,
+        amount: int,
+        max_depth: int) -> str:
+    '''
+    Put payment in queue (without commit), return its id.
+    Raise QueueFull if max_depth payments are waiting already.
+    '''
+    if depth(session) >= max_depth:
+        raise QueueFull(f'Payment queue is full ({max_depth})')
+    payment = models.QueuedPayment(
+        status=QUEUED,
+        amount=amount,
+        sent_to=to_wallet,
+        get_from=from_wallet,
+        created=datetime.now()
+    )
+    session.add(payment)
+    session.flush()
+    return payment.id
+
+
+class ClaimLost(Exception):
+    '''
+    Payment was requeued and claimed by another processor
+    '''
+
+
+class PaymentProcessor:
+    '''
+    Background pool applying queued payments.
+
+    Every batch is claimed with a token of its own and only
+    rows carrying the token are processed, so several
+    processors could share one queue. Claims older than lease
+    seconds are given back to the queue (their processor is
+    considered dead); status of a payment is changed only
+    while the claim is held, so a payment requeued meanwhile
+    is never applied twice.
+    '''
+    def __init__(
+            self,
+            session_factory,
+            workers=4,
+            batch_size=500,
+            poll_interval=0.2,
+            lease=300):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.applied = 0
+        self.failed = 0
+        self._counter_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool = None
+
+    def start(self):
+        '''
+        Run processor in a background thread
+        '''
+        self._thread = threading.Thread(
+            target=self.run, name='whalet-payqueue', daemon=True)
+        self._thread.start()
+
+    def run(self):
+        '''
+        Process queue in current thread until stopped
+        '''
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix='whalet-payqueue')
+        requeued_at = 0
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() - requeued_at >= self.lease / 2:
+                    self.requeue_stale()
+                    requeued_at = time.monotonic()
+                processed = self.process_once(self._pool)
+            except Exception:
+                log.exception('Payment queue batch failed')
+                processed = 0
+            if not processed:
+                self._stop.wait(self.poll_interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._pool:
+            self._pool.shutdown()
+
+    def requeue_stale(self) -> int:
+        '''
+        Give back payments claimed longer than lease seconds
+        ago by a processor which died before applying them,
+        return their number
+        '''
+        expired = datetime.now() - timedelta(seconds=self.lease)
+        session = self.session_factory()
+        try:
+            requeued = session.execute(
+                update(queued).where(
+                    queued.c.status == PROCESSING,
+                    or_(queued.c.claimed_at.is_(None),
+                        queued.c.claimed_at < expired)
+                ).values(status=QUEUED, claimed_by=None, claimed_at=None)
+            ).rowcount
+            session.commit()
+        finally:
+            session.close()
+        if requeued:
+            log.warning('Requeued %s stale queued payments', requeued)
+        return requeued
+
+    def process_once(self, pool=None) -> int:
+        '''
+        Claim and apply one batch, return its size
+        '''
+        batch = self.claim()
+        if not batch:
+            return 0
+
+        # payments of one sender go to one thread, in order
+        batch.sort(key=lambda p: (p.get_from, p.seq))
+        groups = [
+            list(payments)
+            for _, payments in groupby(batch, key=lambda p: p.get_from)
+        ]
+        if pool is None:
+            for group in groups:
+                self.apply_group(group)
+        else:
+            list(pool.map(self.apply_group, groups))
+        return len(batch)
+
+    def claim(self) -> list:
+        '''
+        Mark the oldest queued payments with a new claim token,
+        return the rows carrying the token.
+
+        A payment is claimed only when no earlier payment of its
+        sender is left in queue or processed under another claim,
+        so payments of one sender are never applied by two
+        processors at once (nor out of order).
+        '''
+        token = uuid.uuid4().hex
+        earlier = queued.alias('earlier')
+        same_sender = [
+            earlier.c.get_from == queued.c.get_from,
+            earlier.c.seq < queued.c.seq
+        ]
+        session = self.session_factory()
+        try:
+            # rows locked by another claim are skipped (PostgreSQL)
+            seqs = session.execute(
+                select(queued.c.seq).where(
+                    queued.c.status == QUEUED,
+                    ~exists().where(
+                        *same_sender, earlier.c.status == PROCESSING)
+                ).order_by(queued.c.seq).limit(
+                    self.batch_size
+                ).with_for_update(skip_locked=True)
+            ).scalars().all()
+            if not seqs:
+                session.commit()
+                return []
+
+            # earlier payments skipped above (being claimed by
+            # another processor right now) hold their sender back
+            claimed = session.execute(
+                update(queued).where(
+                    queued.c.seq.in_(seqs),
+                    queued.c.status == QUEUED,
+                    ~exists().where(
+                        *same_sender,
+                        earlier.c.status.in_((QUEUED, PROCESSING)),
+                        earlier.c.seq.not_in(seqs))
+                ).values(
+                    status=PROCESSING, claimed_by=token,
+                    claimed_at=datetime.now())
+            ).rowcount
+            session.commit()
+            if not claimed:
+                return []
+            return session.execute(
+                select(queued).where(queued.c.claimed_by == token)
+            ).all()
+        finally:
+            session.close()
+
+    def apply_group(self, group: list):
+        session = self.session_factory()
+        try:
+            try:
+                for payment in group:
+                    self._apply(session, payment)
+                session.commit()
+                self._count(applied=len(group))
+                return
+            except Exception:
+                session.rollback()
+
+            for payment in group:
+                try:
+                    self._apply(session, payment)
+                    session.commit()
+                    self._count(applied=1)
+                except ClaimLost:
+                    session.rollback()
+                    log.warning(
+                        'Queued payment %s was claimed by another '
+                        'processor', payment.id)
+                except ledger.LedgerError as exc:
+                    session.rollback()
+                    self._fail(session, payment, exc.message)
+                except Exception:
+                    session.rollback()
+                    log.exception('Queued payment %s failed', payment.id)
+                    self._fail(session, payment, 'Internal error')
+        finally:
+            session.close()
+
+    def _apply(self, session, payment):
+        # claim is checked (and queue row locked) first
+        self._set_status(session, payment, DONE)
+        ledger.transfer(
+            session, payment.get_from, payment.sent_to,
+            payment.amount,
+            operation_id=models.parse_operation_id(payment.id))
+
+    def _fail(self, session, payment, error: str):
+        try:
+            self._set_status(session, payment, FAILED, error=error)
+        except ClaimLost:
+            session.rollback()
+            return
+        session.commit()
+        self._count(failed=1)
+
+    def _count(self, applied=0, failed=0):
+        with self._counter_lock:
+            self.applied += applied
+            self.failed += failed
+
+    def _set_status(self, session, payment, status, error=None):
+        '''
+        Change status of a payment claimed by this processor,
+        raise ClaimLost if the claim is not held anymore
+        '''
+        changed = session.execute(
+            update(queued).where(
+                queued.c.seq == payment.seq,
+                queued.c.status == PROCESSING,
+                queued.c.claimed_by == payment.claimed_by
+            ).values(
+                status=status, error=error, processed=datetime.now())
+        ).rowcount
+        if not changed:
+            raise ClaimLost(payment.id)
+
+
+if __name__ == '__main__':
+    from whalet.database import Database
+    from whalet.factory import create_app
+
+    app = create_app()
+    dbase = Database(url=os.environ.get(
+        'DATABASE_URI', 'sqlite:///./whalet.db'))
+    processor = PaymentProcessor(
+        dbase.session_factory,
+        workers=app.config['PAYMENT_QUEUE_WORKERS'] or 4,
+        batch_size=app.config['PAYMENT_QUEUE_BATCH_SIZE'],
+        lease=app.config['PAYMENT_QUEUE_LEASE'])
+    app.logger.info('Processing payment queue...')
+    try:
+        processor.run()
+    except KeyboardInterrupt:
+        processor.stop()
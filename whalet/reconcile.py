@@ -0,0 +1,202 @@
+'''
+Ledger reconciliation.
+
+Rebuilds every wallet balance from its operations (deposits and
+incoming transfers minus outgoing transfers, plus the checkpoint
+of operations archived by whalet.archive) and compares it with
+the stored Wallet.balance. Wallets are split into id ranges, every
+range is summed by the database with one GROUP BY query and ranges
+are checked in parallel by a process pool, so memory depends on
+the range size only, not on the number of operations.
+
+    python -m whalet.reconcile [--workers N] [--range-size N]
+                               [--report FILE] [--repair]
+
+Database is taken from DATABASE_URI (sqlite:///./whalet.db by
+default). With --repair wallets found to drift get the rebuilt
+balance, unless their balance changed since it was checked.
+Writes made while a range is checked could be reported as drift,
+run it at a quiet time or check reported wallets again.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import text
+
+from whalet.database import Database
+from whalet.money import to_str
+
+
+# wallets summed by one query
+RANGE_SIZE = 10000
+
+EXPECTED_BALANCES = text(
+    'SELECT wallet_id, SUM(delta) FROM ('
+    'SELECT sent_to_id AS wallet_id, amount AS delta FROM "Operations" '
+    'WHERE sent_to_id >= :low AND sent_to_id < :high '
+    'AND amount IS NOT NULL '
+    'UNION ALL '
+    'SELECT get_from_id, -amount FROM "Operations" '
+    'WHERE get_from_id >= :low AND get_from_id < :high '
+    'AND amount IS NOT NULL '
+    'UNION ALL '
+    'SELECT wallet_id, balance FROM "Checkpoints" '
+    'WHERE wallet_id >= :low AND wallet_id < :high'
+    ') AS deltas GROUP BY wallet_id')
+
+STORED_BALANCES = text(
+    'SELECT id, name, balance FROM "Wallets" '
+    'WHERE id >= :low AND id < :high')
+
+# engines of worker processes by url
+_databases = {}
+
+
+def _forget_databases():
+    '''
+    Drop engines inherited from the parent process
+    (their connections are not usable after fork)
+    '''
+    for dbase in _databases.values():
+        dbase.engine.dispose(close=False)
+    _databases.clear()
+
+
+def wallet_ranges(engine, size: int = RANGE_SIZE) -> list:
+    '''
+    Split wallet ids into [low, high) ranges
+    '''
+    with engine.connect() as conn:
+        low, high = conn.execute(
+            text('SELECT MIN(id), MAX(id) FROM "Wallets"')).one()
+    if low is None:
+        return []
+    return [
+        (start, min(start + size, high + 1))
+        for start in range(low, high + 1, size)
+    ]
+
+
+def check_range(url: str, low: int, high: int) -> tuple:
+    '''
+    Compare stored and rebuilt balances of wallets with
+    ids in [low, high). Return number of wallets checked
+    and a list of discrepancies.
+    '''
+    if url not in _databases:
+        _databases[url] = Database(url, pool_size=1, max_overflow=0)
+    engine = _databases[url].engine
+
+    bounds = dict(low=low, high=high)
+    with engine.begin() as conn:
+        expected = dict(conn.execute(EXPECTED_BALANCES, bounds).all())
+        wallets = conn.execute(STORED_BALANCES, bounds).all()
+
+    discrepancies = []
+    for wallet_id, name, balance in wallets:
+        balance = balance or 0
+        rebuilt = expected.get(wallet_id) or 0
+        if balance != rebuilt:
+            discrepancies.append(dict(
+                wallet_id=wallet_id,
+                name=name,
+                balance=balance,
+                expected=rebuilt,
+                difference=balance - rebuilt
+            ))
+    return len(wallets), discrepancies
+
+
+def repair(engine, discrepancies: list) -> int:
+    '''
+    Set rebuilt balances, return number of wallets repaired.
+    Wallets with balance changed since the check are skipped.
+    '''
+    repaired = 0
+    with engine.begin() as conn:
+        for item in sorted(discrepancies, key=lambda d: d['wallet_id']):
+            result = conn.execute(
+                text('UPDATE "Wallets" SET balance = :expected '
+                     'WHERE id = :wallet_id AND balance = :balance'),
+                item)
+            repaired += result.rowcount
+    return repaired
+
+
+def reconcile(
+        url: str,
+        workers: int = None,
+        range_size: int = RANGE_SIZE,
+        fix: bool = False) -> dict:
+    '''
+    Check all wallets, repair them if asked, return report
+    '''
+    started = time.perf_counter()
+    engine = Database(url).engine
+    ranges = wallet_ranges(engine, range_size)
+
+    checked, discrepancies = 0, []
+    if workers == 1 or len(ranges) < 2:
+        results = (check_range(url, low, high) for low, high in ranges)
+        for count, found in results:
+            checked += count
+            discrepancies.extend(found)
+    else:
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_forget_databases) as pool:
+            lows, highs = zip(*ranges)
+            results = pool.map(
+                check_range, [url] * len(ranges), lows, highs)
+            for count, found in results:
+                checked += count
+                discrepancies.extend(found)
+
+    repaired = repair(engine, discrepancies) if fix else 0
+    return dict(
+        wallets=checked,
+        ranges=len(ranges),
+        discrepancies=[
+            dict(item, **{
+                key: to_str(item[key])
+                for key in ('balance', 'expected', 'difference')
+            })
+            for item in discrepancies
+        ],
+        repaired=repaired,
+        seconds=round(time.perf_counter() - started, 3)
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m whalet.reconcile',
+        description='Rebuild wallet balances from operations')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--range-size', type=int, default=RANGE_SIZE)
+    parser.add_argument(
+        '--report', help='JSON report file (stdout if not set)')
+    parser.add_argument('--repair', action='store_true')
+    args = parser.parse_args(argv)
+
+    url = os.environ.get('DATABASE_URI', 'sqlite:///./whalet.db')
+    report = reconcile(
+        url, workers=args.workers, range_size=args.range_size,
+        fix=args.repair)
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    # non-zero exit status if drift is left
+    left = len(report['discrepancies']) - report['repaired']
+    return 1 if left else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,23 +13,47 @@ abort scenarios if user request does not meet some pre-
 requisites.
 
 This objects - db and abort - module gets from app_context.
+The db object should be a scoped session
+(whalet.database.Database.session): every request gets its
+own session, removed at request teardown.
+
+Wallets are read through whalet.context.request_wallets(),
+so every wallet row is loaded at most once per request.
 '''
 
 # Python Standard Library
-from datetime import datetime
-from decimal import Decimal
+import time
+from datetime import date
+from functools import partial
 
 # Flask
 from flask import Blueprint
+from flask import Response
 from flask import abort as flask_abort
+from flask import g
 from flask import request
+from flask import stream_with_context
+from flask import url_for
 from flask import current_app
 from flask_httpauth import HTTPBasicAuth
+from sqlalchemy import update
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.exceptions import Conflict, default_exceptions
 
 # internal modules
-from whalet import models, schema
-from whalet.helpers import (change_sign, cook_response,
-                            make_query, represent, safe_round)
+from whalet import (context, ledger, metrics, models, passwords, payqueue,
+                    schema, stats)
+from whalet.batcher import WriteBatcher
+from whalet.cache import CredentialCache
+from whalet.helpers import (cook_response, fast_response,
+                            make_history_queries, make_query,
+                            make_wallets_query, parse_ndjson)
+from whalet.money import to_cents, to_str
+from whalet.pagination import fetch_page
+from whalet.serializers import (WALLET_COLUMNS,
+                                operation_dicts, wallet_dicts)
+from whalet.streaming import (FORMATS, WALLET_CSV_FIELDS, iter_rows,
+                              serialize)
 
 
 #
@@ -42,40 +66,220 @@ with app.app_context():
     master_token = app.config['MASTER_TOKEN']
     main = Blueprint('main', __name__)
     auth = HTTPBasicAuth()
+    credential_cache = CredentialCache(
+        maxsize=app.config['AUTH_CACHE_SIZE'],
+        ttl=app.config['AUTH_CACHE_TTL'],
+        enabled=app.config['AUTH_CACHE_ENABLED']
+    )
+    hasher = passwords.PasswordHasher(
+        method=app.config['PASSWORD_HASH_METHOD'],
+        salt_length=app.config['PASSWORD_SALT_LENGTH'],
+        workers=app.config['HASH_WORKERS'],
+        max_pending=app.config['HASH_MAX_PENDING']
+    )
+    rehash_on_login = app.config['PASSWORD_REHASH_ON_LOGIN']
+    write_batcher = None
+    if app.config['WRITE_BATCHER_ENABLED']:
+        write_batcher = WriteBatcher(
+            db.session_factory,
+            max_size=app.config['WRITE_BATCH_MAX_SIZE'],
+            max_wait=app.config['WRITE_BATCH_MAX_WAIT_MS'] / 1000
+        )
+    engine = db.session_factory.kw['bind']
+    debug_query_count = app.config['DEBUG_QUERY_COUNT']
+    if debug_query_count:
+        context.count_queries(engine)
+    sql_instrumentation = None
+    if app.config['SQL_INSTRUMENTATION']:
+        sql_instrumentation = context.QueryInstrumentation(
+            engine,
+            slow_ms=app.config['SLOW_QUERY_MS'],
+            max_statements=app.config['N_PLUS_ONE_STATEMENTS'])
+    request_timing = None
+    if app.config['REQUEST_TIMING_SAMPLE_RATE'] > 0:
+        request_timing = context.RequestTiming(
+            sample_rate=app.config['REQUEST_TIMING_SAMPLE_RATE'],
+            log_requests=app.config['REQUEST_TIMING_LOG'])
+        context.time_statements(engine)
+    app_metrics = None
+    if app.config['METRICS_ENABLED']:
+        app_metrics = metrics.AppMetrics(
+            directory=app.config['METRICS_DIR'],
+            flush_interval=app.config['METRICS_FLUSH_INTERVAL'])
+        context.count_queries(engine)
+        app_metrics.instrument_engine(engine)
+        app_metrics.watch_pool(engine.pool)
+        app_metrics.watch_cache(credential_cache)
+        app_metrics.watch_hasher(hasher)
+        app_metrics.watch_logs()
+        if write_batcher is not None:
+            app_metrics.watch_batcher(write_batcher)
+    metrics_token = app.config['METRICS_TOKEN'] or master_token
+
+
+# starting request timer
+@main.before_app_request
+def start_timer():
+    g.request_started = time.perf_counter()
+    if request_timing is not None:
+        request_timing.start_request()
+
+
+# recording request metrics
+@main.after_app_request
+def record_request(response):
+    if app_metrics is not None and 'request_started' in g:
+        rule = request.url_rule
+        app_metrics.observe_request(
+            route=rule.rule if rule else 'unmatched',
+            method=request.method,
+            status=response.status_code,
+            seconds=time.perf_counter() - g.request_started,
+            statements=context.query_count())
+    return response
+
+
+# timings collected by request (the hook runs last)
+@main.after_app_request
+def add_server_timing(response):
+    timing = context.server_timing()
+    if timing:
+        response.headers['Server-Timing'] = timing
+    return response
+
+
+# reporting time of request phases
+@main.after_app_request
+def report_timing(response):
+    if request_timing is not None and 'request_started' in g:
+        request_timing.finish_request(
+            status=response.status_code,
+            seconds=time.perf_counter() - g.request_started)
+    return response
+
+
+# reporting statements made by request
+@main.after_app_request
+def report_query_count(response):
+    if debug_query_count:
+        count = context.query_count()
+        response.headers['X-Query-Count'] = str(count)
+        app.logger.debug(
+            '%s %s: %s SQL statements', request.method, request.path, count)
+    if sql_instrumentation is not None:
+        sql_instrumentation.finish_request()
+    return response
+
+
+# releasing request-scoped session and state
+@main.teardown_app_request
+def remove_session(exception=None):
+    context.reset()
+    db.remove()
+
+
+def apply_write(func, *args):
+    '''
+    Apply a whalet.ledger write and commit it. With write
+    batcher enabled the write is group-committed together
+    with writes of concurrent requests.
+    '''
+    if write_batcher is not None:
+        return write_batcher.run(func, *args)
+    try:
+        result = func(db, *args)
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    return result
+
+
+# operations history order (unique key for keyset pagination)
+HISTORY_ORDER = [models.Operation.time, models.Operation.id]
+
+# wallets listing orders (unique keys for keyset pagination)
+WALLET_SORTS = {
+    'name': [models.Wallet.name],
+    'balance': [models.Wallet.balance, models.Wallet.id]
+}
+
 
 # setting marshmallow schemas
 
 operation_schema = schema.OperationSchema()
-operations_schema = schema.OperationSchema(many=True)
 wallet_schema = schema.WalletSchema()
-wallets_schema = schema.WalletSchema(many=True)
+queued_payment_schema = schema.QueuedPaymentSchema()
 
 
 # setting authentication
 @auth.verify_password
+@context.timed('auth')
 def verify_password(username, password):
 
     if not password or not username:
         return False
 
-    wallet = db.query(
-                models.Wallet).filter_by(
-                    name=username).scalar()
+    wallet = context.request_wallets(db).get(username)
 
     if not wallet:
-        current_app.logger.debug(f'Auth: No wallet {username} found')
+        current_app.logger.debug('Auth: No wallet %s found', username)
         abort.if_user_doesnt_exist(
             username=username,
             model=models.Wallet
         )
 
-    if models.Wallet.verify_password(db, username, password):
+    # skipping key derivation for recently verified credentials
+    if credential_cache.check(
+            username, password, wallet.password_hash):
+        return wallet
+
+    started = time.perf_counter()
+    verified = hash_or_abort(hasher.verify, wallet.password_hash, password)
+    if app_metrics is not None:
+        app_metrics.password_time.observe(time.perf_counter() - started)
+
+    if verified:
+        if rehash_on_login and hasher.needs_rehash(wallet.password_hash):
+            rehash_password(wallet, password)
+        credential_cache.add(username, password, wallet.password_hash)
         return wallet
 
     else:
         return False
 
 
+def hash_or_abort(func, *args):
+    '''
+    Run a PasswordHasher call, abort with 503
+    if too many hashes are being computed
+    '''
+    try:
+        return func(*args)
+    except passwords.Busy as exc:
+        flask_abort(503, str(exc))
+
+
+def rehash_password(wallet, password: str):
+    '''
+    Store hash made with current settings, unless the
+    password was changed meanwhile
+    '''
+    try:
+        new_hash = hasher.hash(password)
+    except passwords.Busy:
+        return   # next login would do it
+    wallets = models.Wallet.__table__
+    result = db.execute(
+        update(wallets).where(
+            wallets.c.id == wallet.id,
+            wallets.c.password_hash == wallet.password_hash
+        ).values(password_hash=new_hash))
+    db.commit()
+    if result.rowcount:
+        set_committed_value(wallet, 'password_hash', new_hash)
+
+
 # token auth
 def master_token_required(func):
     '''
@@ -83,11 +287,12 @@ def master_token_required(func):
     operations like deposit and wallets inspection.
     '''
     def function_wrapper(*args, **kwargs):
-        abort.if_value_not_specified(arg='token', request=request,
-                                     code=401, message='Anauthorized')
-        token = request.args['token']
-        abort.if_token_incorrect(token=token,
-                                 master_token=master_token)
+        with context.span('auth'):
+            abort.if_value_not_specified(arg='token', request=request,
+                                         code=401, message='Anauthorized')
+            token = request.args['token']
+            abort.if_token_incorrect(token=token,
+                                     master_token=master_token)
         return func(*args, **kwargs)
 
     function_wrapper.__name__ = func.__name__
@@ -107,21 +312,116 @@ def hello():
     return resp, 200
 
 
+# metrics for Prometheus
+@main.route('/metrics', methods=['GET'])
+def get_metrics():
+    '''
+    Metrics in Prometheus text format. Token is given
+    as token argument or as Bearer authorization.
+    '''
+    if app_metrics is None:
+        flask_abort(404)
+    token = request.args.get('token')
+    authorization = request.headers.get('Authorization', '')
+    if token is None and authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    abort.if_token_incorrect(token=token, master_token=metrics_token)
+    return Response(app_metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 # Get wallet list
 @main.route('/v1/wallets', methods=['GET'])
 @master_token_required
 def get_wallets():
     '''
-    Get all the wallets and their balances
+    Get the wallets and their balances.
+
+    Args: <prefix> of wallet names, <sort> by name (default)
+    or balance. All matching wallets are returned unless
+    <limit> or <cursor> arg is given, then one page is
+    returned along with cursors for the next and previous
+    pages.
+    '''
+    query, columns = wallets_listing()
+
+    if 'limit' in request.args or 'cursor' in request.args:
+        return get_wallets_page(query, columns)
+
+    wallets = query.order_by(*columns).all()
+    result = list(wallet_dicts(wallets))
+
+    resp = fast_response(app, {'wallets': result})
+
+    return resp, 200
+
+
+def wallets_listing() -> tuple:
+    '''
+    Query of wallets listing and columns to sort it by
+    '''
+    prefix = request.args.get('prefix', '')
+    abort.if_bad_prefix(prefix)
+    sort = request.args.get('sort', 'name')
+    abort.if_bad_sort(sort, WALLET_SORTS)
+
+    query = make_wallets_query(
+        db=db,
+        model=models.Wallet,
+        prefix=prefix,
+        columns=WALLET_COLUMNS)
+    return query, WALLET_SORTS[sort]
+
+
+def get_wallets_page(query, columns: list):
+    '''
+    Get one page of wallets using keyset pagination
     '''
-    wallets = db.query(models.Wallet).all()
-    result = wallets_schema.dump(wallets)
+    limit = request.args.get(
+        'limit', str(app.config['WALLETS_PAGE_SIZE']))
+    abort.if_bad_limit(
+        limit, maximum=app.config['WALLETS_MAX_PAGE_SIZE'])
+    cursor = request.args.get('cursor')
+    abort.if_bad_cursor(cursor, columns=columns)
 
-    resp = cook_response(app, {'wallets': result})
+    page = fetch_page(
+        [query], columns=columns, limit=int(limit), cursor=cursor)
+
+    resp = fast_response(
+        app,
+        {
+            'wallets': list(wallet_dicts(page.items)),
+            'next': page.next,
+            'prev': page.prev
+        }
+    )
 
     return resp, 200
 
 
+# stream all the wallets
+@main.route('/v1/wallets/stream', methods=['GET'])
+@master_token_required
+def stream_wallets():
+    '''
+    Stream wallets listing (same args as /v1/wallets)
+    as NDJSON (default), CSV or JSON
+    '''
+    format = request.args.get('format', 'ndjson')
+    abort.if_bad_format(format, FORMATS)
+    query, columns = wallets_listing()
+
+    rows = iter_rows(
+        [query], columns=columns,
+        batch_size=app.config['STREAM_BATCH_SIZE'])
+    chunks = serialize(
+        wallet_dicts(rows),
+        format=format,
+        key='wallets',
+        fields=WALLET_CSV_FIELDS)
+
+    return stream_response(chunks, format), 200
+
+
 # create a wallet
 @main.route('/v1/create', methods=['POST'])
 def create_wallet():
@@ -140,31 +440,25 @@ def create_wallet():
         )
     abort.if_bad_wallet_name(arg=wallet_name)
     abort.if_bad_password(pwd=password)
+    password_hash = hash_or_abort(hasher.hash, password)
     try:
         app.logger.info('Trying to load new user into Wallet')
         wallet = wallet_schema.load(
             dict(
                 name=wallet_name,
-                balance=Decimal('0'),
-                password_hash=models.Wallet.hash_password(
-                    password=password)
+                balance=0,
+                password_hash=password_hash
                 )
         )
     except Exception as exc:
-        app.logger.info(f'{exc}')
+        app.logger.info('%s', exc)
         flask_abort(500, 'Error during wallet creation')
 
-    operation = operation_schema.load(
-        dict(
-            optype='creation',
-            time=datetime.now().isoformat(),
-            sent_to=wallet_name
-            )
-        )
-
     db.add(wallet)
-    db.add(operation)
+    db.flush()
+    ledger.record_creation(db, wallet)
     db.commit()
+    context.request_wallets(db).add(wallet)
 
     resp = cook_response(
         app,
@@ -181,14 +475,11 @@ def get_balance():
     '''
     Get balance for given wallet
     '''
-    wallet_name = auth.current_user().name
+    wallet = auth.current_user()
+    wallet_name = wallet.name
 
-    balance = db.query(models.Wallet).filter(
-        models.Wallet.name == wallet_name
-    ).first()
-
-    # balance: str
-    balance = represent(balance.balance)
+    # wallet row is loaded by auth in this request already
+    balance = to_str(wallet.balance)
     resp = cook_response(
         app,
         {f'{wallet_name}:balance': balance})
@@ -203,23 +494,21 @@ def change_password():
     '''
     Change password for user
     '''
-    wallet_name = auth.current_user().name
+    wallet = auth.current_user()
+    wallet_name = wallet.name
     abort.if_value_not_specified(
         arg='pwd', request=request)
     password = request.args['pwd']
     abort.if_bad_password(pwd=password)
+    password_hash = hash_or_abort(hasher.hash, password)
 
     try:
         app.logger.info('Trying to change password')
-        db.query(models.Wallet).filter(
-            models.Wallet.name == wallet_name).update(
-                {
-                    models.Wallet.password_hash:
-                        models.Wallet.hash_password(password)
-                }
-        )
+        wallet.password_hash = password_hash
+        db.commit()
+        credential_cache.invalidate(wallet_name)
     except Exception as exc:
-        app.logger.info(f'{exc}')
+        app.logger.info('%s', exc)
         flask_abort(500, 'Error during changing password')
 
     resp = cook_response(
@@ -233,30 +522,197 @@ def change_password():
 @main.route('/v1/history', methods=['GET'])
 @main.route('/v1/history/page/<int:page>', methods=['GET'])
 @auth.login_required
-def get_history(page=1):
+def get_history(page=None):
     '''
-    Get history for given wallet
+    Get history for given wallet.
+
+    Whole history is returned unless <limit> or <cursor>
+    arg is given, then one page is returned along with
+    cursors for the next and previous pages.
+    /v1/history/page/<page> is a deprecated alias (its page
+    number was never used), kept for old clients.
     '''
-    wallet_name = auth.current_user().name
+    wallet = auth.current_user()
+    wallet_name = wallet.name
 
-    the_query = make_query(
-        db=db,
-        wallet_name=wallet_name,
-        model=models.Operation)
+    if 'limit' in request.args or 'cursor' in request.args:
+        return get_history_page(wallet)
 
-    # TODO(Alex): pagination with Query obj does not work
-    # need some pure SQL implementation
+    rows = iter_rows(
+        history_queries(wallet),
+        columns=HISTORY_ORDER,
+        batch_size=app.config['STREAM_BATCH_SIZE'])
 
-    result = operations_schema.dump(the_query.all())
-    result = change_sign(result, wallet_name)
-    resp = cook_response(
+    result = list(operation_dicts(rows, wallet_name))
+    resp = fast_response(
         app,
         {f'{wallet_name}:history': result}
         )
+    if page is not None:
+        resp.headers['Deprecation'] = 'true'
+        resp.headers['Link'] = '</v1/history>; rel="successor-version"'
 
     return resp, 200
 
 
+def history_queries(wallet: models.Wallet) -> list:
+    '''
+    Queries of hot and archived (see whalet.archive)
+    operations of given wallet, to be merged in
+    HISTORY_ORDER
+    '''
+    return [
+        query
+        for model in (models.Operation, models.ArchivedOperation)
+        for query in make_history_queries(
+            db=db, wallet_id=wallet.id, model=model)
+    ]
+
+
+def get_history_page(wallet: models.Wallet):
+    '''
+    Get one page of history using keyset pagination
+    on (time, id) of operations
+    '''
+    wallet_name = wallet.name
+    limit = request.args.get(
+        'limit', str(app.config['HISTORY_PAGE_SIZE']))
+    abort.if_bad_limit(
+        limit, maximum=app.config['HISTORY_MAX_PAGE_SIZE'])
+    cursor = request.args.get('cursor')
+    abort.if_bad_cursor(cursor, columns=HISTORY_ORDER)
+
+    page = fetch_page(
+        history_queries(wallet),
+        columns=HISTORY_ORDER,
+        limit=int(limit),
+        cursor=cursor)
+
+    result = list(operation_dicts(page.items, wallet_name))
+    resp = fast_response(
+        app,
+        {
+            f'{wallet_name}:history': result,
+            'next': page.next,
+            'prev': page.prev
+        }
+    )
+
+    return resp, 200
+
+
+def history_records(wallet: models.Wallet):
+    '''
+    Stream serialized operations of given wallet
+    '''
+    rows = iter_rows(
+        history_queries(wallet),
+        columns=HISTORY_ORDER,
+        batch_size=app.config['STREAM_BATCH_SIZE'])
+    return operation_dicts(rows, wallet.name)
+
+
+def stream_response(chunks, format: str, filename: str = None):
+    '''
+    Make chunked response keeping request context (and db
+    session) alive until the last chunk is sent
+    '''
+    resp = app.response_class(
+        stream_with_context(chunks),
+        mimetype=FORMATS[format]
+    )
+    if filename:
+        resp.headers['Content-Disposition'] = \
+            f'attachment; filename={filename}.{format}'
+    return resp
+
+
+# activity statistics for a wallet
+@main.route('/v1/stats', methods=['GET'])
+@auth.login_required
+def get_stats():
+    '''
+    Get deposited, received and sent sums and number of
+    operations of given wallet by periods.
+
+    Args: <from> and <to> days (YYYY-MM-DD, inclusive),
+    <granularity>: day (default), week, month, year or total.
+    '''
+    wallet = auth.current_user()
+    start = request.args.get('from')
+    end = request.args.get('to')
+    abort.if_bad_date(start)
+    abort.if_bad_date(end)
+    abort.if_bad_date_range(start, end)
+    granularity = request.args.get('granularity', 'day')
+    abort.if_bad_granularity(granularity, stats.GRANULARITIES)
+
+    result = stats.wallet_stats(
+        db,
+        wallet_id=wallet.id,
+        start=date.fromisoformat(start) if start else None,
+        end=date.fromisoformat(end) if end else None,
+        granularity=granularity)
+
+    resp = fast_response(
+        app,
+        {
+            f'{wallet.name}:stats': result,
+            'granularity': granularity
+        }
+    )
+
+    return resp, 200
+
+
+# stream op history for a wallet
+@main.route('/v1/history/stream', methods=['GET'])
+@auth.login_required
+def stream_history():
+    '''
+    Stream whole history for given wallet as NDJSON
+    (default), CSV or JSON
+    '''
+    wallet = auth.current_user()
+    wallet_name = wallet.name
+    format = request.args.get('format', 'ndjson')
+    abort.if_bad_format(format, FORMATS)
+
+    chunks = serialize(
+        history_records(wallet),
+        format=format,
+        key=f'{wallet_name}:history')
+
+    return stream_response(chunks, format), 200
+
+
+# export wallet with its history
+@main.route('/v1/export', methods=['GET'])
+@auth.login_required
+def export_wallet():
+    '''
+    Stream wallet name, balance and whole history
+    as a downloadable NDJSON (default), CSV or JSON file.
+    CSV file contains operations only.
+    '''
+    wallet = auth.current_user()
+    format = request.args.get('format', 'ndjson')
+    abort.if_bad_format(format, FORMATS)
+
+    header = {
+        'wallet': wallet.name,
+        'balance': to_str(wallet.balance)
+    }
+    chunks = serialize(
+        history_records(wallet),
+        format=format,
+        key='history',
+        header=header)
+
+    return stream_response(
+        chunks, format, filename=f'{wallet.name}-export'), 200
+
+
 # deposit money to wallet
 @main.route('/v1/deposit', methods=['PUT', 'POST'])
 @master_token_required
@@ -271,34 +727,69 @@ def deposit():
     # checking amount provided (aka <adding>)
     provided_sum = request.args['sum']
     abort.if_not_numeric(provided_sum)
-    adding = Decimal(provided_sum)
-    adding = safe_round(adding)
+    adding = to_cents(provided_sum)
     abort.if_negative_arg(adding, operation='deposit')
     abort.if_zero_amount(adding)
+    abort.if_amount_too_large(adding)
 
-    # actual balance changing
-    wallet = db.query(models.Wallet).filter(
-        models.Wallet.name == wallet_name).first()
-    old_balance = Decimal(str(wallet.balance))
-    new_balance = old_balance + adding
-    wallet.balance = new_balance
-    db.commit()
+    # balance changing and operation recording in one transaction
+    try:
+        new_balance = apply_write(ledger.deposit, wallet_name, adding)
+    except ledger.LedgerError as exc:
+        flask_abort(exc.code, exc.message)
 
-    # operation loading and commiting
-    operation = operation_schema.load(
-        dict(
-            optype='deposit',
-            sent_to=wallet_name,
-            amount=adding,
-            time=datetime.now().isoformat())
-            )
+    resp = cook_response(
+        app, {f'{wallet_name}:new_balance': to_str(new_balance)}
+        )
+
+    return resp, 200
 
-    db.add(operation)
-    db.commit()
 
+# deposit money to many wallets at once
+@main.route('/v1/deposit/bulk', methods=['POST'])
+@master_token_required
+def bulk_deposit():
+    '''
+    Deposit money in many wallets in one transaction.
+
+    Body: JSON list of {"to": <wallet>, "sum": <sum>} items
+    (or {"items": [...]}), or the same items as NDJSON lines
+    (Content-Type: application/x-ndjson). Valid items are
+    applied, the rest are reported as rejected.
+    '''
+    if request.mimetype in ('application/x-ndjson', 'application/ndjson'):
+        body = parse_ndjson(request.get_data(as_text=True))
+    else:
+        body = request.get_json(silent=True)
+    abort.if_bad_batch(
+        body, max_items=app.config['DEPOSIT_BULK_MAX_ITEMS'])
+    items = body['items'] if isinstance(body, dict) else body
+
+    # all wallets checked with one set-based query
+    known_wallets = ledger.existing_wallets(db, [
+        str(item['to']) for item in items
+        if isinstance(item, dict) and 'to' in item
+    ])
+    checked = [check_batch_item(item, known_wallets) for item in items]
+
+    deposits = [deposit for deposit, error in checked if error is None]
+    try:
+        total = apply_write(ledger.deposit_many, deposits)
+    except ledger.LedgerError as exc:
+        flask_abort(exc.code, exc.message)
+
+    rejected = [
+        dict(index=i, code=error.code, error=error.description)
+        for i, (_, error) in enumerate(checked) if error is not None
+    ]
     resp = cook_response(
-        app, {f'{wallet_name}:new_balance': new_balance}
-        )
+        app,
+        {
+            'accepted': len(deposits),
+            'total': to_str(total),
+            'rejected': rejected
+        }
+    )
 
     return resp, 200
 
@@ -310,7 +801,8 @@ def transaction():
     '''
     Pay from one wallet to another
     '''
-    from_wallet = auth.current_user().name
+    sender = auth.current_user()
+    from_wallet = sender.name
 
     # pre-checkings
     abort.if_value_not_specified(  # where to pay
@@ -319,6 +811,7 @@ def transaction():
     )
     to_wallet = request.args['to']
     abort.if_wallet_doesnt_exist(to_wallet, models.Wallet)
+    recipient = context.request_wallets(db).get(to_wallet)
     abort.if_value_not_specified(  # how much to pay
         arg='sum',
         request=request)
@@ -326,47 +819,198 @@ def transaction():
     # operation checkings
     amount = request.args['sum']
     abort.if_not_numeric(amount)
-    amount = safe_round(Decimal(amount))
-    abort.if_balance_falls_below_zero(
-        from_wallet=from_wallet,
-        value=amount,
-        model=models.Wallet)
+    amount = to_cents(amount)
     abort.if_negative_arg(
         arg=amount,
         operation='transaction')
     abort.if_zero_amount(amount)
+    abort.if_amount_too_large(amount)
 
-    # changing balances:
-    db.query(models.Wallet).filter(
-        models.Wallet.name == from_wallet).update(
-            {models.Wallet.balance: models.Wallet.balance - amount}
-        )
+    if request.args.get('async') in ('1', 'true') or \
+            'respond-async' in request.headers.get('Prefer', ''):
+        return enqueue_payment(from_wallet, to_wallet, amount)
 
-    db.query(models.Wallet).filter(
-        models.Wallet.name == to_wallet).update(
-            {models.Wallet.balance: models.Wallet.balance + amount}
-        )
+    # conditional debit, credit and history in one transaction;
+    # not enough money means no row debited
+    known_ids = {from_wallet: sender.id, to_wallet: recipient.id}
+    try:
+        act_balance = apply_write(
+            partial(ledger.transfer, known_ids=known_ids),
+            from_wallet, to_wallet, amount)
+    except ledger.LedgerError as exc:
+        flask_abort(exc.code, exc.message)
 
-    # making history:
-    operation = operation_schema.load(
-        dict(
-            optype='transaction',
-            amount=amount,
-            sent_to=to_wallet,
-            get_from=from_wallet,
-            time=datetime.now().isoformat())
-            )
-    db.add(operation)
+    resp = cook_response(
+        app=app,
+        data={f'{from_wallet}:balance': to_str(act_balance)}
+    )
+
+    return resp, 200
+
+
+def enqueue_payment(from_wallet: str, to_wallet: str, amount: int):
+    '''
+    Accept payment into the queue, it is applied later
+    by whalet.payqueue with the same ledger checks
+    '''
+    try:
+        payment_id = payqueue.enqueue(
+            db, from_wallet, to_wallet, amount,
+            max_depth=app.config['PAYMENT_QUEUE_MAX_DEPTH'])
+    except payqueue.QueueFull as exc:
+        db.rollback()
+        flask_abort(503, str(exc))
     db.commit()
 
-    # getting actual balance of the donor wallet
-    wallet_1 = db.query(models.Wallet).filter(
-            models.Wallet.name == from_wallet).first()
-    act_balance = Decimal(str(wallet_1.balance))
+    resp = cook_response(
+        app, {'operation': payment_id, 'status': payqueue.QUEUED})
+    resp.headers['Location'] = url_for(
+        'main.get_operation', operation_id=payment_id)
+
+    return resp, 202
+
 
+# get status of an operation
+@main.route('/v1/operations/<operation_id>', methods=['GET'])
+@auth.login_required
+def get_operation(operation_id):
+    '''
+    Get status of queued payment or a finished operation
+    '''
+    wallet = auth.current_user()
+    wallet_name = wallet.name
+
+    payment = db.query(models.QueuedPayment).filter_by(
+        id=operation_id, get_from=wallet_name).first()
+    if payment:
+        result = queued_payment_schema.dump(payment)
+    else:
+        operation = None
+        operation_key = models.parse_operation_id(operation_id)
+        for model in (models.Operation, models.ArchivedOperation):
+            if operation or not operation_key:
+                break
+            operation = make_query(
+                db=db,
+                wallet_id=wallet.id,
+                model=model).filter(model.id == operation_key).first()
+        if not operation:
+            flask_abort(404, f'Operation {operation_id} does not exist')
+        result = next(operation_dicts([operation], wallet_name))
+        result['status'] = payqueue.DONE
+
+    resp = cook_response(app, {f'{wallet_name}:operation': result})
+
+    return resp, 200
+
+
+def check_batch_item(item, known_wallets: set):
+    '''
+    Validate one {"to": ..., "sum": ...} batch item with
+    the same rules as single operations use.
+    Return ((to_wallet, amount), None) or (None, HTTPException)
+    '''
+    def checks():
+        abort.if_item_incomplete(item)
+        to_wallet = str(item['to'])
+        abort.if_wallet_doesnt_exist(
+            to_wallet, models.Wallet, known=known_wallets)
+        provided_sum = str(item['sum'])
+        abort.if_not_numeric(provided_sum)
+        amount = to_cents(provided_sum)
+        abort.if_negative_arg(amount)
+        abort.if_zero_amount(amount)
+        abort.if_amount_too_large(amount)
+        return to_wallet, amount
+
+    return abort.collect(checks)
+
+
+def batch_item_result(index: int, checked, error) -> dict:
+    if error is not None:
+        return dict(index=index, status='rejected',
+                    code=error.code, error=error.description)
+    to_wallet, amount = checked
+    return dict(index=index, status='ok',
+                to=to_wallet, sum=to_str(amount))
+
+
+def batch_rejected(mode: str, checked: list, code: int):
+    '''
+    Response to a batch of which nothing was applied
+    '''
+    results = [
+        batch_item_result(i, *check) for i, check in enumerate(checked)
+    ]
     resp = cook_response(
-        app=app,
-        data={f'{from_wallet}:balance': act_balance}
+        app, {'mode': mode, 'applied': 0, 'results': results})
+    return resp, code
+
+
+# pay many wallets at once
+@main.route('/v1/pay/batch', methods=['POST'])
+@auth.login_required
+def batch_transaction():
+    '''
+    Pay from one wallet to many in one transaction.
+
+    Body: [{"to": <wallet>, "sum": <sum>}, ...] or
+    {"items": [...], "mode": <mode>}. Modes:
+
+    - atomic (default): all items are applied or none
+    - best_effort: valid items are applied in given order
+      while balance allows, the rest are rejected
+    '''
+    from_wallet = auth.current_user().name
+    body = request.get_json(silent=True)
+    abort.if_bad_batch(body, max_items=app.config['PAY_BATCH_MAX_ITEMS'])
+    items = body['items'] if isinstance(body, dict) else body
+    mode = request.args.get('mode') or (
+        body.get('mode', 'atomic') if isinstance(body, dict) else 'atomic')
+    abort.if_bad_mode(mode, ('atomic', 'best_effort'))
+
+    # all recipients checked with one set-based query
+    known_wallets = ledger.existing_wallets(db, [
+        str(item['to']) for item in items
+        if isinstance(item, dict) and 'to' in item
+    ])
+    checked = [check_batch_item(item, known_wallets) for item in items]
+
+    if mode == 'atomic' and any(error for _, error in checked):
+        return batch_rejected(mode, checked, 400)
+
+    valid = [i for i, (_, error) in enumerate(checked) if error is None]
+    payments = [checked[i][0] for i in valid]
+    try:
+        if mode == 'best_effort':
+            # payments that fit into balance are chosen by the write
+            balance, paid = apply_write(
+                ledger.transfer_fitting, from_wallet, payments)
+            for position in set(range(len(valid))) - set(paid):
+                checked[valid[position]] = None, Conflict(
+                    f'Not enough money in wallet {from_wallet}')
+            payments = [payments[position] for position in paid]
+        elif payments:
+            balance = apply_write(
+                ledger.transfer_many, from_wallet, payments)
+    except ledger.LedgerError as exc:
+        # nothing applied: valid items are rejected with the error
+        error = default_exceptions[exc.code](exc.message)
+        for i in valid:
+            checked[i] = None, error
+        return batch_rejected(mode, checked, exc.code)
+
+    results = [
+        batch_item_result(i, *check) for i, check in enumerate(checked)
+    ]
+    resp = cook_response(
+        app,
+        {
+            f'{from_wallet}:balance': to_str(balance),
+            'mode': mode,
+            'applied': len(payments),
+            'results': results
+        }
     )
 
     return resp, 200
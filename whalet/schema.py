@@ -5,6 +5,7 @@ from marshmallow import Schema, ValidationError, fields, post_load
 
 # internal
 from whalet import models
+from whalet.money import to_cents, to_str
 
 
 # Custom validators
@@ -19,26 +20,62 @@ def must_be_enum(data):
         raise ValidationError("Unsupported operation type")
 
 
+# Custom fields
+class Money(fields.Field):
+    '''
+    Integer cents in models, 2-decimal string in API
+    '''
+    def _serialize(self, value, attr, obj, **kwargs):
+        return to_str(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            return to_cents(value)
+        except ValueError as exc:
+            raise ValidationError('Not a valid amount.') from exc
+
+
+class OperationId(fields.Field):
+    '''
+    16 bytes in models, UUID string in API
+    '''
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value is None:
+            return None
+        return models.format_operation_id(value)
+
+
 # Schemas
 class OperationSchema(Schema):
-    id = fields.Str(dump_only=True)
+    '''
+    Operation as seen in API: rows of OPERATION_COLUMNS
+    (see whalet.serializers), with wallet names
+    '''
+    id = OperationId(dump_only=True)
     optype = fields.Str(validate=must_be_enum)
     time = fields.DateTime()
-    amount = fields.Decimal(as_string=True)
+    amount = Money()
     sent_to = fields.Str()
     get_from = fields.Str()
 
-    @post_load
-    def make_op(self, data, **kwargs):
-        return models.Operation(**data)
-
 
 class WalletSchema(Schema):
     id = fields.Int(dump_only=True)
     name = fields.Str()
-    balance = fields.Decimal(as_string=True)
+    balance = Money()
     password_hash = fields.Str(load_only=True)
 
     @post_load
     def make_wallet(self, data, **kwargs):
         return models.Wallet(**data)
+
+
+class QueuedPaymentSchema(Schema):
+    id = fields.Str(dump_only=True)
+    status = fields.Str()
+    amount = Money()
+    sent_to = fields.Str()
+    get_from = fields.Str()
+    error = fields.Str()
+    created = fields.DateTime()
+    processed = fields.DateTime()
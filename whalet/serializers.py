@@ -0,0 +1,105 @@
+'''
+Fast serialization of Operation and Wallet rows.
+
+Marshmallow dump, change_sign() and json.dumps() with a Python
+default= callback cost more than the query itself for long
+histories. Here plain column tuples are turned into dicts by
+precompiled functions and dumped by orjson when it is installed
+(falling back to json otherwise).
+
+Output has the same keys and values as the marshmallow schemas
+in whalet.schema: ids in UUID format, amounts as 2-decimal
+strings, time in ISO format and outgoing transfers with minus
+sign.
+'''
+import json
+
+from sqlalchemy.orm import aliased
+
+from whalet import models
+from whalet.money import to_str
+
+try:
+    import orjson
+except ImportError:   # optional fast JSON backend
+    orjson = None
+
+
+# operations reference wallets by id, names are joined
+SENT_TO = aliased(models.Wallet, name='sent_to_wallet')
+GET_FROM = aliased(models.Wallet, name='get_from_wallet')
+
+
+def operation_columns(model: object) -> tuple:
+    '''
+    Columns of operation rows of given table (hot
+    Operations or OperationsArchive)
+    '''
+    return (
+        model.id,
+        model.optype,
+        model.time,
+        model.amount,
+        SENT_TO.name.label('sent_to'),
+        GET_FROM.name.label('get_from')
+    )
+
+
+OPERATION_COLUMNS = operation_columns(models.Operation)
+ARCHIVE_COLUMNS = operation_columns(models.ArchivedOperation)
+
+WALLET_COLUMNS = (
+    models.Wallet.id,
+    models.Wallet.name,
+    models.Wallet.balance
+)
+
+
+def operations_query(
+        db,
+        columns: tuple = OPERATION_COLUMNS,
+        model: object = models.Operation):
+    '''
+    Query of operation columns with wallet names joined
+    '''
+    return db.query(*columns).outerjoin(
+        SENT_TO, model.sent_to_id == SENT_TO.id
+    ).outerjoin(
+        GET_FROM, model.get_from_id == GET_FROM.id
+    )
+
+
+def dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+
+def operation_dicts(rows, wallet_name: str):
+    '''
+    Turn OPERATION_COLUMNS tuples into dicts, changing sign
+    of transfers made by given wallet
+    '''
+    for op_id, optype, time, amount, sent_to, get_from in rows:
+        if optype == 'transaction' and get_from == wallet_name:
+            amount = -amount
+        yield {
+            'id': models.format_operation_id(op_id),
+            'optype': optype,
+            'time': time.isoformat() if time is not None else None,
+            'amount': to_str(amount),
+            'sent_to': sent_to,
+            'get_from': get_from
+        }
+
+
+def wallet_dicts(rows):
+    '''
+    Turn WALLET_COLUMNS tuples into dicts
+    '''
+    for wallet_id, name, balance in rows:
+        yield {
+            'id': wallet_id,
+            'name': name,
+            'balance': to_str(balance)
+        }
@@ -0,0 +1,156 @@
+'''
+Daily rollup of wallet activity.
+
+Every operation recorded by whalet.ledger adds to the DailyStats
+row of each wallet taking part: deposited, received and sent
+cents and the number of operations. Rows are upserted in the
+same transaction as the operations, so statistics of any date
+range are read from at most one row per wallet and day instead
+of scanning the Operations table.
+'''
+from collections import defaultdict
+from datetime import date, timedelta
+
+from sqlalchemy import and_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from whalet import models
+from whalet.money import to_str
+
+
+daily = models.DailyStats.__table__
+
+COUNTERS = ('deposited', 'received', 'sent', 'operations')
+
+GRANULARITIES = ('day', 'week', 'month', 'year', 'total')
+
+
+def rollup(rows: list) -> dict:
+    '''
+    Sum operation rows (dicts with optype, time, amount,
+    sent_to_id and get_from_id) into {(wallet_id, day):
+    [deposited, received, sent, operations]}
+    '''
+    deltas = defaultdict(lambda: [0, 0, 0, 0])
+    for row in rows:
+        day = row['time'].date()
+        amount = row.get('amount') or 0
+        sent_to, get_from = row.get('sent_to_id'), row.get('get_from_id')
+        if sent_to is not None:
+            delta = deltas[sent_to, day]
+            if row['optype'] == 'deposit':
+                delta[0] += amount
+            elif row['optype'] == 'transaction':
+                delta[1] += amount
+            delta[3] += 1
+        if get_from is not None:
+            delta = deltas[get_from, day]
+            delta[2] += amount
+            if get_from != sent_to:
+                delta[3] += 1
+    return deltas
+
+
+def add(session, rows: list):
+    '''
+    Add just recorded operation rows to daily statistics
+    '''
+    deltas = rollup(rows)
+    # keys in one order, concurrent writers lock rows alike
+    increment(session, daily, ('wallet_id', 'day'), COUNTERS, [
+        dict(zip(('wallet_id', 'day') + COUNTERS, key + tuple(delta)))
+        for key, delta in sorted(deltas.items())
+    ])
+
+
+def increment(
+        session,
+        table,
+        keys: tuple,
+        counters: tuple,
+        values: list,
+        replace: tuple = ()):
+    '''
+    Upsert rows adding values of counter columns to the
+    existing ones (and overwriting replace columns)
+    '''
+    if not values:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        module = sqlite if dialect == 'sqlite' else postgresql
+        insert = module.insert(table)
+        changes = {name: table.c[name] + insert.excluded[name]
+                   for name in counters}
+        changes.update(
+            {name: insert.excluded[name] for name in replace})
+        session.execute(insert.on_conflict_do_update(
+            index_elements=list(keys), set_=changes), values)
+        return
+
+    # no upsert: update existing rows, insert the rest
+    for value in values:
+        changes = {name: table.c[name] + value[name] for name in counters}
+        changes.update({name: value[name] for name in replace})
+        result = session.execute(
+            update(table).where(and_(
+                *(table.c[name] == value[name] for name in keys)
+            )).values(changes))
+        if not result.rowcount:
+            session.execute(table.insert(), [value])
+
+
+def period_start(day: date, granularity: str, first: date = None) -> date:
+    '''
+    First day of the period given day belongs to
+    '''
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    if granularity == 'year':
+        return day.replace(month=1, day=1)
+    if granularity == 'total':
+        return first
+    return day
+
+
+def wallet_stats(
+        session,
+        wallet_id: int,
+        start: date = None,
+        end: date = None,
+        granularity: str = 'day') -> list:
+    '''
+    Statistics of a wallet between start and end days
+    (inclusive) summed by periods of given granularity.
+    Periods without operations are left out.
+    '''
+    query = select(
+        daily.c.day, *(daily.c[name] for name in COUNTERS)
+    ).where(daily.c.wallet_id == wallet_id).order_by(daily.c.day)
+    if start:
+        query = query.where(daily.c.day >= start)
+    if end:
+        query = query.where(daily.c.day <= end)
+
+    periods = {}
+    first = start
+    for day, *counters in session.execute(query):
+        first = first or day
+        period = period_start(day, granularity, first=first)
+        totals = periods.setdefault(period, [0, 0, 0, 0])
+        for i, value in enumerate(counters):
+            totals[i] += value or 0
+
+    return [
+        {
+            'period': period.isoformat(),
+            'deposited': to_str(deposited),
+            'received': to_str(received),
+            'sent': to_str(sent),
+            'operations': operations
+        }
+        for period, (deposited, received, sent, operations)
+        in periods.items()
+    ]
@@ -0,0 +1,114 @@
+'''
+Streaming responses for long operation histories
+and wallet listings.
+
+Rows are read through server-side cursors (Query.yield_per)
+and serialized one by one into NDJSON, CSV or JSON chunks,
+so worker memory does not depend on the history length.
+'''
+import csv
+import io
+import json
+
+from whalet.pagination import merge_rows, query_columns
+from whalet.serializers import dumps
+
+
+# format name: mimetype
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'json': 'application/json'
+}
+
+CSV_FIELDS = ['id', 'optype', 'time', 'amount', 'sent_to', 'get_from']
+WALLET_CSV_FIELDS = ['id', 'name', 'balance']
+
+
+def iter_rows(
+        queries: list,
+        columns: list,
+        batch_size=1000):
+    '''
+    Stream rows of several queries in (col_1, col_2, ...)
+    order. Every query is read with a server-side cursor
+    in its index order, streams are merged on the fly.
+    '''
+    def sort_key(row):
+        return tuple(getattr(row, col.key) for col in columns)
+
+    streams = [
+        query.order_by(
+            *query_columns(query, columns)).yield_per(batch_size)
+        for query in queries
+    ]
+    yield from merge_rows(streams, key=sort_key)
+
+
+def buffered(chunks, size=500):
+    '''
+    Join small string chunks to send less pieces over the wire
+    '''
+    buffer = []
+    for chunk in chunks:
+        buffer.append(chunk)
+        if len(buffer) >= size:
+            yield ''.join(buffer)
+            buffer.clear()
+    if buffer:
+        yield ''.join(buffer)
+
+
+def to_ndjson(records, header: dict = None):
+    '''
+    One JSON document per line, header (if any) goes first
+    '''
+    if header is not None:
+        yield json.dumps(header) + '\n'
+    for record in records:
+        yield dumps(record).decode() + '\n'
+
+
+def to_csv(records, fields=CSV_FIELDS):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def to_json(records, key: str, header: dict = None):
+    '''
+    Single JSON object {**header, key: [records]}
+    '''
+    opening = '{'
+    if header:
+        opening += json.dumps(header)[1:-1] + ', '
+    yield opening + json.dumps(key) + ': ['
+    separator = ''
+    for record in records:
+        yield separator + dumps(record).decode()
+        separator = ', '
+    yield ']}'
+
+
+def serialize(
+        records,
+        format: str,
+        key: str,
+        header: dict = None,
+        fields=CSV_FIELDS):
+    '''
+    Get chunks of records serialized in given format
+    '''
+    if format == 'ndjson':
+        chunks = to_ndjson(records, header)
+    elif format == 'csv':
+        chunks = to_csv(records, fields)
+    else:
+        chunks = to_json(records, key, header)
+    return buffered(chunks)
@@ -1,9 +1,12 @@
 import os
+import shlex
+import sys
 
 from whalet.factory import create_app
 from whalet.check import Abort
-from whalet import models
+from whalet import migrations, models
 from whalet.database import Database
+from whalet.payqueue import PaymentProcessor
 
 
 # creating app
@@ -15,19 +18,30 @@ app.config['TESTING'] = True
 
 app.logger.info('Creating database...')
 
+# connection pool settings
+pool_options = dict(
+    pool_size=app.config['DB_POOL_SIZE'],
+    max_overflow=app.config['DB_MAX_OVERFLOW'],
+    pool_recycle=app.config['DB_POOL_RECYCLE'],
+    pool_pre_ping=app.config['DB_POOL_PRE_PING'],
+    pool_timeout=app.config['DB_POOL_TIMEOUT']
+)
+
 # creating database, session and tables
 if app.config['TESTING']:
     app.logger.warning('App using SQLight temporary db')
-    dbase = Database()
+    dbase = Database(**pool_options)
     MASTER_TOKEN = 'whalesome'
 
 else:
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URI']
     MASTER_TOKEN = os.environ['MASTER_TOKEN']
-    dbase = Database(url=SQLALCHEMY_DATABASE_URI)
+    dbase = Database(url=SQLALCHEMY_DATABASE_URI, **pool_options)
 
-db = dbase.create_session()
-models.Base.metadata.create_all(bind=dbase.engine)
+# request-scoped session, removed on request teardown
+# in whalet.routes
+db = dbase.session
+migrations.upgrade(dbase.engine, models.Base.metadata)
 
 app.logger.info('Registering aborter helper...')
 
@@ -35,6 +49,11 @@ app.logger.info('Registering aborter helper...')
 # in user requests
 abort = Abort(app, db)
 
+# metrics of all gunicorn workers are summed through files
+# in METRICS_DIR (should be emptied on server start)
+if os.environ.get('METRICS_DIR'):
+    app.config['METRICS_DIR'] = os.environ['METRICS_DIR']
+
 # registering database and abort helper in app
 app.config['DATABASE_SESSION'] = db
 app.config['ABORT_HELPER'] = abort
@@ -48,6 +67,40 @@ with app.app_context():
     from whalet import routes
     app.register_blueprint(routes.main)
 
+
+def gunicorn_workers() -> int:
+    '''
+    Number of workers gunicorn was started with (command line,
+    GUNICORN_CMD_ARGS or WEB_CONCURRENCY), 1 if not run by it
+    '''
+    if 'gunicorn' not in sys.modules:
+        return 1
+    from gunicorn.config import Config
+    config = Config()
+    argv = shlex.split(os.environ.get('GUNICORN_CMD_ARGS', '')) \
+        + sys.argv[1:]
+    args, _ = config.parser().parse_known_args(argv)
+    return args.workers or config.workers
+
+
+# applying queued payments inside the app (single worker only,
+# otherwise run "python -m whalet.payqueue" separately)
+if app.config['PAYMENT_QUEUE_WORKERS']:
+    workers = gunicorn_workers()
+    if workers > 1:
+        app.logger.error(
+            'Payment queue processor not started: it runs inside a '
+            'single worker only (got %s), run "python -m '
+            'whalet.payqueue" instead', workers)
+    else:
+        app.logger.info('Starting payment queue processor...')
+        processor = PaymentProcessor(
+            dbase.session_factory,
+            workers=app.config['PAYMENT_QUEUE_WORKERS'],
+            batch_size=app.config['PAYMENT_QUEUE_BATCH_SIZE'],
+            lease=app.config['PAYMENT_QUEUE_LEASE'])
+        processor.start()
+
 app.logger.info('Done with setting.')
 
 if __name__ == '__main__':